@@ -1,12 +1,11 @@
-from typing import Tuple
+from typing import Optional, Tuple
 import numpy as np
 from numpy import ndarray
 from dataclasses import dataclass, field
-from numpy.core.shape_base import block
-from scipy.linalg import block_diag
 import scipy.linalg as la
 from utils import rotmat2d
-from JCBB import JCBB
+from association import Associator, JCBBAssociator, extract_associated
+from validation import CovarianceValidator
 import utils
 import solution
 
@@ -16,8 +15,30 @@ class EKFSLAM:
     Q: ndarray
     R: ndarray
     do_asso: bool
-    alphas: 'ndarray[2]' = field(default=np.array([0.001, 0.0001]))
-    sensor_offset: 'ndarray[2]' = field(default=np.zeros(2))
+    alphas: 'ndarray[2]' = field(
+        default_factory=lambda: np.array([0.001, 0.0001]))
+    sensor_offset: 'ndarray[2]' = field(default_factory=lambda: np.zeros(2))
+    # validation mode: use the (expensive, O(n^3)) Joseph form in update and
+    # check it against the Cholesky downdate
+    joseph_form: bool = False
+    # checks of eta and P in predict, update and add_landmarks, off by default
+    validation: CovarianceValidator = field(default_factory=CovarianceValidator)
+    # data association backend, JCBB with alphas if not given
+    associator: Optional[Associator] = None
+
+    def __post_init__(self):
+        if self.associator is None:
+            self.associator = JCBBAssociator(self.alphas)
+
+    def close(self):
+        """Close the associator, which shuts down the pool of a parallel JCBBAssociator."""
+        self.associator.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     def f(self, x: np.ndarray, u: np.ndarray) -> np.ndarray:
         """Add the odometry u to the robot state x.
@@ -102,6 +123,9 @@ class EKFSLAM:
     ) -> Tuple[np.ndarray, np.ndarray]:
         """Predict the robot state using the zOdo as odometry the corresponding state&map covariance.
 
+        eta and P are updated in place, and only the robot rows and columns of P are touched,
+        so this is O(#landmarks).
+
         Parameters
         ----------
         eta : np.ndarray, shape=(3 + 2*#landmarks,)
@@ -114,50 +138,134 @@ class EKFSLAM:
         Returns
         -------
         Tuple[np.ndarray, np.ndarray], shapes= (3 + 2*#landmarks,), (3 + 2*#landmarks,)*2
-            predicted mean and covariance of eta.
+            predicted mean and covariance of eta, the same arrays as the input.
         """
         #etapred_sol, P_sol = solution.EKFSLAM.EKFSLAM.predict(self, eta, P, z_odo)
 
         # check inout matrix
-        assert np.allclose(P, P.T), "EKFSLAM.predict: not symmetric P input"
-        assert np.all(
-            np.linalg.eigvals(P) >= 0
-        ), "EKFSLAM.predict: non-positive eigen values in P input"
-        assert (
-            eta.shape * 2 == P.shape
-        ), "EKFSLAM.predict: input eta and P shape do not match"
-        etapred = np.empty_like(eta)
+        self.validation.check("EKFSLAM.predict input", eta, P)
 
         x = eta[:3]
-        etapred[:3] = self.f(x, z_odo)  # TODO robot state prediction
-        etapred[3:] = eta[3:]  # TODO landmarks: no effect
+        Fx = self.Fx(x, z_odo)
+        Fu = self.Fu(x, z_odo)
+        xpred = self.f(x, z_odo)
+
+        self.predict_robot(eta, P, xpred, Fx, Fu @ self.Q @ Fu.T)
+
+        self.validation.check("EKFSLAM.predict", eta, P)
+
+        return eta, P
+
+    def predict_batch(
+        self, eta: np.ndarray, P: np.ndarray, z_odos: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Predict with several odometry increments, touching P only once.
+
+        Gives the same result as calling predict for each row of z_odos in turn.
+
+        Parameters
+        ----------
+        eta : np.ndarray, shape=(3 + 2*#landmarks,)
+            the robot state and map concatenated
+        P : np.ndarray, shape=(3 + 2*#landmarks,)*2
+            the covariance of eta
+        z_odos : np.ndarray, shape=(#odometry, 3)
+            the measured odometry increments in the order they are applied
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray], shapes= (3 + 2*#landmarks,), (3 + 2*#landmarks,)*2
+            predicted mean and covariance of eta, the same arrays as the input.
+        """
+        self.validation.check("EKFSLAM.predict_batch input", eta, P)
+
+        xpred, F, Qc = self.compose_odometry(eta[:3], z_odos)
+        self.predict_robot(eta, P, xpred, F, Qc)
+
+        self.validation.check("EKFSLAM.predict_batch", eta, P)
+
+        return eta, P
+
+    def compose_odometry(
+        self, x: np.ndarray, z_odos: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Compose odometry increments into one robot state prediction.
+
+        Parameters
+        ----------
+        x : np.ndarray, shape=(3,)
+            the robot state
+        z_odos : np.ndarray, shape=(#odometry, 3)
+            the measured odometry increments in the order they are applied
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray, np.ndarray], shapes=(3,), (3, 3), (3, 3)
+            the predicted robot state, the accumulated Jacobian wrt. x and the accumulated
+            process noise covariance.
+        """
+        F = np.eye(3)
+        Qc = np.zeros((3, 3))
+        for z_odo in z_odos:
+            x, F, Qc = self.compose_step(x, F, Qc, z_odo)
+
+        return x, F, Qc
+
+    def compose_step(
+        self, x: np.ndarray, F: np.ndarray, Qc: np.ndarray, z_odo: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Compose one more odometry increment onto an accumulated prediction.
+
+        Parameters
+        ----------
+        x : np.ndarray, shape=(3,)
+            the robot state predicted so far
+        F : np.ndarray, shape=(3, 3)
+            the accumulated Jacobian wrt. the robot state at the start
+        Qc : np.ndarray, shape=(3, 3)
+            the accumulated process noise covariance
+        z_odo : np.ndarray, shape=(3,)
+            the measured odometry increment
 
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray, np.ndarray], shapes=(3,), (3, 3), (3, 3)
+            x, F and Qc with z_odo composed.
+        """
         Fx = self.Fx(x, z_odo)
         Fu = self.Fu(x, z_odo)
+        return self.f(x, z_odo), Fx @ F, Fx @ Qc @ Fx.T + Fu @ self.Q @ Fu.T
+
+    def predict_robot(
+        self, eta: np.ndarray, P: np.ndarray, xpred: np.ndarray, F: np.ndarray, Qc: np.ndarray
+    ):
+        """Set the predicted robot state in eta and propagate P in place, O(#landmarks).
 
-        # evaluate covariance prediction in place to save computation
+        Parameters
+        ----------
+        eta : np.ndarray, shape=(3 + 2*#landmarks,)
+            the robot state and map concatenated
+        P : np.ndarray, shape=(3 + 2*#landmarks,)*2
+            the covariance of eta
+        xpred : np.ndarray, shape=(3,)
+            the predicted robot state
+        F : np.ndarray, shape=(3, 3)
+            the Jacobian of the prediction wrt. the robot state
+        Qc : np.ndarray, shape=(3, 3)
+            the process noise covariance of the prediction
+        """
         # only robot state changes, so only rows and colums of robot state needs changing
         # cov matrix layout:
         # [[P_xx, P_xm],
         # [P_mx, P_mm]]
+        # P_xx = F P_xx F^T + Qc, P_xm = F P_xm and P_mx = P_xm^T
+        Pstrip = F @ P[:3, :]
+        P[:3, 3:] = Pstrip[:, 3:]
+        P[3:, :3] = Pstrip[:, 3:].T
+        Pxx = Pstrip[:, :3] @ F.T
+        P[:3, :3] = (Pxx + Pxx.T) / 2 + Qc
 
-        # P = FPF + GQG^T
-
-        P[:3, :3] = Fx@P[0:3, 0:3]@Fx.T + \
-            Fu@self.Q@Fu.T  # robot cov prediction
-        P[:3, 3:] = Fx @ P[:3, 3:]  # robot-map covariance prediction
-        # map-robot covariance: transpose of the above
-        P[3:, :3] = P[3:, :3] @ Fx.T
-
-        assert np.allclose(P, P.T), "EKFSLAM.predict: not symmetric P"
-        assert np.all(
-            np.linalg.eigvals(P) > 0
-        ), "EKFSLAM.predict: non-positive eigen values"
-        assert (
-            etapred.shape * 2 == P.shape
-        ), "EKFSLAM.predict: calculated shapes does not match"
-
-        return etapred, P
+        eta[:3] = xpred
 
     def h(self, eta: np.ndarray) -> np.ndarray:
         """Predict all the landmark positions in sensor frame.
@@ -316,61 +424,146 @@ class EKFSLAM:
         #     self, eta, P, z)
         # return etaadded, Padded
 
-        n = P.shape[0]
+        lmnew, Gx, Rcart = self.init_landmarks(eta, z)
+        return self.append_landmarks(eta, P, lmnew, Gx, Rcart)
+
+    def init_landmarks(
+        self, eta: np.ndarray, z: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Calculate the positions of new landmarks and the Jacobians needed for their covariance.
+
+        Parameters
+        ----------
+        eta : np.ndarray, shape=(3 + 2*#landmarks,)
+            the robot state and map concatenated
+        z : np.ndarray, shape(2 * #newlandmarks,)
+            A set of measurements to create landmarks for
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray, np.ndarray], shapes=(#newlandmarks, 2), (2 * #newlandmarks, 3), (#newlandmarks, 2, 2)
+            the new landmarks in world frame, their Jacobian wrt. the robot state and
+            their measurement covariance in cartesian coordinates.
+        """
         assert z.ndim == 1, "SLAM.add_landmarks: z must be a 1d array"
+        assert len(z) % 2 == 0, "SLAM.add_landmark: z not even length"
 
         numLmk = z.shape[0] // 2
 
-        lmnew = np.empty_like(z)
+        # all the new landmarks at once, zr[j] and zang[j] belong to landmark j
+        zr = z[::2]
+        zang = z[1::2] + eta[2]
+        cos_ang = np.cos(zang)
+        sin_ang = np.sin(zang)
 
-        Gx = np.empty((numLmk * 2, 3))
-        Rall = np.zeros((numLmk * 2, numLmk * 2))
-
-        I2 = np.eye(2)  # Preallocate, used for Gx
         # For transforming landmark position into world frame
         sensor_offset_world = rotmat2d(eta[2]) @ self.sensor_offset
         sensor_offset_world_der = rotmat2d(
             eta[2] + np.pi / 2) @ self.sensor_offset  # Used in Gx
 
-        for j in range(numLmk):
-            ind = 2 * j
-            inds = slice(ind, ind + 2)
-            zj = z[inds]
+        # position of the new landmarks in world frame, shape (#newlandmarks, 2)
+        lmnew = (zr[:, None] * np.stack((cos_ang, sin_ang), axis=1)
+                 + eta[:2] + sensor_offset_world)
 
-            rot = rotmat2d(zj[1] + eta[2])  # TODO, rotmat in Gz
-            # TODO, calculate position of new landmark in world frame
-            lmnew[inds] = zj[0]*rot[:, 0] + eta[:2] + sensor_offset_world
+        # Gx is [I2, d lmnew / d psi] stacked for each landmark, shape (2 * #newlandmarks, 3)
+        Gx = np.empty((numLmk, 2, 3))
+        Gx[:, :, :2] = np.eye(2)
+        Gx[:, 0, 2] = -zr * sin_ang + sensor_offset_world_der[0]
+        Gx[:, 1, 2] = zr * cos_ang + sensor_offset_world_der[1]
+        Gx = Gx.reshape(-1, 3)
 
-            Gx[inds, :2] = I2  # TODO
-            Gx[inds, 2] = zj[0] * rot[:, 1] + sensor_offset_world_der  # TODO
+        # Gz = rotmat2d(zang) @ diag([1, zr]), shape (#newlandmarks, 2, 2)
+        Gz = np.empty((numLmk, 2, 2))
+        Gz[:, 0, 0] = cos_ang
+        Gz[:, 1, 0] = sin_ang
+        Gz[:, 0, 1] = -zr * sin_ang
+        Gz[:, 1, 1] = zr * cos_ang
 
-            Gz = rot @ np.diag([1, zj[0]])  # TODO
+        # Gz * R * Gz^T, measurement covariance from polar to cartesian coordinates
+        Rcart = Gz @ self.R @ Gz.transpose(0, 2, 1)
 
-            # TODO, Gz * R * Gz^T, transform measurement covariance from polar to cartesian coordinates
-            Rall[inds, inds] = Gz @ self.R @ Gz.T
+        return lmnew, Gx, Rcart
 
-        assert len(lmnew) % 2 == 0, "SLAM.add_landmark: lmnew not even length"
-        # TODO, append new landmarks to state vector
-        etaadded = np.append(eta, lmnew.flatten(), axis=0)
-        # TODO, block diagonal of P_new, see problem text in 1g) in graded assignment 3
-        Padded = la.block_diag(
-            P, Gx @ P[:3, :3] @ Gx.T + Rall)
-        Padded[n:, :n] = Gx @ P[:3, :]  # TODO, top right corner of P_new
-        # TODO, transpose of above. Should yield the same as calcualion, but this enforces symmetry and should be cheaper
-        Padded[:n, n:] = Padded[n:, :n].T
+    def append_landmarks(
+        self, eta: np.ndarray, P: np.ndarray, lmnew: np.ndarray, Gx: np.ndarray, Rcart: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Append new landmarks from init_landmarks to eta and P.
 
-        assert (
-            etaadded.shape * 2 == Padded.shape
-        ), "EKFSLAM.add_landmarks: calculated eta and P has wrong shape"
-        assert np.allclose(
-            Padded, Padded.T
-        ), "EKFSLAM.add_landmarks: Padded not symmetric"
-        assert np.all(
-            np.linalg.eigvals(Padded) >= 0
-        ), "EKFSLAM.add_landmarks: Padded not PSD"
+        Parameters
+        ----------
+        eta : np.ndarray, shape=(3 + 2*#landmarks,)
+            the robot state and map concatenated
+        P : np.ndarray, shape=(3 + 2*#landmarks,)*2
+            the covariance of eta
+        lmnew : np.ndarray, shape=(#newlandmarks, 2)
+            the new landmarks in world frame
+        Gx : np.ndarray, shape=(2 * #newlandmarks, 3)
+            the Jacobian of lmnew wrt. the robot state
+        Rcart : np.ndarray, shape=(#newlandmarks, 2, 2)
+            the measurement covariance of each new landmark in cartesian coordinates
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray], shapes=(3 + 2*(#landmarks + #newlandmarks,), (3 + 2*(#landmarks + #newlandmarks,)*2
+            eta with new landmarks appended, and its covariance
+        """
+        n = P.shape[0]
+        numLmk = lmnew.shape[0]
+
+        etaadded = np.append(eta, lmnew.ravel(), axis=0)
+
+        # New covariance, see problem text in 1g) in graded assignment 3:
+        # [[P,        P Gx^T],
+        #  [Gx P, Gx Pxx Gx^T + blkdiag(Gz R Gz^T)]]
+        # build it directly instead of going through the dense block_diag
+        Padded = np.empty((n + 2 * numLmk,) * 2)
+        Padded[:n, :n] = P
+        GxP = Gx @ P[:3, :]
+        Padded[n:, :n] = GxP
+        # transpose of above, this enforces symmetry and is cheaper
+        Padded[:n, n:] = GxP.T
+
+        Pnew = GxP[:, :3] @ Gx.T
+        # add the (2, 2) blocks on the diagonal, (j, :, j, :) is the jth block
+        lmk_idxs = np.arange(numLmk)
+        Pnew.reshape(numLmk, 2, numLmk, 2)[lmk_idxs, :, lmk_idxs] += Rcart
+        Padded[n:, n:] = Pnew
+
+        self.validation.check("EKFSLAM.add_landmarks", etaadded, Padded)
 
         return etaadded, Padded
 
+    def remove_landmarks(
+        self, eta: np.ndarray, P: np.ndarray, lmks: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Remove landmarks from eta and P, the remaining ones keep their order.
+
+        Parameters
+        ----------
+        eta : np.ndarray, shape=(3 + 2*#landmarks,)
+            the robot state and map concatenated
+        P : np.ndarray, shape=(3 + 2*#landmarks,)*2
+            the covariance of eta
+        lmks : np.ndarray, shape=(#removed,)
+            the indices of the landmarks to remove
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray], shapes=(3 + 2*(#landmarks - #removed),), (3 + 2*(#landmarks - #removed),)*2
+            the compacted eta and P
+        """
+        keep = np.ones(eta.shape[0], dtype=bool)
+        keep[3 + 2 * np.asarray(lmks, dtype=int)[:, None] + np.arange(2)] = False
+        keep = np.flatnonzero(keep)
+
+        # one gather of the kept rows and columns, O((3 + 2*#kept)^2)
+        etakept = eta[keep]
+        Pkept = P[np.ix_(keep, keep)]
+
+        self.validation.check("EKFSLAM.remove_landmarks", etakept, Pkept)
+
+        return etakept, Pkept
+
     def associate(
         self, z: np.ndarray, zpred: np.ndarray, H: np.ndarray, S: np.ndarray,
     ):  # -> Tuple[*((np.ndarray,) * 5)]:
@@ -394,36 +587,15 @@ class EKFSLAM:
 
         Note
         ----
-        See the associations are calculated  using JCBB. See this function for documentation
-        of the returned association and the association procedure.
+        The associations are calculated using self.associator, JCBB by default. See
+        association.py for documentation of the returned association and the backends.
+        If do_asso is False, nothing is associated.
         """
         if self.do_asso:
-            # Associate
-            a = JCBB(z, zpred, S, self.alphas[0], self.alphas[1])
-
-            # Extract associated measurements
-            zinds = np.empty_like(z, dtype=bool)
-            zinds[::2] = a > -1  # -1 means no association
-            zinds[1::2] = zinds[::2]
-            zass = z[zinds]
-
-            # extract and rearange predicted measurements and cov
-            zbarinds = np.empty_like(zass, dtype=int)
-            zbarinds[::2] = 2 * a[a > -1]
-            zbarinds[1::2] = 2 * a[a > -1] + 1
-
-            zpredass = zpred[zbarinds]
-            Sass = S[zbarinds][:, zbarinds]
-            Hass = H[zbarinds]
-
-            assert zpredass.shape == zass.shape
-            assert Sass.shape == zpredass.shape * 2
-            assert Hass.shape[0] == zpredass.shape[0]
-
-            return zass, zpredass, Hass, Sass, a
+            return self.associator.associate(z, zpred, H, S)
         else:
-            # should one do something her
-            pass
+            a = np.full(z.shape[0] // 2, -1, dtype=int)
+            return extract_associated(z, zpred, H, S, a)
 
     def update(
         self, eta: np.ndarray, P: np.ndarray, z: np.ndarray
@@ -456,10 +628,10 @@ class EKFSLAM:
             zpred = self.h(eta)  # TODO
             H = self.h_jac(eta)  # TODO
 
-            # Here you can use simply np.kron (a bit slow) to form the big (very big in VP after a while) R,
-            # or be smart with indexing and broadcasting (3d indexing into 2d mat) realizing you are adding the same R on all diagonals
-            R = np.kron(np.eye(numLmk), self.R)
-            S = H @ P @ H.T + R  # TODO,
+            # R is block diagonal with self.R on all the diagonals, so add it in place
+            # instead of forming the (very big in VP after a while) kron(I, self.R)
+            S = H @ P @ H.T
+            utils.add_block_diag(S, self.R)
             assert (
                 S.shape == zpred.shape * 2
             ), "EKFSLAM.update: wrong shape on either S or zpred"
@@ -478,30 +650,33 @@ class EKFSLAM:
                 v = za.ravel() - zpred  # za: 2D -> flat
                 v[1::2] = utils.wrapToPi(v[1::2])
 
-                # Kalman mean update
-                # Optional, used in places for S^-1, see scipy.linalg.cho_factor and scipy.linalg.cho_solve
-                S_cho_factors = la.cho_factor(Sa, lower=True)
-                S_inv = la.cho_solve(S_cho_factors, np.eye(Sa.shape[0]))
-                W = P @ Ha.T @ S_inv  # TODO, Kalman gain, can use S_cho_factors
-                etaupd = eta + W @ v  # TODO, Kalman update
-
-                # Kalman cov update: use Joseph form for stability
-                jo = -W @ Ha
-                # same as adding Identity mat
-                jo[np.diag_indices(jo.shape[0])] += 1
-                # TODO, Kalman update. This is the main workload on VP after speedups
-                R = np.kron(np.eye(za.size // 2), self.R)
-                Pupd = jo @ P @ jo.T + W @ R @ W.T
-
-                # calculate NIS, can use S_cho_factors
-                NIS = v.T @ S_inv @ v  # TODO
-
-                # When tested, remove for speed
-                assert np.allclose(
-                    Pupd, Pupd.T), "EKFSLAM.update: Pupd not symmetric"
-                assert np.all(
-                    np.linalg.eigvals(Pupd) > 0
-                ), "EKFSLAM.update: Pupd not positive definite"
+                # Kalman update using the Cholesky factor of S only through triangular solves:
+                # with S = L L^T and B = L^-1 Ha P, we have
+                # W v = B^T L^-1 v, W S W^T = B^T B and NIS = |L^-1 v|^2
+                S_chol = la.cholesky(Sa, lower=True)
+                HaP = Ha @ P
+                B = la.solve_triangular(S_chol, HaP, lower=True)
+                v_white = la.solve_triangular(S_chol, v, lower=True)
+                etaupd = eta + B.T @ v_white
+
+                # Kalman cov update P - W S W^T as a rank 2m symmetric downdate, O(n^2 m).
+                # B.T @ B is evaluated as a symmetric rank-k product, so Pupd stays symmetric
+                Pupd = P - B.T @ B
+
+                NIS = v_white @ v_white
+
+                if self.joseph_form:
+                    # Joseph form for validation, (I - WH) P (I - WH)^T + W R W^T
+                    W = la.solve_triangular(S_chol, B, lower=True, trans='T').T
+                    jo = -W @ Ha
+                    # same as adding Identity mat
+                    jo[np.diag_indices(jo.shape[0])] += 1
+                    Pupd_joseph = jo @ P @ jo.T + \
+                        utils.matmul_block_diag(W, self.R) @ W.T
+                    if not np.allclose(Pupd, Pupd_joseph):
+                        self.validation.report(
+                            "EKFSLAM.update", "Pupd does not match Joseph form")
+                    Pupd = Pupd_joseph
 
         else:  # All measurements are new landmarks,
             a = np.full(z.shape[0], -1)
@@ -521,10 +696,7 @@ class EKFSLAM:
                 # TODO, add new landmarks.
                 etaupd, Pupd = self.add_landmarks(etaupd, Pupd, z_new)
 
-        assert np.allclose(
-            Pupd, Pupd.T), "EKFSLAM.update: Pupd must be symmetric"
-        assert np.all(np.linalg.eigvals(Pupd) >=
-                      0), "EKFSLAM.update: Pupd must be PSD"
+        self.validation.check("EKFSLAM.update", etaupd, Pupd)
 
         return etaupd, Pupd, NIS, a
 
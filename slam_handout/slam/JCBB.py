@@ -1,3 +1,6 @@
+from dataclasses import dataclass
+import threading
+import time
 import numpy as np
 from functools import lru_cache
 from scipy.stats import chi2
@@ -6,96 +9,523 @@ import utils
 
 chi2isf_cached = lru_cache(maxsize=None)(chi2.isf)
 
+@dataclass
+class JCBBStats:
+    """Search statistics of one JCBB call."""
+
+    nodes: int = 0  # nodes expanded
+    pruned_joint: int = 0  # branches cut because they were not jointly compatible
+    pruned_bound: int = 0  # branches cut because they could not beat the best hypothesis
+    leaves: int = 0  # complete hypotheses evaluated
+    max_depth: int = 0
+    truncated: bool = False  # the budget ran out before the search was complete
+    time: float = 0.0
+
+
 # TODO: make sure a is 0-indexed
-def JCBB(z, zbar, S, alpha1, alpha2):
+def JCBB(z, zbar, S, alpha1, alpha2, max_nodes=None, max_time=None, stats=None, prune_ties=True):
+    """Joint compatibility branch and bound.
+
+    The search is iterative with an explicit stack. If max_nodes or max_time (in seconds) is
+    given, the search stops when the budget runs out and returns the best hypothesis found
+    so far. If stats is given, it is filled with the search statistics.
+
+    With prune_ties, branches that can at most tie the number of associations of the best
+    hypothesis are pruned, so which of the tied hypotheses is found depends on the search
+    order. Without it, the hypothesis with the most associations and then the lowest joint
+    NIS is found regardless of search order, at the cost of a larger search, see JCBBparallel.
+    """
     assert len(z.shape) == 1, "z must be in one row in JCBB"
     assert z.shape[0] % 2 == 0, "z must be equal in x and y"
     m = z.shape[0] // 2
 
-    a = np.full(m, -1, dtype=int)
     abest = np.full(m, -1, dtype=int)
 
-    # ic has measurements rowwise and predicted measurements columnwise
-    ic = individualCompatibility(z, zbar, S)
     g2 = chi2.isf(alpha2, 2)
-    order = np.argsort(np.amin(ic, axis=1))
-    j = 0
-    z_order = np.empty(2 * len(order), dtype=int)
-    z_order[::2] = 2 * order
-    z_order[1::2] = 2 * order + 1
-    zo = z[z_order]
-
-    ico = ic[order]
+    cand = individualCandidates(z, zbar, S, g2)
+    order = np.argsort(cand.nis_min)
 
-    abesto = JCBBrec(zo, zbar, S, alpha1, g2, j, a, ico, abest)
+    abesto, _ = JCBBsearch(z, zbar, S, alpha1, cand, order,
+                           max_nodes, max_time, stats, prune_ties)
 
     abest[order] = abesto
 
     return abest
 
 
-def JCBBrec(z, zbar, S, alpha1, g2, j, a, ic, abest):
-    m = z.shape[0] // 2
-    assert isinstance(m, int), "m in JCBBrec must be int"
-    n = num_associations(a)
+def JCBBsearch(
+    z, zbar, S, alpha1, cand, order, max_nodes=None, max_time=None, stats=None,
+    prune_ties=True, prefix=None, shared_bound=None
+):
+    """Depth first branch and bound over the measurements in order, see JCBB.
 
-    if j >= m:  # end of recursion
-        if n > num_associations(abest) or (
-            (n >= num_associations(abest))
-            and (NIS(z, zbar, S, a) < NIS(z, zbar, S, abest))
+    Node j of the search tree decides the association of measurement order[j], and the
+    returned association is indexed the same way. The candidates of a node are the
+    individually compatible landmarks not used higher up in the tree, tried in order of
+    increasing individual NIS, followed by leaving the measurement unassociated.
+
+    If prefix is given, only the subtree below the associations prefix of the first
+    len(prefix) measurements is searched. shared_bound is the number of associations of the
+    best hypothesis found by any other search (with .value and .get_lock() like a
+    multiprocessing.Value), it is read for pruning and raised when a better one is found.
+
+    Returns the best association and its joint NIS.
+    """
+    m = order.shape[0]
+    nzbar = cand.num_landmarks
+    # at most tie (prune_ties) or not even tie the best number of associations
+    slack = 2 if prune_ties else 1
+
+    if stats is None:
+        stats = JCBBStats()
+    t_start = time.perf_counter()
+
+    # preallocated search state, a[j:] == -1 at node j
+    a = np.full(m, -1, dtype=int)
+    abest = np.full(m, -1, dtype=int)
+    nbest = 0
+    nisbest = np.inf
+    used = np.zeros(nzbar, dtype=bool)
+    # candidates of the node at each depth, and where we are in them
+    cands = np.empty((m, cand.max_row_length()), dtype=int)
+    num_cands = np.zeros(m + 1, dtype=int)
+    cand_pos = np.zeros(m + 1, dtype=int)
+    # number of associations in a[:j]
+    num_ass = np.zeros(m + 1, dtype=int)
+    # joint NIS of the associations along the search path
+    joint_nis = IncrementalNIS(z, zbar, S, min(m, nzbar))
+
+    def enter(j):
+        # expand node j
+        stats.nodes += 1
+        stats.max_depth = max(stats.max_depth, j)
+        cand_pos[j] = 0
+        if j < m:
+            landmarks, _ = cand.row(order[j])
+            usable = landmarks[~used[landmarks]]
+            num_cands[j] = usable.size
+            cands[j, :usable.size] = usable
+
+    depth0 = 0
+    if prefix is not None:
+        depth0 = len(prefix)
+        for j, i in enumerate(prefix):
+            num_ass[j + 1] = num_ass[j]
+            if i > -1:
+                joint_nis.try_push(order[j], i)
+                joint_nis.commit()
+                used[i] = True
+                a[j] = i
+                num_ass[j + 1] += 1
+
+    j = depth0
+    enter(j)
+    while j >= depth0:
+        if (max_nodes is not None and stats.nodes >= max_nodes) or (
+            max_time is not None and time.perf_counter() - t_start >= max_time
         ):
-            abest = a
-        # else abest = previous abest from the input
-    else:  # still at least one measurement to associate
-        I = np.argsort(ic[j, ic[j, :] < g2])
-        # allinds = np.array(range(ic.shape[1]), dtype=int)
-        usableinds = np.where(ic[j, :] < g2)[0]  # allinds[ic[j, :] < g2]
-        # if np.any(np.where(ic[j, :] < g2)[0] != usableinds):
-        #     raise ValueError
-
-        for i in usableinds[I]:
+            stats.truncated = True
+            break
+
+        n = num_ass[j]
+        pos = cand_pos[j]
+        if j >= m:  # complete hypothesis
+            stats.leaves += 1
+            if n >= nbest:
+                nis = joint_nis.nis if n > 0 else np.inf
+                if n > nbest or nis < nisbest:
+                    abest[:] = a
+                    nbest = n
+                    nisbest = nis
+                    if shared_bound is not None and n > shared_bound.value:
+                        with shared_bound.get_lock():
+                            shared_bound.value = max(shared_bound.value, n)
+        elif pos < num_cands[j]:  # associate measurement j with the next candidate
+            cand_pos[j] += 1
+            i = cands[j, pos]
             a[j] = i
             # jointly compatible?
-            if NIS(z, zbar, S, a) < chi2isf_cached(alpha1, 2 * (n + 1)):
-                # We need to decouple ici from ic, so copy is required
-                ici = ic[j:, i].copy()
-                ic[j:, i] = np.Inf  # landmark not available any more.
+            if joint_nis.try_push(order[j], i) < chi2isf_cached(alpha1, 2 * (n + 1)):
+                joint_nis.commit()
+                used[i] = True  # landmark not available any more.
+                num_ass[j + 1] = n + 1
+                j += 1
+                enter(j)
+            else:
+                stats.pruned_joint += 1
+                a[j] = -1
+            continue
+        elif pos == num_cands[j]:  # leave measurement j unassociated
+            cand_pos[j] += 1
+            a[j] = -1
+            bound = nbest if shared_bound is None else max(nbest, shared_bound.value)
+            if n + (m - j - slack) >= bound:
+                num_ass[j + 1] = n
+                j += 1
+                enter(j)
+            else:
+                stats.pruned_bound += 1
+            continue
+
+        # node j is done, backtrack and make its landmark available again
+        j -= 1
+        if j >= depth0 and a[j] > -1:
+            used[a[j]] = False
+            a[j] = -1
+            joint_nis.pop()
+
+    stats.time = time.perf_counter() - t_start
+    return abest, nisbest
+
+
+class SharedBound:
+    """Thread shared number of associations, with the interface of multiprocessing.Value."""
+
+    def __init__(self, value=0):
+        self.value = value
+        self._lock = threading.Lock()
+
+    def get_lock(self):
+        return self._lock
+
+
+# the shared bound of a process pool worker, set by JCBBpool_init
+_pool_shared_bound = None
+
+
+def JCBBpool_init(shared_bound):
+    global _pool_shared_bound
+    _pool_shared_bound = shared_bound
+
+
+def JCBBbranch(z, zbar, S, alpha1, cand, order, prefix, max_nodes, max_time, shared_bound=None):
+    """Search the subtree below prefix in exact (prune_ties=False) mode, see JCBBparallel."""
+    if shared_bound is None:
+        shared_bound = _pool_shared_bound
+    stats = JCBBStats()
+    abest, nisbest = JCBBsearch(
+        z, zbar, S, alpha1, cand, order, max_nodes, max_time, stats,
+        prune_ties=False, prefix=prefix, shared_bound=shared_bound
+    )
+    return abest, nisbest, stats
+
+
+def JCBBfrontier(z, zbar, S, alpha1, cand, order, min_branches):
+    """Expand the top levels of the search tree until there are at least min_branches.
+
+    Returns the association prefixes of the branches in depth first search order. Only
+    joint compatibility is used for pruning here, as there is no best hypothesis yet.
+    """
+    m = order.shape[0]
+    frontier = [[]]
+    depth = 0
+    while len(frontier) < min_branches and depth < m:
+        expanded = []
+        for prefix in frontier:
+            joint_nis = IncrementalNIS(z, zbar, S, depth + 1)
+            for j, i in enumerate(prefix):
+                if i > -1:
+                    joint_nis.try_push(order[j], i)
+                    joint_nis.commit()
+            gate = chi2isf_cached(alpha1, 2 * (joint_nis.k + 1))
+
+            landmarks, _ = cand.row(order[depth])
+            for i in landmarks:
+                if i not in prefix and joint_nis.try_push(order[depth], i) < gate:
+                    expanded.append(prefix + [i])
+            expanded.append(prefix + [-1])
+        frontier = expanded
+        depth += 1
+
+    return frontier
+
+
+def JCBBparallel(
+    z, zbar, S, alpha1, alpha2, executor, shared_bound, num_workers,
+    min_measurements=15, branches_per_worker=4, max_nodes=None, max_time=None, stats=None
+):
+    """JCBB with the top-level branches of the search tree searched concurrently.
+
+    The branches are searched in exact mode (prune_ties=False) and pruned against the
+    number of associations of the best hypothesis found in any branch through
+    shared_bound. The branch results are merged in depth first order with the same rule as
+    the serial search, so the result is the same as JCBB(..., prune_ties=False). Problems
+    with fewer than min_measurements measurements are searched serially.
+
+    executor is a concurrent.futures executor. For a process pool, shared_bound must be the
+    multiprocessing.Value given to JCBBpool_init as pool initializer, for a thread pool a
+    SharedBound. With max_nodes or max_time the budget is per branch, and the result is no
+    longer guaranteed to be the same as the serial search.
+    """
+    assert len(z.shape) == 1, "z must be in one row in JCBB"
+    assert z.shape[0] % 2 == 0, "z must be equal in x and y"
+    m = z.shape[0] // 2
 
-                # Needs to explicitly copy a for recursion to work
-                abest = JCBBrec(z, zbar, S, alpha1, g2, j + 1, a.copy(), ic, abest)
-                ic[j:, i] = ici  # set landmark available again for next round.
+    if m < min_measurements or num_workers < 2:
+        return JCBB(z, zbar, S, alpha1, alpha2, max_nodes, max_time, stats, prune_ties=False)
 
-        if n + (m - j - 2) >= num_associations(abest):
-            a[j] = -1
-            abest = JCBBrec(z, zbar, S, alpha1, g2, j + 1, a, ic, abest)
+    if stats is None:
+        stats = JCBBStats()
+    t_start = time.perf_counter()
 
+    g2 = chi2.isf(alpha2, 2)
+    cand = individualCandidates(z, zbar, S, g2)
+    order = np.argsort(cand.nis_min)
+
+    # only the landmarks that are candidates are needed in the workers
+    lmks, cand_lmks = np.unique(cand.landmarks, return_inverse=True)
+    Sinds = np.empty(2 * lmks.size, dtype=int)
+    Sinds[::2] = 2 * lmks
+    Sinds[1::2] = 2 * lmks + 1
+    zbar_sub = zbar[Sinds]
+    S_sub = S[Sinds[:, None], Sinds]
+    cand_sub = IndividualCandidates(
+        cand.offsets, cand_lmks.ravel(), cand.nis, cand.nis_min, lmks.size)
+
+    frontier = JCBBfrontier(z, zbar_sub, S_sub, alpha1, cand_sub, order,
+                            branches_per_worker * num_workers)
+
+    with shared_bound.get_lock():
+        shared_bound.value = 0
+    is_thread_pool = isinstance(shared_bound, SharedBound)
+    futures = [
+        executor.submit(
+            JCBBbranch, z, zbar_sub, S_sub, alpha1, cand_sub, order, prefix,
+            max_nodes, max_time, shared_bound if is_thread_pool else None
+        )
+        for prefix in frontier
+    ]
+
+    # merge in depth first order, the same rule as at the leaves of the serial search
+    abesto = np.full(m, -1, dtype=int)
+    nbest = 0
+    nisbest = np.inf
+    for future in futures:
+        a, nis, branch_stats = future.result()
+        n = num_associations(a)
+        if n > nbest or (n == nbest and nis < nisbest):
+            abesto = a
+            nbest = n
+            nisbest = nis
+
+        stats.nodes += branch_stats.nodes
+        stats.pruned_joint += branch_stats.pruned_joint
+        stats.pruned_bound += branch_stats.pruned_bound
+        stats.leaves += branch_stats.leaves
+        stats.max_depth = max(stats.max_depth, branch_stats.max_depth)
+        stats.truncated |= branch_stats.truncated
+
+    abest = np.full(m, -1, dtype=int)
+    abest[order] = np.where(abesto > -1, lmks[np.maximum(abesto, 0)], -1)
+
+    stats.time = time.perf_counter() - t_start
     return abest
 
 
-#   @profilehooks.profile(sort="cumulative")
+class IncrementalNIS:
+    """Joint NIS of a growing set of associations, using Cholesky updates.
+
+    The Cholesky factor L of the joint innovation covariance and the whitened innovation
+    y = L^-1 v are kept for the current k associations, so NIS = |y|^2. Adding an
+    association extends L by a 2-row block in O(k^2), and pop drops the last one.
+    """
+
+    def __init__(self, z, zbar, S, max_associations):
+        self.z = z
+        self.zbar = zbar
+        self.S = S
+        self.k = 0
+        size = 2 * max_associations
+        self.L = np.zeros((size, size))
+        self.y = np.zeros(size)
+        # indices into zbar and S of the associated landmarks
+        self.inds = np.empty(size, dtype=int)
+        # NIS for each number of associations along the path
+        self.nises = np.zeros(max_associations + 1)
+
+    @property
+    def nis(self):
+        return self.nises[self.k]
+
+    def try_push(self, j, i):
+        """Calculate the joint NIS with measurement j associated to landmark i added.
+
+        The new block is stored in the buffers, but only kept if commit is called.
+        Returns inf if the joint innovation covariance is not positive definite.
+        """
+        k2 = 2 * self.k
+        ii = slice(2 * i, 2 * i + 2)
+        S_i = self.S[ii, ii]
+
+        v = self.z[2 * j:2 * j + 2] - self.zbar[ii]
+        v[1] = utils.wrapToPi(v[1])
+
+        if k2 > 0:
+            # L21 = (L11^-1 S12)^T, S22 - L21 L21^T is the Schur complement
+            L11 = self.L[:k2, :k2]
+            L21 = la.solve_triangular(
+                L11, self.S[self.inds[:k2], ii], lower=True, check_finite=False).T
+            Schur = S_i - L21 @ L21.T
+            v = v - L21 @ self.y[:k2]
+            self.L[k2:k2 + 2, :k2] = L21
+        else:
+            Schur = S_i
+
+        # closed form 2x2 Cholesky and forward substitution
+        l00 = Schur[0, 0]
+        if l00 <= 0:
+            return np.inf
+        l00 = np.sqrt(l00)
+        l10 = Schur[1, 0] / l00
+        l11 = Schur[1, 1] - l10 ** 2
+        if l11 <= 0:
+            return np.inf
+        l11 = np.sqrt(l11)
+
+        y0 = v[0] / l00
+        y1 = (v[1] - l10 * y0) / l11
+
+        self.L[k2, k2] = l00
+        self.L[k2 + 1, k2] = l10
+        self.L[k2, k2 + 1] = 0
+        self.L[k2 + 1, k2 + 1] = l11
+        self.y[k2] = y0
+        self.y[k2 + 1] = y1
+        self.inds[k2] = 2 * i
+        self.inds[k2 + 1] = 2 * i + 1
+
+        nis = self.nises[self.k] + y0 ** 2 + y1 ** 2
+        self.nises[self.k + 1] = nis
+        return nis
+
+    def commit(self):
+        self.k += 1
+
+    def pop(self):
+        self.k -= 1
+
+
+@dataclass
+class IndividualCandidates:
+    """Individually compatible measurement-landmark pairs, in a compressed row layout.
+
+    The candidates of measurement j are landmarks[offsets[j]:offsets[j + 1]], with their
+    individual NIS in the same slice of nis, sorted by increasing NIS.
+    """
+
+    offsets: np.ndarray  # shape=(#measurements + 1,)
+    landmarks: np.ndarray  # shape=(#pairs,)
+    nis: np.ndarray  # shape=(#pairs,)
+    # smallest individual NIS of each measurement over the pairs in the gate box, also
+    # when outside the gate, inf when no landmark is in the box, see individualCandidates
+    nis_min: np.ndarray  # shape=(#measurements,)
+    num_landmarks: int
+
+    def row(self, j):
+        inds = slice(self.offsets[j], self.offsets[j + 1])
+        return self.landmarks[inds], self.nis[inds]
+
+    def measurements(self):
+        """The measurement of each pair, shape=(#pairs,)."""
+        return np.repeat(np.arange(self.offsets.shape[0] - 1), np.diff(self.offsets))
+
+    def max_row_length(self):
+        return np.diff(self.offsets).max(initial=0)
+
+
+def individualCandidates(z, zbar, S, g2):
+    """The measurement-landmark pairs with individual NIS below the gate g2.
+
+    The dense (#measurements, #landmarks) NIS matrix is never formed. A pair can only be
+    inside the gate if its range and bearing innovations are within sqrt(g2 S_rr) and
+    sqrt(g2 S_bb) of the landmark, the extent of the gate ellipse along each axis. The
+    landmarks are sorted by predicted range, each measurement looks up the ones within
+    the largest range extent of any landmark, and the NIS is only computed for the pairs
+    inside the box. The cost is O((#measurements + #landmarks) log #landmarks) plus the
+    number of pairs in the range windows.
+
+    nis_min is the smallest individual NIS of each measurement over the pairs in the box,
+    which is the smallest over all landmarks when the measurement has candidates.
+    """
+    assert z.shape[0] % 2 == 0, "JCBB.individualCandidates: z must have even lenght"
+    assert zbar.shape[0] % 2 == 0, "JCBB.individualCandidates: zbar must have even length"
+    zr = z.reshape(-1, 2)
+    zbarr = zbar.reshape(-1, 2)
+    nz = zr.shape[0]
+    nzbar = zbarr.shape[0]
+    Sinv00, Sinv01, Sinv11 = individualInverses(S)
+
+    # gate extents per landmark, slightly widened so the box never cuts the gate
+    width_r = np.sqrt(g2 * S.diagonal()[::2]) * (1 + 1e-9)
+    width_b = np.sqrt(g2 * S.diagonal()[1::2]) * (1 + 1e-9)
+
+    # the landmarks within the largest range extent of each measurement
+    by_range = np.argsort(zbarr[:, 0], kind="stable")
+    ranges = zbarr[by_range, 0]
+    width_max = width_r.max(initial=0)
+    lo = np.searchsorted(ranges, zr[:, 0] - width_max, side="left")
+    hi = np.searchsorted(ranges, zr[:, 0] + width_max, side="right")
+    counts = hi - lo
+    meas = np.repeat(np.arange(nz), counts)
+    starts = np.cumsum(counts) - counts
+    lmks = by_range[np.arange(meas.shape[0]) - np.repeat(starts - lo, counts)]
+
+    v_r = zr[meas, 0] - zbarr[lmks, 0]
+    v_b = utils.wrapToPi(zr[meas, 1] - zbarr[lmks, 1])
+    box = (np.abs(v_r) <= width_r[lmks]) & (np.abs(v_b) <= width_b[lmks])
+    meas, lmks, v_r, v_b = meas[box], lmks[box], v_r[box], v_b[box]
+
+    nis = (Sinv00[lmks] * v_r + 2 * Sinv01[lmks] * v_b) * v_r + Sinv11[lmks] * v_b * v_b
+    nis_min = np.full(nz, np.inf)
+    np.minimum.at(nis_min, meas, nis)
+
+    gated = nis < g2
+    meas, lmks, nis = meas[gated], lmks[gated], nis[gated]
+    # by measurement, then NIS, then landmark index for ties
+    sort = np.lexsort((lmks, nis, meas))
+
+    offsets = np.zeros(nz + 1, dtype=int)
+    np.cumsum(np.bincount(meas, minlength=nz), out=offsets[1:])
+
+    return IndividualCandidates(offsets, lmks[sort], nis[sort], nis_min, nzbar)
+
+
+def individualInverses(S):
+    """Closed form inverse of the (2, 2) blocks on the diagonal of S, one per landmark.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray], shapes=(#landmarks,)*3
+        the (0, 0), (0, 1) and (1, 1) elements of the inverses
+    """
+    Sdiag = S.diagonal()
+    s00 = Sdiag[::2]
+    s11 = Sdiag[1::2]
+    s01 = S.diagonal(1)[::2]
+    det = s00 * s11 - s01 * s01
+    return s11 / det, -s01 / det, s00 / det
+
+
 def individualCompatibility(z, zbar, S):
-    nz = z.shape[0] // 2
-    nz_bar = zbar.shape[0] // 2
+    """Individual NIS of all measurement-landmark pairs, shape=(#measurements, #landmarks).
 
+    This is the dense O(#measurements #landmarks) computation, the associators use the
+    gated individualCandidates instead.
+    """
     assert z.shape[0] % 2 == 0, "JCBB.individualCompatibility: z must have even lenght"
     assert (
         zbar.shape[0] % 2 == 0
     ), "JCBB.individualCompatibility: zbar must have even length"
 
-    # all innovations from broadcasting
-    # extra trailing dimension to avoid problems in solve when z has 2 landmarks
-    v_all = z.reshape(-1, 1, 2, 1) - zbar.reshape(1, -1, 2, 1)
+    zr = z.reshape(-1, 2)
+    zbarr = zbar.reshape(-1, 2)
+    Sinv00, Sinv01, Sinv11 = individualInverses(S)
 
-    # get the (2, 2) blocks on the diagonal to make the (nz_bar, 2, 2) array of individual S
-    # first idxs get to the start of lmk, second is along the lmk axis
-    idxs = np.arange(nz_bar)[:, None] * 2 + np.arange(2)[None]
-    # broadcast lmk axis to two dimesions
-    S_all = S[idxs[..., None], idxs[:, None]]
+    # all innovations from broadcasting, measurements rowwise and landmarks columnwise
+    v_r = zr[:, 0, None] - zbarr[None, :, 0]
+    v_b = utils.wrapToPi(zr[:, 1, None] - zbarr[None, :, 1])
 
-    # broadcast S_all over the measurements by adding leading 1 size axis to match v_all
-    # solve nz by nz_bar systems
-    # sum over axis 3 to get rid of trailing dim (faster than squeeze?)
-    ic = (v_all * np.linalg.solve(S_all[None], v_all)).sum(axis=(2, 3))
+    ic = (Sinv00 * v_r + 2 * Sinv01 * v_b) * v_r + Sinv11 * v_b * v_b
     return ic
 
 
@@ -0,0 +1,348 @@
+from typing import List, Optional, Tuple
+import numpy as np
+from dataclasses import dataclass, field
+import scipy.linalg as la
+import scipy.sparse as sparse
+import scipy.sparse.linalg as spla
+from EKFSLAM import EKFSLAM
+import utils
+
+
+@dataclass
+class InformationState:
+    """The information form of the SLAM state, used by SEIFSLAM in place of P.
+
+    Omega is the information matrix (inverse covariance) and xi the information vector, so
+    that Omega @ eta = xi at convergence. active are the landmarks linked to the robot in
+    Omega, the least recently observed first.
+    """
+
+    Omega: sparse.lil_matrix
+    xi: np.ndarray
+    active: List[int] = field(default_factory=list)
+    num_updates: int = 0
+
+    @property
+    def shape(self) -> Tuple[int, int]:
+        return self.Omega.shape
+
+
+@dataclass
+class SEIFSLAM(EKFSLAM):
+    """Sparse extended information filter (SEIF) SLAM, see Thrun et al., Probabilistic Robotics ch. 12.
+
+    Uses the motion and measurement models of EKFSLAM, with the state kept as an
+    InformationState instead of a dense covariance. The number of landmarks linked to the
+    robot is kept at most max_active by sparsification, so predict and update only touch
+    the robot and the active landmarks. The mean is kept up to date by relaxation over the
+    robot and the active landmarks, and solved for exactly every recover_every update.
+    Covariances are only recovered where they are needed: the robot and the landmarks within
+    sensor_range for association, conditioned on their Markov blanket.
+
+    predict and update take and return (eta, info) in place of (eta, P), start with
+    info = slam.init_information(eta, P).
+    """
+
+    max_active: int = 20
+    sensor_range: float = 80.0
+    relax_iterations: int = 2
+    # exact mean recovery every this many updates, never if None
+    recover_every: Optional[int] = 50
+    # added to the variances of the initial state, as P is usually 0 there
+    prior_var: float = 1e-8
+
+    def init_information(self, eta: np.ndarray, P: np.ndarray) -> InformationState:
+        """The information form of eta and P, all the landmarks in P are active."""
+        n = eta.shape[0]
+        Omega = la.inv(P + self.prior_var * np.eye(n))
+        Omega = (Omega + Omega.T) / 2
+        info = InformationState(
+            sparse.lil_matrix(Omega), Omega @ eta, list(range((n - 3) // 2)))
+        self.sparsify(eta, info)
+        return info
+
+    @staticmethod
+    def state_inds(lmks: np.ndarray, robot: bool = True) -> np.ndarray:
+        """The state indices of the landmarks lmks, with the robot first if robot."""
+        inds = (3 + 2 * np.asarray(lmks, dtype=int)[:, None] + np.arange(2)).ravel()
+        if robot:
+            inds = np.concatenate((np.arange(3), inds))
+        return inds
+
+    def predict(
+        self, eta: np.ndarray, info: InformationState, z_odo: np.ndarray
+    ) -> Tuple[np.ndarray, InformationState]:
+        """Predict the robot state using the odometry z_odo, O(#active^2).
+
+        Parameters
+        ----------
+        eta : np.ndarray, shape=(3 + 2*#landmarks,)
+            the robot state and map concatenated
+        info : InformationState
+            the information form of the state
+        z_odo : np.ndarray, shape=(3,)
+            the measured odometry
+
+        Returns
+        -------
+        Tuple[np.ndarray, InformationState]
+            predicted mean and information, the same objects as the input.
+        """
+        x = eta[:3]
+        Fx = self.Fx(x, z_odo)
+        Fu = self.Fu(x, z_odo)
+        xpred = self.f(x, z_odo)
+        self.predict_robot(eta, info, xpred, Fx, Fu @ self.Q @ Fu.T)
+        return eta, info
+
+    def predict_batch(
+        self, eta: np.ndarray, info: InformationState, z_odos: np.ndarray
+    ) -> Tuple[np.ndarray, InformationState]:
+        """Predict with several odometry increments, see EKFSLAM.predict_batch."""
+        xpred, F, Qc = self.compose_odometry(eta[:3], z_odos)
+        self.predict_robot(eta, info, xpred, F, Qc)
+        return eta, info
+
+    def predict_robot(
+        self, eta: np.ndarray, info: InformationState, xpred: np.ndarray, F: np.ndarray,
+        Qc: np.ndarray
+    ):
+        """Set the predicted robot state in eta and propagate info in place.
+
+        Omega' = (Fb Omega^-1 Fb^T + E Qc E^T)^-1 with Fb = blkdiag(F, I), evaluated with the
+        matrix inversion lemma. Only the robot and active rows and columns are changed.
+        """
+        L = self.state_inds(info.active)
+        OmL = info.Omega[np.ix_(L, L)].toarray()
+
+        # Fb^-T Omega Fb^-1
+        Finv = la.inv(F)
+        Ob = OmL.copy()
+        Ob[:, :3] = Ob[:, :3] @ Finv
+        Ob[:3, :] = Finv.T @ Ob[:3, :]
+
+        # Ob - Ob E (Qc^-1 + Ob_xx)^-1 E^T Ob, without inverting Qc
+        M = la.solve(np.eye(3) + Qc @ Ob[:3, :3], Qc)
+        OmLpred = Ob - Ob[:, :3] @ M @ Ob[:3, :]
+        OmLpred = (OmLpred + OmLpred.T) / 2
+
+        # xi' = xi + (Omega' - Omega) mu + Omega' E (xpred - x)
+        info.xi[L] += (OmLpred - OmL) @ eta[L] + OmLpred[:, :3] @ (xpred - eta[:3])
+        info.Omega[np.ix_(L, L)] = OmLpred
+        eta[:3] = xpred
+
+    def local_covariance(self, info: InformationState, inds: np.ndarray) -> np.ndarray:
+        """Approximate covariance of the states inds, conditioned on their Markov blanket.
+
+        The information matrix is inverted over inds and the landmarks linked to them.
+        """
+        neighbours = info.Omega[inds, :].nonzero()[1]
+        lmks = np.unique((neighbours[neighbours >= 3] - 3) // 2)
+        blanket = self.state_inds(lmks)
+
+        OmB = info.Omega[np.ix_(blanket, blanket)].toarray()
+        PB = la.cho_solve(la.cho_factor(OmB, lower=True), np.eye(blanket.shape[0]))
+
+        pos = np.searchsorted(blanket, inds)
+        return PB[np.ix_(pos, pos)]
+
+    def marginal_covariance(self, info: InformationState, inds: np.ndarray) -> np.ndarray:
+        """Exact covariance of the states inds, with a sparse factorization of Omega."""
+        lu = spla.splu(info.Omega.tocsc())
+        E = np.zeros((info.shape[0], len(inds)))
+        E[inds, np.arange(len(inds))] = 1
+        return lu.solve(E)[inds]
+
+    def covariance(self, info: InformationState) -> np.ndarray:
+        """The full covariance, O(n^3) so only for evaluation of small maps."""
+        return self.marginal_covariance(info, np.arange(info.shape[0]))
+
+    def recover_mean(self, info: InformationState) -> np.ndarray:
+        """Solve Omega eta = xi for the mean, with a sparse factorization of Omega."""
+        return spla.spsolve(info.Omega.tocsc(), info.xi)
+
+    def relax(self, eta: np.ndarray, info: InformationState, lmks: np.ndarray):
+        """Gauss-Seidel sweeps of Omega eta = xi over the robot and the landmarks lmks, in place."""
+        blocks = [np.arange(3)] + [self.state_inds([l], robot=False) for l in lmks]
+        for _ in range(self.relax_iterations):
+            for b in blocks:
+                rows = info.Omega[b, :].tocsr()
+                Obb = rows[:, b].toarray()
+                r = info.xi[b] - rows @ eta + Obb @ eta[b]
+                eta[b] = la.solve(Obb, r, assume_a="pos")
+
+    def sparsify(self, eta: np.ndarray, info: InformationState):
+        """Remove the robot links of the least recently observed landmarks beyond max_active.
+
+        Omega~ = Omega1 - Omega2 + Omega3, where Omega1 marginalizes out the deactivated
+        landmarks m0, Omega2 the robot and m0 of the robot, active and m0 part of Omega,
+        and Omega3 marginalizes out the robot of all of Omega. Only the robot, active and m0
+        rows and columns change.
+        """
+        num_deactivate = len(info.active) - self.max_active
+        if num_deactivate <= 0:
+            return
+
+        m0 = info.active[:num_deactivate]
+        info.active = info.active[num_deactivate:]
+
+        L = np.concatenate((self.state_inds(info.active), self.state_inds(m0, robot=False)))
+        nL = L.shape[0]
+        x_loc = np.arange(3)
+        m0_loc = np.arange(nL - 2 * len(m0), nL)
+
+        Om0 = info.Omega[np.ix_(L, L)].toarray()
+        Om1 = marginalize(Om0, m0_loc)
+        Om2 = marginalize(Om0, np.concatenate((x_loc, m0_loc)))
+        Om3 = marginalize(Om0, x_loc)
+        OmSparse = Om1 - Om2 + Om3
+        OmSparse = (OmSparse + OmSparse.T) / 2
+        # these are zero up to rounding, make it exact so they are not stored
+        OmSparse[np.ix_(x_loc, m0_loc)] = 0
+        OmSparse[np.ix_(m0_loc, x_loc)] = 0
+
+        info.xi[L] += (OmSparse - Om0) @ eta[L]
+        info.Omega[np.ix_(L, L)] = OmSparse
+
+    def update(
+        self, eta: np.ndarray, info: InformationState, z: np.ndarray
+    ) -> Tuple[np.ndarray, InformationState, float, np.ndarray]:
+        """Update eta and info with z, associating landmarks and adding new ones.
+
+        Parameters
+        ----------
+        eta : np.ndarray, shape=(3 + 2*#landmarks,)
+            the robot state and map concatenated
+        info : InformationState
+            the information form of the state, updated in place
+        z : np.ndarray, shape=(#detections, 2)
+            the measurements
+
+        Returns
+        -------
+        Tuple[np.ndarray, InformationState, float, np.ndarray]
+            the updated mean and information, the NIS and the associations,
+            a[j] is the landmark measurement j is associated with, -1 means no association.
+        """
+        eta = eta.copy()
+        z = z.ravel()
+        a = np.full(z.shape[0] // 2, -1, dtype=int)
+        NIS = 1  # TODO: beware this one when analysing consistency.
+        observed = np.zeros(0, dtype=int)
+
+        # only the landmarks within the sensor range can be associated
+        lmks = eta[3:].reshape(-1, 2)
+        dist2 = ((lmks - eta[:2]) ** 2).sum(axis=1)
+        local = np.flatnonzero(dist2 <= self.sensor_range ** 2)
+
+        if local.shape[0] > 0:
+            L = self.state_inds(local)
+            PL = self.local_covariance(info, L)
+            etaL = eta[L]
+
+            zpred = self.h(etaL)
+            H = self.h_jac(etaL)
+            S = H @ PL @ H.T
+            utils.add_block_diag(S, self.R)
+
+            za, zpred, Ha, Sa, a_local = self.associate(z, zpred, H, S)
+            a[a_local > -1] = local[a_local[a_local > -1]]
+
+            if za.shape[0] > 0:
+                v = za - zpred
+                v[1::2] = utils.wrapToPi(v[1::2])
+
+                S_chol = la.cholesky(Sa, lower=True)
+                v_white = la.solve_triangular(S_chol, v, lower=True)
+                NIS = v_white @ v_white
+
+                # Omega += H^T R^-1 H, xi += H^T R^-1 (v + H eta), on the robot and
+                # the observed landmarks only
+                observed = a[a > -1]
+                U_local = self.state_inds(a_local[a_local > -1])
+                U = L[U_local]
+                HU = Ha[:, U_local]
+                HtRinv = utils.matmul_block_diag(HU.T, la.inv(self.R))
+
+                info.Omega[np.ix_(U, U)] = (
+                    info.Omega[np.ix_(U, U)].toarray() + HtRinv @ HU)
+                info.xi[U] += HtRinv @ (v + HU @ eta[U])
+
+        # the new landmarks are initialized from the updated mean
+        info.num_updates += 1
+        if self.recover_every is not None and info.num_updates % self.recover_every == 0:
+            eta = self.recover_mean(info)
+        else:
+            self.relax(eta, info, np.union1d(info.active, observed))
+
+        if self.do_asso:
+            is_new_lmk = a == -1
+            if np.any(is_new_lmk):
+                z_new = z.reshape(-1, 2)[is_new_lmk].ravel()
+                eta, new = self.add_landmarks_information(eta, info, z_new)
+                observed = np.concatenate((observed, new))
+
+        # the observed landmarks are now linked to the robot
+        observed_set = set(observed.tolist())
+        info.active = [l for l in info.active if l not in observed_set] + observed.tolist()
+        self.sparsify(eta, info)
+
+        return eta, info, NIS, a
+
+    def add_landmarks_information(
+        self, eta: np.ndarray, info: InformationState, z: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Add new landmarks from the measurements z to eta and info.
+
+        The new landmarks l = g(x, z) enter as the factors l - g(x, z) with information
+        Rcart^-1, which gives the same joint as EKFSLAM.add_landmarks.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray]
+            eta with new landmarks appended, and the indices of the new landmarks.
+        """
+        lmnew, Gx, Rcart = self.init_landmarks(eta, z)
+        numLmk = lmnew.shape[0]
+        n0 = eta.shape[0]
+        new = (n0 - 3) // 2 + np.arange(numLmk)
+
+        eta = np.append(eta, lmnew.ravel())
+        info.Omega.resize((eta.shape[0],) * 2)
+        info.xi = np.append(info.xi, np.zeros(2 * numLmk))
+
+        # J = [-Gx_j, I] for each new landmark j, J^T Rcart_j^-1 J assembled over [x, new]
+        Rinv = np.linalg.inv(Rcart)
+        Gx = Gx.reshape(numLmk, 2, 3)
+        RinvGx = Rinv @ Gx
+        OmU = np.zeros((3 + 2 * numLmk,) * 2)
+        OmU[:3, :3] = (Gx.transpose(0, 2, 1) @ RinvGx).sum(axis=0)
+        cross = -RinvGx.reshape(-1, 3)
+        OmU[3:, :3] = cross
+        OmU[:3, 3:] = cross.T
+        OmNew = np.zeros((2 * numLmk,) * 2)
+        lmk_idxs = np.arange(numLmk)
+        OmNew.reshape(numLmk, 2, numLmk, 2)[lmk_idxs, :, lmk_idxs] = Rinv
+        OmU[3:, 3:] = OmNew
+
+        U = self.state_inds(new)
+        info.Omega[np.ix_(U, U)] = info.Omega[np.ix_(U, U)].toarray() + OmU
+        # the factors are zero at the linearization point
+        info.xi[U] += OmU @ eta[U]
+
+        return eta, new
+
+
+def marginalize(Omega: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """Marginalize the states out of the information matrix Omega.
+
+    Returns Omega with the Schur complement in the kept rows and columns, and zeros in out.
+    """
+    keep = np.ones(Omega.shape[0], dtype=bool)
+    keep[out] = False
+    Oko = Omega[np.ix_(keep, ~keep)]
+    Ooo = Omega[np.ix_(~keep, ~keep)]
+
+    Omarg = np.zeros_like(Omega)
+    Omarg[np.ix_(keep, keep)] = Omega[np.ix_(keep, keep)] - Oko @ la.solve(Ooo, Oko.T, assume_a="pos")
+    return Omarg
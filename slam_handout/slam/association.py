@@ -0,0 +1,322 @@
+from typing import Any, Optional, Tuple
+import abc
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import os
+import numpy as np
+from numpy import ndarray
+from dataclasses import dataclass, field
+from scipy.optimize import linear_sum_assignment
+from scipy.stats import chi2
+from JCBB import (JCBB, JCBBStats, IncrementalNIS, individualCandidates, chi2isf_cached,
+                  JCBBparallel, JCBBpool_init, SharedBound)
+
+
+def extract_associated(
+    z: np.ndarray, zpred: np.ndarray, H: np.ndarray, S: np.ndarray, a: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """Extract the associated measurements and the corresponding zpred, H and S.
+
+    Parameters
+    ----------
+    z : np.ndarray, shape=(2 * #measurements,)
+        The measurements all in one vector
+    zpred : np.ndarray, shape=(2 * #landmarks,)
+        Predicted measurements in one vector
+    H : np.ndarray, shape=(2 * #landmarks, 3 + 2 * #landmarks)
+        The measurement Jacobian matrix related to zpred
+    S : np.ndarray, shape=(2 * #landmarks,)*2
+        The innovation covariance related to zpred
+    a : np.ndarray, shape=(#measurements,)
+        a[j] is the landmark measurement j is associated with, -1 means no association
+
+    Returns
+    -------
+    Tuple[*((np.ndarray,) * 5)]
+        The extracted measurements, the corresponding zpred, H, S and the associations.
+    """
+    # Extract associated measurements
+    zinds = np.empty_like(z, dtype=bool)
+    zinds[::2] = a > -1  # -1 means no association
+    zinds[1::2] = zinds[::2]
+    zass = z[zinds]
+
+    # extract and rearange predicted measurements and cov
+    zbarinds = np.empty_like(zass, dtype=int)
+    zbarinds[::2] = 2 * a[a > -1]
+    zbarinds[1::2] = 2 * a[a > -1] + 1
+
+    zpredass = zpred[zbarinds]
+    Sass = S[zbarinds][:, zbarinds]
+    Hass = H[zbarinds]
+
+    assert zpredass.shape == zass.shape
+    assert Sass.shape == zpredass.shape * 2
+    assert Hass.shape[0] == zpredass.shape[0]
+
+    return zass, zpredass, Hass, Sass, a
+
+
+@dataclass
+class Associator(abc.ABC):
+    """Data association interface.
+
+    Implementations only need to provide find_associations. Associators that hold
+    resources, e.g. a pool, free them in close, which is also called when used as a
+    context manager.
+    """
+
+    @abc.abstractmethod
+    def find_associations(self, z: np.ndarray, zpred: np.ndarray, S: np.ndarray) -> np.ndarray:
+        """Find the associations between the measurements and landmarks.
+
+        Parameters
+        ----------
+        z : np.ndarray, shape=(2 * #measurements,)
+            The measurements all in one vector
+        zpred : np.ndarray, shape=(2 * #landmarks,)
+            Predicted measurements in one vector
+        S : np.ndarray, shape=(2 * #landmarks,)*2
+            The innovation covariance related to zpred
+
+        Returns
+        -------
+        np.ndarray, shape=(#measurements,)
+            a[j] is the landmark measurement j is associated with, -1 means no association
+        """
+
+    def associate(
+        self, z: np.ndarray, zpred: np.ndarray, H: np.ndarray, S: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+        """Associate landmarks and measurements, and extract correct matrices for these.
+
+        See extract_associated for the returned values.
+        """
+        a = self.find_associations(z, zpred, S)
+        return extract_associated(z, zpred, H, S, a)
+
+    def close(self):
+        """Free the resources of the associator, nothing by default."""
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+@dataclass
+class JCBBAssociator(Associator):
+    """Joint compatibility branch and bound, see JCBB.JCBB.
+
+    With parallel, the top-level branches of the search are spread over a pool of
+    num_workers processes (or threads), see JCBB.JCBBparallel. The search is then in exact
+    mode also for the small problems that are searched serially, so the result does not
+    depend on the pool. Call close when done to shut the pool down, or use the associator
+    as a context manager.
+    """
+
+    # first is for joint compatibility, second is individual
+    alphas: 'ndarray[2]' = field(
+        default_factory=lambda: np.array([0.001, 0.0001]))
+    # search budget per scan, the best association found so far is used when it runs out
+    max_nodes: Optional[int] = None
+    max_time: Optional[float] = None
+    # search statistics of the last call
+    stats: JCBBStats = field(default_factory=JCBBStats)
+    parallel: bool = False
+    num_workers: int = field(default_factory=lambda: os.cpu_count() or 1)
+    # "process" or "thread"
+    executor: str = "process"
+    # fewer measurements than this are searched serially
+    min_parallel_measurements: int = 15
+    _pool: Any = field(default=None, init=False, repr=False)
+    _shared_bound: Any = field(default=None, init=False, repr=False)
+
+    def find_associations(self, z, zpred, S):
+        self.stats = JCBBStats()
+        if not self.parallel:
+            return JCBB(z, zpred, S, self.alphas[0], self.alphas[1],
+                        max_nodes=self.max_nodes, max_time=self.max_time, stats=self.stats)
+
+        if self._pool is None and z.shape[0] // 2 >= self.min_parallel_measurements:
+            self.start_pool()
+        return JCBBparallel(
+            z, zpred, S, self.alphas[0], self.alphas[1], self._pool, self._shared_bound,
+            self.num_workers, self.min_parallel_measurements,
+            max_nodes=self.max_nodes, max_time=self.max_time, stats=self.stats
+        )
+
+    def start_pool(self):
+        if self.executor == "process":
+            self._shared_bound = multiprocessing.Value("i", 0)
+            self._pool = ProcessPoolExecutor(
+                self.num_workers, initializer=JCBBpool_init, initargs=(self._shared_bound,))
+        elif self.executor == "thread":
+            self._shared_bound = SharedBound()
+            self._pool = ThreadPoolExecutor(self.num_workers)
+        else:
+            raise ValueError(f"JCBBAssociator: unknown executor {self.executor}")
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+            self._shared_bound = None
+
+
+@dataclass
+class NNAssociator(Associator):
+    """Greedy nearest neighbour within the individual compatibility gate.
+
+    The pairs are taken in order of increasing individual NIS, so every landmark is used
+    at most once.
+    """
+
+    alpha: float = 0.0001
+
+    def find_associations(self, z, zpred, S):
+        m = z.shape[0] // 2
+        a = np.full(m, -1, dtype=int)
+        if zpred.shape[0] == 0 or m == 0:
+            return a
+
+        cand = individualCandidates(z, zpred, S, chi2.isf(self.alpha, 2))
+        meas = cand.measurements()
+
+        used = np.zeros(cand.num_landmarks, dtype=bool)
+        for pair in np.argsort(cand.nis):
+            j = meas[pair]
+            i = cand.landmarks[pair]
+            if a[j] == -1 and not used[i]:
+                a[j] = i
+                used[i] = True
+
+        return a
+
+
+@dataclass
+class GNNAssociator(Associator):
+    """Global nearest neighbour, minimizing the sum of individual NIS.
+
+    Solved as a linear assignment problem with the cost of leaving a measurement
+    unassociated equal to the gate.
+    """
+
+    alpha: float = 0.0001
+
+    def find_associations(self, z, zpred, S):
+        m = z.shape[0] // 2
+        a = np.full(m, -1, dtype=int)
+        if zpred.shape[0] == 0 or m == 0:
+            return a
+
+        g2 = chi2.isf(self.alpha, 2)
+        cand = individualCandidates(z, zpred, S, g2)
+        if cand.nis.size == 0:
+            return a
+
+        # only the landmarks that are a candidate for some measurement take part
+        lmks, lmk_cols = np.unique(cand.landmarks, return_inverse=True)
+        nlmks = lmks.size
+
+        # [candidate costs, dummy columns], the rest is not allowed
+        not_allowed = 1e3 * g2 * (m + 1)
+        cost = np.full((m, nlmks + m), not_allowed)
+        cost[cand.measurements(), lmk_cols] = cand.nis
+        cost[np.arange(m), nlmks + np.arange(m)] = g2
+
+        rows, cols = linear_sum_assignment(cost)
+        is_ass = cols < nlmks
+        is_ass[is_ass] = cost[rows[is_ass], cols[is_ass]] < g2
+        a[rows[is_ass]] = lmks[cols[is_ass]]
+
+        return a
+
+
+@dataclass
+class RJCAssociator(Associator):
+    """Randomized joint compatibility (RJC).
+
+    For each try JCBB is run on a random subset of the measurements, and the hypothesis is
+    completed by adding the remaining measurements with nearest neighbour under joint
+    compatibility. The try with the most associations, and then the lowest joint NIS, is
+    used. The number of tries is from the RANSAC formula for the given probabilities.
+    """
+
+    # first is for joint compatibility, second is individual
+    alphas: 'ndarray[2]' = field(
+        default_factory=lambda: np.array([0.001, 0.0001]))
+    # number of measurements in the random subsets
+    sample_size: int = 4
+    # probability of a measurement being correctly associated (not clutter)
+    p_inlier: float = 0.7
+    # wanted probability of at least one subset with only inliers
+    p_success: float = 0.99
+    # scans with fewer measurements than this, or than sample_size, are solved with plain JCBB
+    min_measurements: int = 10
+    seed: Optional[int] = None
+    rng: np.random.Generator = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.rng = np.random.default_rng(self.seed)
+
+    def num_tries(self) -> int:
+        p_good_sample = self.p_inlier ** self.sample_size
+        if p_good_sample >= 1:
+            return 1
+        return int(np.ceil(np.log(1 - self.p_success) / np.log(1 - p_good_sample)))
+
+    def find_associations(self, z, zpred, S):
+        m = z.shape[0] // 2
+        alpha1, alpha2 = self.alphas
+        if m < max(self.min_measurements, self.sample_size) or zpred.shape[0] == 0:
+            return JCBB(z, zpred, S, alpha1, alpha2)
+
+        cand = individualCandidates(z, zpred, S, chi2.isf(alpha2, 2))
+        nzbar = cand.num_landmarks
+
+        # measurements in order of their best individual NIS, used for the completion
+        order = np.argsort(cand.nis_min)
+
+        abest = np.full(m, -1, dtype=int)
+        nbest = 0
+        nisbest = np.inf
+        for _ in range(self.num_tries()):
+            sample = self.rng.choice(m, size=self.sample_size, replace=False)
+            zinds = np.empty(2 * self.sample_size, dtype=int)
+            zinds[::2] = 2 * sample
+            zinds[1::2] = 2 * sample + 1
+
+            a = np.full(m, -1, dtype=int)
+            a[sample] = JCBB(z[zinds], zpred, S, alpha1, alpha2)
+
+            # joint NIS of the subset hypothesis
+            joint_nis = IncrementalNIS(z, zpred, S, min(m, nzbar))
+            used = np.zeros(nzbar, dtype=bool)
+            for j in sample[a[sample] > -1]:
+                joint_nis.try_push(j, a[j])
+                joint_nis.commit()
+                used[a[j]] = True
+
+            # complete with nearest neighbour under joint compatibility
+            in_sample = np.zeros(m, dtype=bool)
+            in_sample[sample] = True
+            for j in order[~in_sample[order]]:
+                landmarks, _ = cand.row(j)
+                for i in landmarks[~used[landmarks]]:
+                    gate = chi2isf_cached(alpha1, 2 * (joint_nis.k + 1))
+                    if joint_nis.try_push(j, i) < gate:
+                        joint_nis.commit()
+                        a[j] = i
+                        used[i] = True
+                        break
+
+            n = joint_nis.k
+            nis = joint_nis.nis if n > 0 else np.inf
+            if n > nbest or (n == nbest and nis < nisbest):
+                abest = a
+                nbest = n
+                nisbest = nis
+
+        return abest
@@ -0,0 +1,254 @@
+from typing import Callable, Dict, List, Optional
+from dataclasses import dataclass, field, asdict
+from pathlib import Path
+import argparse
+import json
+import platform
+import subprocess
+import time
+import tracemalloc
+import numpy as np
+import scipy
+import matplotlib
+import matplotlib.pyplot as plt
+from EKFSLAM import EKFSLAM
+from synthetic_data import SimulationConfig, simulate
+
+
+@dataclass
+class StageTimer:
+    """Records the latency of every call to a function, and the landmark count of the call.
+
+    Every memory_every call is run under tracemalloc instead, for the peak memory, and
+    left out of the latencies.
+    """
+
+    name: str
+    # the number of landmarks of a call, from its arguments
+    size: Callable[..., int]
+    memory_every: int = 50
+    sizes: List[int] = field(default_factory=list)
+    latencies: List[float] = field(default_factory=list)
+    memory_sizes: List[int] = field(default_factory=list)
+    peak_memory: List[int] = field(default_factory=list)
+    _calls: int = 0
+
+    def wrap(self, func: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            if tracemalloc.is_tracing():  # within a memory sample of another stage
+                return func(*args, **kwargs)
+            self._calls += 1
+            n = self.size(*args)
+            if self.memory_every and self._calls % self.memory_every == 0:
+                tracemalloc.start()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    self.memory_sizes.append(n)
+                    self.peak_memory.append(tracemalloc.get_traced_memory()[1])
+                    tracemalloc.stop()
+            t0 = time.perf_counter()
+            ret = func(*args, **kwargs)
+            self.latencies.append(time.perf_counter() - t0)
+            self.sizes.append(n)
+            return ret
+        return timed
+
+
+def num_landmarks_eta(eta, *args) -> int:
+    return (eta.shape[0] - 3) // 2
+
+
+def num_landmarks_zpred(z, zpred, *args) -> int:
+    return zpred.shape[0] // 2
+
+
+# the stages timed, and how the landmark count is found from their arguments. The
+# stages are inclusive, update contains h, h_jac, associate and add_landmarks.
+STAGES = {
+    "predict": num_landmarks_eta,
+    "h": num_landmarks_eta,
+    "h_jac": num_landmarks_eta,
+    "associate": num_landmarks_zpred,
+    "add_landmarks": num_landmarks_eta,
+    "update": num_landmarks_eta,
+}
+
+
+def run_benchmark(
+    config: SimulationConfig, max_landmarks: int, memory_every: int = 50, max_time: Optional[float] = None
+) -> Dict[str, StageTimer]:
+    """Run EKFSLAM on a synthetic dataset until the map has max_landmarks landmarks.
+
+    Returns
+    -------
+    Dict[str, StageTimer]
+        the timings of each stage
+    """
+    dataset = simulate(config)
+    slam = EKFSLAM(config.Q, config.R, do_asso=True, alphas=np.array([0.001, 0.0001]))
+    timers = {}
+    for name, size in STAGES.items():
+        timers[name] = StageTimer(name, size, memory_every)
+        setattr(slam, name, timers[name].wrap(getattr(slam, name)))
+
+    z = dataset.z_list()
+    eta = dataset.poseGT[0].copy()
+    P = np.zeros((3, 3))
+    t0 = time.perf_counter()
+    for k in range(dataset.K):
+        eta, P, _, _ = slam.update(eta, P, z[k])
+        eta, P = slam.predict(eta, P, dataset.odometry[k])
+        if (eta.shape[0] - 3) // 2 >= max_landmarks:
+            break
+        if max_time is not None and time.perf_counter() - t0 > max_time:
+            break
+
+    return timers
+
+
+def fit_exponent(n: np.ndarray, t: np.ndarray) -> Optional[float]:
+    """The exponent p of t = c n^p, least squares in log-log."""
+    valid = (n > 0) & (t > 0)
+    if np.count_nonzero(valid) < 2 or np.ptp(np.log(n[valid])) == 0:
+        return None
+    return float(np.polyfit(np.log(n[valid]), np.log(t[valid]), 1)[0])
+
+
+def summarize(timer: StageTimer, num_bins: int = 12, min_landmarks: int = 10) -> Dict:
+    """Latency percentiles and peak memory in log spaced bins of the landmark count.
+
+    The complexity exponent is fitted to the bin medians with at least min_landmarks.
+    """
+    sizes = np.array(timer.sizes)
+    latencies = np.array(timer.latencies)
+    memory_sizes = np.array(timer.memory_sizes)
+    peak_memory = np.array(timer.peak_memory)
+    summary = dict(calls=int(sizes.shape[0]), bins=[], exponent=None, memory_exponent=None)
+    if sizes.shape[0] == 0:
+        return summary
+
+    edges = np.unique(np.geomspace(1, max(sizes.max(), 1) + 1, num_bins + 1).astype(int))
+    bin_inds = np.searchsorted(edges, sizes, side="right") - 1
+    memory_bin_inds = np.searchsorted(edges, memory_sizes, side="right") - 1
+    for b in range(edges.shape[0] - 1):
+        in_bin = bin_inds == b
+        if not np.any(in_bin):
+            continue
+        p50, p90, p99 = np.percentile(latencies[in_bin], [50, 90, 99])
+        memory = peak_memory[memory_bin_inds == b]
+        summary["bins"].append(dict(
+            landmarks=float(np.median(sizes[in_bin])),
+            calls=int(np.count_nonzero(in_bin)),
+            p50=float(p50), p90=float(p90), p99=float(p99),
+            peak_memory=int(memory.max()) if memory.shape[0] > 0 else None,
+        ))
+
+    bins = [b for b in summary["bins"] if b["landmarks"] >= min_landmarks]
+    summary["exponent"] = fit_exponent(
+        np.array([b["landmarks"] for b in bins]), np.array([b["p50"] for b in bins]))
+    bins = [b for b in bins if b["peak_memory"] is not None]
+    summary["memory_exponent"] = fit_exponent(
+        np.array([b["landmarks"] for b in bins]), np.array([b["peak_memory"] for b in bins], dtype=float))
+    return summary
+
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=Path(__file__).parent,
+            capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def plot_results(results: Dict, path: Path):
+    fig, (ax_t, ax_m) = plt.subplots(1, 2, figsize=(11, 4.5), num="benchmark", clear=True)
+    for name, stage in results["stages"].items():
+        bins = stage["bins"]
+        if not bins:
+            continue
+        n = np.array([b["landmarks"] for b in bins])
+        p50 = np.array([b["p50"] for b in bins])
+        p90 = np.array([b["p90"] for b in bins])
+        exponent = stage["exponent"]
+        label = name if exponent is None else f"{name}, $n^{{{exponent:.2f}}}$"
+        line, = ax_t.loglog(n, p50, ".-", label=label)
+        ax_t.fill_between(n, p50, p90, color=line.get_color(), alpha=0.2)
+
+        memory = [(b["landmarks"], b["peak_memory"]) for b in bins if b["peak_memory"] is not None]
+        if memory:
+            ax_m.loglog(*np.array(memory).T, ".-", color=line.get_color(), label=name)
+
+    ax_t.set(xlabel="landmarks", ylabel="latency [s], median to p90",
+             title=f"commit {results['commit']}")
+    ax_m.set(xlabel="landmarks", ylabel="peak memory [B]")
+    for ax in (ax_t, ax_m):
+        ax.grid(True, which="both")
+        ax.legend()
+    fig.tight_layout()
+    fig.savefig(path)
+
+
+def compare(results: Dict, reference: Dict):
+    """Print the exponents and the median latency at the largest common bin against reference."""
+    print(f"{'stage':<15}{'exponent':>18}{'p50 [ms]':>24}")
+    for name, stage in results["stages"].items():
+        ref = reference["stages"].get(name)
+        if ref is None or not stage["bins"] or not ref["bins"]:
+            continue
+        n_ref = {round(b["landmarks"]): b for b in ref["bins"]}
+        common = [b for b in stage["bins"] if round(b["landmarks"]) in n_ref]
+        exponents = f"{ref['exponent'] or float('nan'):.2f} -> {stage['exponent'] or float('nan'):.2f}"
+        if common:
+            b = common[-1]
+            b_ref = n_ref[round(b["landmarks"])]
+            latency = f"{1e3 * b_ref['p50']:.3f} -> {1e3 * b['p50']:.3f} @ {b['landmarks']:.0f}"
+        else:
+            latency = "no common bins"
+        print(f"{name:<15}{exponents:>18}{latency:>24}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Per-stage latency and memory of EKFSLAM as the map grows.")
+    parser.add_argument("--output", type=Path, default=Path("benchmark_scaling.json"))
+    parser.add_argument("--max-landmarks", type=int, default=1000)
+    parser.add_argument("--max-time", type=float, default=None, help="seconds")
+    parser.add_argument("--memory-every", type=int, default=50)
+    parser.add_argument("--compare", type=Path, default=None, help="an earlier result to compare with")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # a long drive through a dense forest with a short sensor range, so the map keeps
+    # growing at a moderate number of measurements per scan
+    config = SimulationConfig(
+        world_size=2000, landmark_density=0.01, num_steps=100000, speed=2.0,
+        max_range=20.0, seed=args.seed)
+
+    t0 = time.perf_counter()
+    timers = run_benchmark(config, args.max_landmarks, args.memory_every, args.max_time)
+    results = dict(
+        commit=git_commit(),
+        max_landmarks=args.max_landmarks,
+        wall_time=time.perf_counter() - t0,
+        config=asdict(config),
+        platform=dict(python=platform.python_version(), numpy=np.__version__,
+                      scipy=scipy.__version__, machine=platform.machine()),
+        stages={name: summarize(timer) for name, timer in timers.items()},
+    )
+
+    args.output.write_text(json.dumps(results, indent=2))
+    plot_results(results, args.output.with_suffix(".pdf"))
+    for name, stage in results["stages"].items():
+        exponent = "-" if stage["exponent"] is None else f"{stage['exponent']:.2f}"
+        print(f"{name}: {stage['calls']} calls, exponent {exponent}")
+    print(f"results written to {args.output} and {args.output.with_suffix('.pdf')}")
+
+    if args.compare is not None:
+        compare(results, json.loads(args.compare.read_text()))
+
+
+if __name__ == "__main__":
+    matplotlib.use("Agg")
+    main()
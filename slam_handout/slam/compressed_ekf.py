@@ -0,0 +1,233 @@
+from typing import Tuple
+import numpy as np
+from dataclasses import dataclass, field
+import scipy.linalg as la
+from EKFSLAM import EKFSLAM
+import utils
+
+
+@dataclass
+class CompressedEKFSLAM:
+    """Compressed EKF SLAM, the filter steps only touch a local region of the map.
+
+    The state is split into the active part A, the robot and the landmarks within
+    sensor_range + refresh_distance of the robot at the last refresh, and the passive part
+    B, the rest of the map. predict and update work on eta_A and P_AA only, and their
+    effect on the passive part is accumulated in the auxiliary matrices phi, psi and theta,
+    such that (with 0 denoting the values at the last refresh)
+
+        P_AB = phi P_AB0, P_BB = P_BB0 - P_BA0 psi P_AB0, eta_B = eta_B0 + P_BA0 theta.
+
+    The global eta and P are brought up to date by refresh, which is done when the robot
+    is more than refresh_distance from where the region was selected, or on demand. The
+    cost of a scan then depends on the number of landmarks in the region and not on the
+    size of the map.
+
+    Measurements can only be associated with the active landmarks, so sensor_range should
+    be the range of the detections plus a margin for the errors in the estimated positions.
+    With all landmarks active this gives the same result as EKFSLAM.
+
+    Example
+    -------
+    cekf = CompressedEKFSLAM(slam, eta, P, sensor_range=80, refresh_distance=20)
+    cekf.predict(z_odo)
+    NIS, a = cekf.update(z)
+    eta, P = cekf.refresh()
+    """
+
+    slam: EKFSLAM
+    # the global state and covariance, the passive part is as of the last refresh
+    eta: np.ndarray
+    P: np.ndarray
+    sensor_range: float = 80.0
+    refresh_distance: float = 20.0
+    num_refreshes: int = 0
+    # state indices of the active part at the last refresh, the robot first
+    active: np.ndarray = field(init=False, repr=False)
+    passive: np.ndarray = field(init=False, repr=False)
+    # landmark indices of the active landmarks at the last refresh
+    active_lmks: np.ndarray = field(init=False, repr=False)
+    # where the active region was selected
+    center: np.ndarray = field(init=False, repr=False)
+    # the active state and covariance, landmarks added since the refresh are appended
+    eta_A: np.ndarray = field(init=False, repr=False)
+    P_A: np.ndarray = field(init=False, repr=False)
+    phi: np.ndarray = field(init=False, repr=False)
+    psi: np.ndarray = field(init=False, repr=False)
+    theta: np.ndarray = field(init=False, repr=False)
+
+    def __post_init__(self):
+        self.eta = np.array(self.eta, dtype=float)
+        self.P = np.array(self.P, dtype=float)
+        self.select_active()
+
+    @property
+    def num_landmarks(self) -> int:
+        return (self.eta.shape[0] + self.eta_A.shape[0] - self.active.shape[0] - 3) // 2
+
+    def select_active(self):
+        """Select the active region around the robot, the global state must be up to date."""
+        self.center = self.eta[:2].copy()
+        lmks = self.eta[3:].reshape(-1, 2)
+        region_radius = self.sensor_range + self.refresh_distance
+        dist2 = ((lmks - self.center) ** 2).sum(axis=1)
+        self.active_lmks = np.flatnonzero(dist2 <= region_radius ** 2)
+
+        lmk_inds = 3 + 2 * self.active_lmks[:, None] + np.arange(2)
+        self.active = np.concatenate((np.arange(3), lmk_inds.ravel()))
+        is_passive = np.ones(self.eta.shape[0], dtype=bool)
+        is_passive[self.active] = False
+        self.passive = np.flatnonzero(is_passive)
+
+        self.eta_A = self.eta[self.active]
+        self.P_A = self.P[np.ix_(self.active, self.active)]
+
+        nA = self.active.shape[0]
+        self.phi = np.eye(nA)
+        self.psi = np.zeros((nA, nA))
+        self.theta = np.zeros(nA)
+
+    def refresh(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Bring the global eta and P up to date and select the active region again.
+
+        This is O(n^2 * #active) in the global state size n.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray], shapes= (3 + 2*#landmarks,), (3 + 2*#landmarks,)*2
+            the global state and covariance, the landmarks added since the last refresh
+            are appended at the end.
+        """
+        n0 = self.eta.shape[0]
+        n = n0 + self.eta_A.shape[0] - self.active.shape[0]
+        act = np.concatenate((self.active, np.arange(n0, n)))
+        pas = self.passive
+
+        PA0B = self.P[np.ix_(self.active, pas)]
+        PAB = self.phi @ PA0B
+
+        eta = np.empty(n)
+        eta[pas] = self.eta[pas] + PA0B.T @ self.theta
+        eta[act] = self.eta_A
+
+        P = np.empty((n, n))
+        P[np.ix_(pas, pas)] = self.P[np.ix_(pas, pas)] - PA0B.T @ self.psi @ PA0B
+        P[np.ix_(act, pas)] = PAB
+        P[np.ix_(pas, act)] = PAB.T
+        P[np.ix_(act, act)] = self.P_A
+
+        self.eta = eta
+        self.P = P
+        self.num_refreshes += 1
+        self.select_active()
+
+        self.slam.validation.check("CompressedEKFSLAM.refresh", self.eta, self.P)
+
+        return self.eta, self.P
+
+    def predict(self, z_odo: np.ndarray):
+        """Predict the robot state with the odometry z_odo, O(#active).
+
+        Parameters
+        ----------
+        z_odo : np.ndarray, shape=(3,)
+            the measured odometry
+        """
+        x = self.eta_A[:3]
+        Fx = self.slam.Fx(x, z_odo)
+        Fu = self.slam.Fu(x, z_odo)
+        xpred = self.slam.f(x, z_odo)
+        self.predict_robot(xpred, Fx, Fu @ self.slam.Q @ Fu.T)
+
+    def predict_batch(self, z_odos: np.ndarray):
+        """Predict with several odometry increments, see EKFSLAM.predict_batch."""
+        xpred, F, Qc = self.slam.compose_odometry(self.eta_A[:3], z_odos)
+        self.predict_robot(xpred, F, Qc)
+
+    def predict_robot(self, xpred: np.ndarray, F: np.ndarray, Qc: np.ndarray):
+        """Set the predicted robot state and propagate the active part, see EKFSLAM.predict_robot."""
+        self.slam.predict_robot(self.eta_A, self.P_A, xpred, F, Qc)
+        # P_AB = phi P_AB0 changes in the robot rows only
+        self.phi[:3] = F @ self.phi[:3]
+
+    def update(self, z: np.ndarray) -> Tuple[float, np.ndarray]:
+        """Update the active part with z, associating landmarks and adding new ones.
+
+        Refreshes first if the robot has left the active region.
+
+        Parameters
+        ----------
+        z : np.ndarray, shape=(#detections, 2)
+            the measurements
+
+        Returns
+        -------
+        Tuple[float, np.ndarray]
+            the NIS and the associations, a[j] is the (global) landmark index measurement j
+            is associated with, -1 means no association.
+        """
+        if np.linalg.norm(self.eta_A[:2] - self.center) > self.refresh_distance:
+            self.refresh()
+
+        slam = self.slam
+        eta = self.eta_A
+        P = self.P_A
+        z = z.ravel()
+        a = np.full(z.shape[0] // 2, -1, dtype=int)
+        NIS = 1  # TODO: beware this one when analysing consistency.
+
+        if eta.shape[0] > 3:
+            zpred = slam.h(eta)
+            H = slam.h_jac(eta)
+            S = H @ P @ H.T
+            utils.add_block_diag(S, slam.R)
+
+            za, zpred, Ha, Sa, a = slam.associate(z, zpred, H, S)
+
+            if za.shape[0] > 0:
+                v = za - zpred
+                v[1::2] = utils.wrapToPi(v[1::2])
+
+                # same Cholesky form as EKFSLAM.update, with C = L^-1 Ha the whitened Jacobian
+                S_chol = la.cholesky(Sa, lower=True)
+                C = la.solve_triangular(S_chol, Ha, lower=True)
+                v_white = la.solve_triangular(S_chol, v, lower=True)
+                B = C @ P
+                Cphi = C @ self.phi
+
+                self.eta_A = eta + B.T @ v_white
+                self.P_A = P - B.T @ B
+                NIS = v_white @ v_white
+
+                # the effect on the passive part, applied at the next refresh
+                self.theta += Cphi.T @ v_white
+                self.psi += Cphi.T @ Cphi
+                self.phi -= B.T @ Cphi
+
+        if slam.do_asso:
+            is_new_lmk = a == -1
+            if np.any(is_new_lmk):
+                z_new = z.reshape(-1, 2)[is_new_lmk].ravel()
+                lmnew, Gx, Rcart = slam.init_landmarks(self.eta_A, z_new)
+                self.eta_A, self.P_A = slam.append_landmarks(
+                    self.eta_A, self.P_A, lmnew, Gx, Rcart)
+                # the new landmarks are correlated with the passive part through the robot
+                self.phi = np.vstack((self.phi, Gx @ self.phi[:3]))
+
+        slam.validation.check("CompressedEKFSLAM.update", self.eta_A, self.P_A)
+
+        return NIS, self.global_associations(a)
+
+    def global_associations(self, a: np.ndarray) -> np.ndarray:
+        """Convert associations to active landmarks to global landmark indices."""
+        numLmk0 = (self.eta.shape[0] - 3) // 2
+        numActive0 = self.active_lmks.shape[0]
+        numActive = (self.eta_A.shape[0] - 3) // 2
+        lmks = np.concatenate((
+            self.active_lmks,
+            numLmk0 + np.arange(numActive - numActive0),
+        ))
+
+        a_global = np.full_like(a, -1)
+        a_global[a > -1] = lmks[a[a > -1]]
+        return a_global
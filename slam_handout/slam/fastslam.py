@@ -0,0 +1,460 @@
+from typing import Any, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
+import numpy as np
+import scipy.linalg as la
+from scipy.stats import chi2
+from EKFSLAM import EKFSLAM
+import utils
+
+
+@dataclass
+class LandmarkMap:
+    """The landmarks of one particle as 2x2 EKFs, stored in chunks shared copy-on-write.
+
+    Landmark j is row j % chunk_size of chunk j // chunk_size. Copies share all the chunks,
+    and a chunk is copied the first time it is written to by a map that does not own it,
+    so resampling copies #landmarks / chunk_size references and not the landmarks.
+
+    Each chunk has a bounding box of its means, used by local to only look at the chunks
+    near a position. The boxes only grow, so they stay valid as the landmarks move.
+    Landmarks are appended in the order they are seen, so a chunk covers a small area.
+    """
+
+    chunk_size: int = 64
+    means: List[np.ndarray] = field(default_factory=list)
+    covs: List[np.ndarray] = field(default_factory=list)
+    # the chunks that are not shared with other maps and can be written in place
+    owned: List[bool] = field(default_factory=list)
+    num_landmarks: int = 0
+    # the [min, max] of the means in each chunk, shape (#chunks, 2, 2)
+    bounds: np.ndarray = field(default_factory=lambda: np.zeros((0, 2, 2)))
+
+    def copy(self) -> "LandmarkMap":
+        """A copy sharing all the chunks, which are then owned by neither map."""
+        self.owned = [False] * len(self.owned)
+        return LandmarkMap(
+            self.chunk_size, list(self.means), list(self.covs), list(self.owned), self.num_landmarks,
+            self.bounds.copy())
+
+    def all_means(self) -> np.ndarray:
+        """The means of all the landmarks, shape (#landmarks, 2)."""
+        if self.num_landmarks == 0:
+            return np.zeros((0, 2))
+        return np.concatenate(self.means)[:self.num_landmarks]
+
+    def local(self, center: np.ndarray, radius: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """The landmarks within radius of center, from the chunks whose box is within radius.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray, np.ndarray], shapes=(#local,), (#local, 2), (#local, 2, 2)
+            the landmark indices, in increasing order, and their means and covariances
+        """
+        gap = np.maximum(np.maximum(self.bounds[:, 0] - center, center - self.bounds[:, 1]), 0)
+        near = np.flatnonzero((gap ** 2).sum(axis=1) <= radius ** 2)
+        if near.shape[0] == 0:
+            return np.zeros(0, dtype=int), np.zeros((0, 2)), np.zeros((0, 2, 2))
+
+        inds = (self.chunk_size * near[:, None] + np.arange(self.chunk_size)).ravel()
+        means = np.concatenate([self.means[c] for c in near])
+        covs = np.concatenate([self.covs[c] for c in near])
+        # the unused rows of the last chunk are nan, and never within radius
+        with np.errstate(invalid="ignore"):
+            local = ((means - center) ** 2).sum(axis=1) <= radius ** 2
+        return inds[local], means[local], covs[local]
+
+    def chunk_groups(self, inds: np.ndarray) -> List[Tuple[int, np.ndarray, np.ndarray]]:
+        """The chunk, the positions in inds and the rows in the chunk, per chunk in inds."""
+        chunks, rows = np.divmod(inds, self.chunk_size)
+        order = np.argsort(chunks, kind="stable")
+        splits = np.flatnonzero(np.diff(chunks[order])) + 1
+        return [(chunks[group[0]], group, rows[group]) for group in np.split(order, splits)
+                if group.shape[0] > 0]
+
+    def get(self, inds: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """The means and covariances of the landmarks inds, shapes (#inds, 2), (#inds, 2, 2)."""
+        means = np.empty((inds.shape[0], 2))
+        covs = np.empty((inds.shape[0], 2, 2))
+        for c, group, rows in self.chunk_groups(inds):
+            means[group] = self.means[c][rows]
+            covs[group] = self.covs[c][rows]
+        return means, covs
+
+    def set(self, inds: np.ndarray, means: np.ndarray, covs: np.ndarray):
+        """Set the landmarks inds, copying the chunks that are shared."""
+        for c, group, rows in self.chunk_groups(inds):
+            self.own(c)
+            self.means[c][rows] = means[group]
+            self.covs[c][rows] = covs[group]
+            self.bounds[c, 0] = np.minimum(self.bounds[c, 0], means[group].min(axis=0))
+            self.bounds[c, 1] = np.maximum(self.bounds[c, 1], means[group].max(axis=0))
+
+    def own(self, c: int):
+        if not self.owned[c]:
+            self.means[c] = self.means[c].copy()
+            self.covs[c] = self.covs[c].copy()
+            self.owned[c] = True
+
+    def append(self, means: np.ndarray, covs: np.ndarray):
+        """Append new landmarks at the end."""
+        inds = self.num_landmarks + np.arange(means.shape[0])
+        num_chunks = -(-(self.num_landmarks + means.shape[0]) // self.chunk_size)
+        new_chunks = num_chunks - len(self.means)
+        if new_chunks > 0:
+            empty = np.array([[np.inf, np.inf], [-np.inf, -np.inf]])
+            self.bounds = np.concatenate((self.bounds, np.tile(empty, (new_chunks, 1, 1))))
+        while len(self.means) < num_chunks:
+            self.means.append(np.full((self.chunk_size, 2), np.nan))
+            self.covs.append(np.full((self.chunk_size, 2, 2), np.nan))
+            self.owned.append(True)
+        self.num_landmarks += means.shape[0]
+        self.set(inds, means, covs)
+
+
+@dataclass
+class ParticleUpdate:
+    """The result of particle_update for one particle."""
+
+    x: np.ndarray
+    log_likelihood: float
+    NIS: float
+    # a[j] is the (local) landmark measurement j is associated with, -1 means new
+    a: np.ndarray
+    # the updated means and covariances of the associated landmarks, in the order of a[a > -1]
+    means: np.ndarray
+    covs: np.ndarray
+    # the new landmarks
+    new_means: np.ndarray
+    new_covs: np.ndarray
+
+
+def particle_update(
+    slam: EKFSLAM,
+    x: np.ndarray,
+    Qc: np.ndarray,
+    means: np.ndarray,
+    covs: np.ndarray,
+    z: np.ndarray,
+    new_landmark_log_likelihood: float,
+    seed: int,
+) -> ParticleUpdate:
+    """The FastSLAM 2.0 update of one particle with the scan z.
+
+    The pose is sampled from the proposal conditioned on the associated measurements,
+    which is a Kalman update of the predicted pose x with covariance Qc, and the
+    associated landmarks are then updated at the sampled pose. Without associations the
+    pose is sampled from N(x, Qc), so the particles keep the spread of the odometry noise.
+
+    Parameters
+    ----------
+    slam : EKFSLAM
+        for the models, noise and association
+    x : np.ndarray, shape=(3,)
+        the predicted pose
+    Qc : np.ndarray, shape=(3, 3)
+        the process noise since the last update
+    means : np.ndarray, shape=(#landmarks, 2)
+        the landmarks that can be associated
+    covs : np.ndarray, shape=(#landmarks, 2, 2)
+        their covariances
+    z : np.ndarray, shape=(#detections, 2)
+        the measurements
+    new_landmark_log_likelihood : float
+        the log likelihood of a measurement of a new landmark
+    seed : int
+        for the sampling of the pose
+
+    Returns
+    -------
+    ParticleUpdate
+    """
+    rng = np.random.default_rng(seed)
+    z = z.ravel()
+    numLmk = means.shape[0]
+    a = np.full(z.shape[0] // 2, -1, dtype=int)
+    log_likelihood = 0.0
+    NIS = 0.0
+    # without associations the proposal is the prior, x ~ N(x, Qc)
+    xmean = x
+    xcov = Qc
+
+    if numLmk > 0 and z.shape[0] > 0:
+        eta = np.concatenate((x, means.ravel()))
+        zpred = slam.h(eta)
+        Hx = slam.h_jac(eta)[:, :3]
+        # the Jacobian wrt. a landmark is minus the one wrt. the position
+        Hm = -Hx[:, :2].reshape(numLmk, 2, 2)
+
+        S = Hx @ Qc @ Hx.T
+        idxs = 2 * np.arange(numLmk)[:, None] + np.arange(2)
+        S[idxs[:, :, None], idxs[:, None, :]] += Hm @ covs @ Hm.transpose(0, 2, 1) + slam.R
+
+        za, zpreda, Hxa, Sa, a = slam.associate(z, zpred, Hx, S)
+
+        if za.shape[0] > 0:
+            v = za - zpreda
+            v[1::2] = utils.wrapToPi(v[1::2])
+
+            # proposal, x ~ N(x + W v, Qc - W Sa W^T) with W = Qc Hxa^T Sa^-1
+            S_cho = la.cho_factor(Sa)
+            W = la.cho_solve(S_cho, Hxa @ Qc).T
+            xmean = x + W @ v
+            xcov = Qc - W @ Hxa @ Qc
+            xcov = (xcov + xcov.T) / 2
+
+            NIS = v @ la.cho_solve(S_cho, v)
+            log_likelihood = -0.5 * (
+                NIS + 2 * np.log(np.diag(S_cho[0])).sum() + za.shape[0] * np.log(2 * np.pi))
+
+    w, V = la.eigh(xcov)
+    x = xmean + V @ (np.sqrt(np.clip(w, 0, None)) * rng.standard_normal(3))
+    x[2] = utils.wrapToPi(x[2])
+
+    # landmark EKF updates at the sampled pose
+    lmks = a[a > -1]
+    is_asso = np.flatnonzero(a > -1)
+    means_upd = means[lmks]
+    covs_upd = covs[lmks]
+    if lmks.shape[0] > 0:
+        eta = np.concatenate((x, means_upd.ravel()))
+        zpred = slam.h(eta).reshape(-1, 2)
+        Hm = -slam.h_jac(eta)[:, :2].reshape(-1, 2, 2)
+        v = z.reshape(-1, 2)[is_asso] - zpred
+        v[:, 1] = utils.wrapToPi(v[:, 1])
+
+        PHt = covs_upd @ Hm.transpose(0, 2, 1)
+        S = Hm @ PHt + slam.R
+        K = np.linalg.solve(S, PHt.transpose(0, 2, 1)).transpose(0, 2, 1)
+        means_upd = means_upd + (K @ v[:, :, None])[:, :, 0]
+        covs_upd = covs_upd - K @ S @ K.transpose(0, 2, 1)
+        covs_upd = (covs_upd + covs_upd.transpose(0, 2, 1)) / 2
+
+    new_means = np.zeros((0, 2))
+    new_covs = np.zeros((0, 2, 2))
+    is_new = a == -1
+    if slam.do_asso and np.any(is_new):
+        z_new = z.reshape(-1, 2)[is_new].ravel()
+        new_means, _, new_covs = slam.init_landmarks(x, z_new)
+        log_likelihood += np.count_nonzero(is_new) * new_landmark_log_likelihood
+
+    return ParticleUpdate(x, log_likelihood, NIS, a, means_upd, covs_upd, new_means, new_covs)
+
+
+_worker_slam: Optional[EKFSLAM] = None
+
+
+def _worker_init(slam: EKFSLAM):
+    global _worker_slam
+    _worker_slam = slam
+
+
+def _worker_update(args: List[Tuple]) -> List[ParticleUpdate]:
+    return [particle_update(_worker_slam, *particle_args) for particle_args in args]
+
+
+@dataclass
+class FastSLAM:
+    """FastSLAM 2.0, a particle filter over the robot path with 2x2 landmark EKFs per particle.
+
+    The motion and measurement models, noise and data association are the ones of slam,
+    so slam.associator decides between JCBB and e.g. the cheaper association.NNAssociator.
+    Each particle associates on its own, with the landmarks within sensor_range of its pose.
+    An update costs O(#particles * (#landmarks / chunk_size + #landmarks in the chunks
+    near the particle)), as the local landmarks are found from the chunk bounding boxes,
+    and the memory is O(#particles * #landmarks) at worst, but the maps share the chunks
+    of the landmarks they have not changed since resampling, see LandmarkMap.
+
+    With num_workers > 0 the particle updates are sharded over a process pool. Only the
+    local landmarks of each particle are sent to the workers, the maps stay here. Call
+    close when done to shut the pool down.
+
+    Example
+    -------
+    fslam = FastSLAM(slam, num_particles=50, seed=0)
+    fslam.init_particles(x0)
+    fslam.predict(z_odo)
+    NIS, a = fslam.update(z)
+    x, lmks = fslam.estimate()
+    fslam.close()
+    """
+
+    slam: EKFSLAM
+    num_particles: int = 100
+    sensor_range: float = 80.0
+    # resample when the effective sample size is below this fraction of the particles
+    resample_threshold: float = 0.5
+    chunk_size: int = 64
+    num_workers: int = 0
+    seed: Optional[int] = None
+    # the log likelihood of a measurement of a new landmark, by default the one of a
+    # measurement at the individual gate with covariance R
+    new_landmark_log_likelihood: Optional[float] = None
+    num_resamplings: int = 0
+    poses: np.ndarray = field(init=False, repr=False)
+    log_weights: np.ndarray = field(init=False, repr=False)
+    maps: List[LandmarkMap] = field(init=False, repr=False)
+    _odos: List[np.ndarray] = field(default_factory=list, init=False, repr=False)
+    _rng: np.random.Generator = field(init=False, repr=False)
+    _pool: Any = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        self._rng = np.random.default_rng(self.seed)
+        if self.new_landmark_log_likelihood is None:
+            g2 = chi2.isf(self.slam.alphas[1], 2)
+            self.new_landmark_log_likelihood = -0.5 * (
+                g2 + np.log(la.det(self.slam.R)) + 2 * np.log(2 * np.pi))
+        self.init_particles(np.zeros(3))
+
+    def init_particles(self, x0: np.ndarray, P0: Optional[np.ndarray] = None):
+        """Start all the particles at x0, or sampled from N(x0, P0), with empty maps."""
+        self.poses = np.tile(np.asarray(x0, dtype=float)[:3], (self.num_particles, 1))
+        if P0 is not None:
+            self.poses += self._rng.multivariate_normal(np.zeros(3), P0, self.num_particles)
+        self.log_weights = np.zeros(self.num_particles)
+        self.maps = [LandmarkMap(self.chunk_size) for _ in range(self.num_particles)]
+        self._odos = []
+
+    def predict(self, z_odo: np.ndarray):
+        """Add the odometry z_odo, it is applied at the next update."""
+        self._odos.append(np.asarray(z_odo, dtype=float))
+
+    def predict_poses(self) -> Tuple[np.ndarray, np.ndarray]:
+        """Apply the odometry since the last update to all the particles.
+
+        The odometry is composed once in the robot frame, and then rotated to each particle.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray], shapes=(#particles, 3), (#particles, 3, 3)
+            the predicted poses and the process noise of each particle
+        """
+        u, _, Qc = self.slam.compose_odometry(np.zeros(3), np.array(self._odos).reshape(-1, 3))
+        self._odos = []
+
+        psi = utils.wrapToPi(self.poses[:, 2])
+        c = np.cos(psi)
+        s = np.sin(psi)
+        xpred = np.column_stack((
+            self.poses[:, 0] + c * u[0] - s * u[1],
+            self.poses[:, 1] + s * u[0] + c * u[1],
+            psi + u[2],
+        ))
+
+        T = np.zeros((self.num_particles, 3, 3))
+        T[:, 0, 0] = c
+        T[:, 0, 1] = -s
+        T[:, 1, 0] = s
+        T[:, 1, 1] = c
+        T[:, 2, 2] = 1
+        return xpred, T @ Qc @ T.transpose(0, 2, 1)
+
+    def update(self, z: np.ndarray) -> Tuple[float, np.ndarray]:
+        """Predict, update every particle with the scan z and resample if needed.
+
+        Parameters
+        ----------
+        z : np.ndarray, shape=(#detections, 2)
+            the measurements
+
+        Returns
+        -------
+        Tuple[float, np.ndarray]
+            the NIS and the associations of the most likely particle, a[j] is the
+            landmark measurement j is associated with, -1 means a new landmark.
+        """
+        xpred, Qc = self.predict_poses()
+        z = np.asarray(z, dtype=float).reshape(-1, 2)
+        seeds = self._rng.integers(2 ** 63, size=self.num_particles)
+
+        args = []
+        local_lmks = []
+        for i, lmap in enumerate(self.maps):
+            lmks, means, covs = lmap.local(xpred[i, :2], self.sensor_range)
+            local_lmks.append(lmks)
+            args.append((xpred[i], Qc[i], means, covs, z, self.new_landmark_log_likelihood, seeds[i]))
+
+        results = self.update_particles(args)
+
+        a_global = []
+        for i, (lmap, lmks, res) in enumerate(zip(self.maps, local_lmks, results)):
+            self.poses[i] = res.x
+            self.log_weights[i] += res.log_likelihood
+            lmap.set(lmks[res.a[res.a > -1]], res.means, res.covs)
+            lmap.append(res.new_means, res.new_covs)
+            a = np.full_like(res.a, -1)
+            a[res.a > -1] = lmks[res.a[res.a > -1]]
+            a_global.append(a)
+
+        self.log_weights -= self.log_weights.max()
+        best = int(np.argmax(self.log_weights))
+        NIS = results[best].NIS
+        a = a_global[best]
+
+        if self.effective_sample_size() < self.resample_threshold * self.num_particles:
+            self.resample()
+
+        return NIS, a
+
+    def update_particles(self, args: List[Tuple]) -> List[ParticleUpdate]:
+        """Run particle_update for each particle, in the process pool if num_workers > 0."""
+        if self.num_workers <= 0:
+            return [particle_update(self.slam, *particle_args) for particle_args in args]
+
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(
+                self.num_workers, initializer=_worker_init, initargs=(self.slam,))
+        shards = [args[i::self.num_workers] for i in range(self.num_workers)]
+        shard_results = list(self._pool.map(_worker_update, shards))
+        results = [None] * len(args)
+        for i, shard_result in enumerate(shard_results):
+            results[i::self.num_workers] = shard_result
+        return results
+
+    def weights(self) -> np.ndarray:
+        w = np.exp(self.log_weights - self.log_weights.max())
+        return w / w.sum()
+
+    def effective_sample_size(self) -> float:
+        w = self.weights()
+        return 1 / (w @ w)
+
+    def resample(self):
+        """Systematic resampling, the maps of duplicated particles share their chunks."""
+        w = self.weights()
+        positions = (self._rng.random() + np.arange(self.num_particles)) / self.num_particles
+        parents = np.minimum(np.searchsorted(np.cumsum(w), positions), self.num_particles - 1)
+        counts = np.bincount(parents, minlength=self.num_particles)
+
+        maps = []
+        for p in parents:
+            maps.append(self.maps[p] if counts[p] == 1 else self.maps[p].copy())
+        self.maps = maps
+        self.poses = self.poses[parents]
+        self.log_weights = np.zeros(self.num_particles)
+        self.num_resamplings += 1
+
+    def estimate(self) -> Tuple[np.ndarray, np.ndarray]:
+        """The weighted mean pose and the map of the most likely particle.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray], shapes=(3,), (#landmarks, 2)
+        """
+        w = self.weights()
+        x = np.empty(3)
+        x[:2] = w @ self.poses[:, :2]
+        x[2] = np.arctan2(w @ np.sin(self.poses[:, 2]), w @ np.cos(self.poses[:, 2]))
+        return x, self.maps[int(np.argmax(w))].all_means()
+
+    def pose_covariance(self) -> np.ndarray:
+        """The weighted sample covariance of the poses around estimate()[0]."""
+        w = self.weights()
+        d = self.poses - self.estimate()[0]
+        d[:, 2] = utils.wrapToPi(d[:, 2])
+        return (w[:, None] * d).T @ d
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
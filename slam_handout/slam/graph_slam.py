@@ -0,0 +1,393 @@
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+import time
+import numpy as np
+import scipy.linalg as la
+import scipy.sparse as sparse
+import scipy.sparse.linalg as spla
+from EKFSLAM import EKFSLAM
+import utils
+
+
+def landmark_ids(associations: List[np.ndarray], num_landmarks0: int = 0) -> List[np.ndarray]:
+    """The landmark index of every measurement of a filter run.
+
+    The unassociated measurements (-1) get the indices of the landmarks EKFSLAM.update
+    creates from them, in the same order.
+
+    Parameters
+    ----------
+    associations : List[np.ndarray]
+        the associations returned by update, in the order of the updates
+    num_landmarks0 : int, optional
+        the number of landmarks before the first update, by default 0
+
+    Returns
+    -------
+    List[np.ndarray]
+        the landmark index of each measurement of each update
+    """
+    ids = []
+    numLmk = num_landmarks0
+    for a in associations:
+        ids_k = np.array(a, dtype=int)
+        is_new = ids_k == -1
+        num_new = np.count_nonzero(is_new)
+        ids_k[is_new] = numLmk + np.arange(num_new)
+        numLmk += num_new
+        ids.append(ids_k)
+    return ids
+
+
+@dataclass
+class GraphRecorder:
+    """Records the odometry and the associated measurements of a filter run for GraphSLAM.
+
+    Call odometry for every odometry increment given to the filter, and scan after every
+    update. Pose 0 is the initial state x0, pose t > 0 the state at scan t - 1.
+
+    Example
+    -------
+    recorder = GraphRecorder(eta[:3])
+    recorder.odometry(z_odo)
+    eta, P = slam.predict(eta, P, z_odo)
+    eta, P, NIS, a = slam.update(eta, P, z)
+    recorder.scan(eta, z, a)
+    """
+
+    x0: np.ndarray
+    # the odometry increments from pose t - 1 to pose t, odos[0] is empty
+    odos: List[np.ndarray] = field(default_factory=list)
+    # the filter estimates of the poses
+    poses: List[np.ndarray] = field(default_factory=list)
+    z: List[np.ndarray] = field(default_factory=list)
+    a: List[np.ndarray] = field(default_factory=list)
+    _pending: List[np.ndarray] = field(default_factory=list, repr=False)
+
+    def __post_init__(self):
+        self.x0 = np.array(self.x0[:3], dtype=float)
+        self.odos.append(np.zeros((0, 3)))
+        self.poses.append(self.x0)
+        self.z.append(np.zeros((0, 2)))
+        self.a.append(np.zeros(0, dtype=int))
+
+    def odometry(self, z_odo: np.ndarray):
+        self._pending.append(np.asarray(z_odo, dtype=float))
+
+    def scan(self, eta: np.ndarray, z: np.ndarray, a: np.ndarray):
+        """Close the odometry since the last scan and record the measurements of this scan."""
+        self.odos.append(np.array(self._pending).reshape(-1, 3))
+        self._pending = []
+        self.poses.append(np.array(eta[:3], dtype=float))
+        self.z.append(np.asarray(z, dtype=float).reshape(-1, 2))
+        self.a.append(np.asarray(a, dtype=int))
+
+
+@dataclass
+class GraphSLAM:
+    """Batch SLAM over all the poses and landmarks, with the models and noise of an EKFSLAM.
+
+    The factors are
+    - a prior on pose 0 with standard deviations prior_std,
+    - odometry between consecutive poses: the composed odometry in the frame of the first
+      pose, with the composed Q noise, see EKFSLAM.compose_odometry,
+    - range and bearing measurements of the landmarks with the R noise, as in EKFSLAM.h.
+
+    The least squares problem is solved by Gauss-Newton or Levenberg-Marquardt. The normal
+    equations are sparse and solved with a sparse LU factorization with a fill-reducing
+    (minimum degree) ordering, or the whitened Jacobian with LSQR. Each iteration
+    linearizes all the factors and solves once, the time it took is in stats.
+
+    Example
+    -------
+    graph = GraphSLAM.from_recording(slam, recorder, eta[3:].reshape(-1, 2))
+    graph.optimize()
+    graph.poses, graph.landmarks
+    """
+
+    slam: EKFSLAM
+    # (#poses, 3) and (#landmarks, 2), the linearization points, updated by optimize
+    poses: np.ndarray
+    landmarks: np.ndarray
+    # the odometry factor e is between pose e and e + 1, (#poses - 1, 3)
+    odo_u: np.ndarray
+    # whitening of the odometry factors, L^-1 with L L^T the composed noise, (#poses - 1, 3, 3)
+    odo_white: np.ndarray
+    # the pose, landmark and measurement of each measurement factor, (#meas,), (#meas,), (#meas, 2)
+    meas_pose: np.ndarray
+    meas_lmk: np.ndarray
+    meas_z: np.ndarray
+    prior: np.ndarray = field(default_factory=lambda: np.zeros(3))
+    prior_std: np.ndarray = field(default_factory=lambda: np.array([1e-3, 1e-3, 1e-4]))
+    # per iteration: cost, damping, step size and time
+    stats: List[Dict[str, float]] = field(default_factory=list)
+
+    @classmethod
+    def from_recording(
+        cls, slam: EKFSLAM, recorder: GraphRecorder, landmarks: np.ndarray,
+        min_var: float = 1e-12, **kwargs
+    ) -> "GraphSLAM":
+        """Build the graph of a recorded run, with the filter estimates as initial values.
+
+        Parameters
+        ----------
+        slam : EKFSLAM
+            the filter that was run, for the models and noise
+        recorder : GraphRecorder
+            the recorded run
+        landmarks : np.ndarray, shape=(#landmarks, 2)
+            the final landmark estimates of the filter
+        min_var : float, optional
+            added to the variances of the odometry factors, as there might be no odometry
+            between two scans, by default 1e-12
+        """
+        odo_u = np.empty((len(recorder.odos) - 1, 3))
+        odo_cov = np.empty((len(recorder.odos) - 1, 3, 3))
+        for e, z_odos in enumerate(recorder.odos[1:]):
+            odo_u[e], _, odo_cov[e] = slam.compose_odometry(np.zeros(3), z_odos)
+        odo_cov += min_var * np.eye(3)
+        odo_white = np.linalg.inv(np.linalg.cholesky(odo_cov))
+
+        ids = landmark_ids(recorder.a)
+        meas_pose = np.repeat(np.arange(len(ids)), [len(ids_t) for ids_t in ids])
+
+        return cls(
+            slam,
+            np.array(recorder.poses),
+            np.array(landmarks, dtype=float).reshape(-1, 2),
+            odo_u,
+            odo_white,
+            meas_pose,
+            np.concatenate(ids),
+            np.concatenate(recorder.z),
+            prior=recorder.x0.copy(),
+            **kwargs,
+        )
+
+    @property
+    def num_variables(self) -> int:
+        return 3 * self.poses.shape[0] + 2 * self.landmarks.shape[0]
+
+    def unpack(self, x: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        num_poses = self.poses.shape[0]
+        return x[:3 * num_poses].reshape(-1, 3), x[3 * num_poses:].reshape(-1, 2)
+
+    def pack(self) -> np.ndarray:
+        return np.concatenate((self.poses.ravel(), self.landmarks.ravel()))
+
+    def linearize(self, x: np.ndarray, jacobian: bool = True) -> Tuple[np.ndarray, Optional[sparse.csr_matrix]]:
+        """The whitened residuals at x, and their sparse Jacobian if jacobian.
+
+        The residuals are ordered as [prior, odometry, measurements].
+        """
+        poses, lmks = self.unpack(x)
+        num_poses = poses.shape[0]
+        r_parts = []
+        rows, cols, vals = [], [], []
+
+        # prior on pose 0
+        r_prior = poses[0] - self.prior
+        r_prior[2] = utils.wrapToPi(r_prior[2])
+        r_parts.append(r_prior / self.prior_std)
+        if jacobian:
+            rows.append(np.arange(3))
+            cols.append(np.arange(3))
+            vals.append(1 / self.prior_std)
+
+        # odometry, r = [R_i^T (p_j - p_i); psi_j - psi_i] - u
+        xi = poses[:-1]
+        xj = poses[1:]
+        num_odo = xi.shape[0]
+        c = np.cos(xi[:, 2])
+        s = np.sin(xi[:, 2])
+        d = xj[:, :2] - xi[:, :2]
+        r_odo = np.empty((num_odo, 3))
+        r_odo[:, 0] = c * d[:, 0] + s * d[:, 1] - self.odo_u[:, 0]
+        r_odo[:, 1] = -s * d[:, 0] + c * d[:, 1] - self.odo_u[:, 1]
+        r_odo[:, 2] = utils.wrapToPi(xj[:, 2] - xi[:, 2] - self.odo_u[:, 2])
+        r_parts.append(np.einsum("eij,ej->ei", self.odo_white, r_odo).ravel())
+
+        if jacobian:
+            Ji = np.zeros((num_odo, 3, 3))
+            Ji[:, 0, 0] = -c
+            Ji[:, 0, 1] = -s
+            Ji[:, 0, 2] = -s * d[:, 0] + c * d[:, 1]
+            Ji[:, 1, 0] = s
+            Ji[:, 1, 1] = -c
+            Ji[:, 1, 2] = -c * d[:, 0] - s * d[:, 1]
+            Ji[:, 2, 2] = -1
+            Jj = np.zeros((num_odo, 3, 3))
+            Jj[:, 0, 0] = c
+            Jj[:, 0, 1] = s
+            Jj[:, 1, 0] = -s
+            Jj[:, 1, 1] = c
+            Jj[:, 2, 2] = 1
+            row0 = 3 + 3 * np.arange(num_odo)
+            for J, pose0 in ((Ji, np.arange(num_odo)), (Jj, np.arange(1, num_poses))):
+                block_rows, block_cols = np.meshgrid(np.arange(3), np.arange(3), indexing="ij")
+                rows.append((row0[:, None, None] + block_rows).ravel())
+                cols.append((3 * pose0[:, None, None] + block_cols).ravel())
+                vals.append((self.odo_white @ J).ravel())
+
+        # measurements, see EKFSLAM.h
+        r_meas, J_meas_pose, J_meas_lmk = self.measurement_residuals(
+            poses[self.meas_pose], lmks[self.meas_lmk], self.meas_z, jacobian)
+        # whiten with the Cholesky factor of R
+        R_white = la.inv(la.cholesky(self.slam.R, lower=True))
+        r_parts.append((r_meas @ R_white.T).ravel())
+
+        r = np.concatenate(r_parts)
+        if not jacobian:
+            return r, None
+
+        num_meas = self.meas_pose.shape[0]
+        row0 = 3 + 3 * num_odo + 2 * np.arange(num_meas)
+        lmk0 = 3 * num_poses + 2 * self.meas_lmk
+        for J, col0, width in ((J_meas_pose, 3 * self.meas_pose, 3), (J_meas_lmk, lmk0, 2)):
+            block_rows, block_cols = np.meshgrid(np.arange(2), np.arange(width), indexing="ij")
+            rows.append((row0[:, None, None] + block_rows).ravel())
+            cols.append((col0[:, None, None] + block_cols).ravel())
+            vals.append((R_white @ J).ravel())
+
+        J = sparse.csr_matrix(
+            (np.concatenate(vals), (np.concatenate(rows), np.concatenate(cols))),
+            shape=(r.shape[0], self.num_variables),
+        )
+        return r, J
+
+    def measurement_residuals(
+        self, x: np.ndarray, lmk: np.ndarray, z: np.ndarray, jacobian: bool = True
+    ) -> Tuple[np.ndarray, Optional[np.ndarray], Optional[np.ndarray]]:
+        """Range and bearing residuals h(x, lmk) - z, and their Jacobians wrt. x and lmk.
+
+        Vectorized over the measurements, the model is the one in EKFSLAM.h and EKFSLAM.h_jac.
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray, np.ndarray], shapes=(#meas, 2), (#meas, 2, 3), (#meas, 2, 2)
+        """
+        c = np.cos(x[:, 2])
+        s = np.sin(x[:, 2])
+        d = lmk - x[:, :2]
+        offset = self.slam.sensor_offset
+
+        # landmark in the sensor frame, R^T (lmk - p) - offset
+        zc = np.empty_like(d)
+        zc[:, 0] = c * d[:, 0] + s * d[:, 1] - offset[0]
+        zc[:, 1] = -s * d[:, 0] + c * d[:, 1] - offset[1]
+        zr2 = (zc ** 2).sum(axis=1)
+        zr = np.sqrt(zr2)
+
+        r = np.empty_like(z)
+        r[:, 0] = zr - z[:, 0]
+        r[:, 1] = utils.wrapToPi(np.arctan2(zc[:, 1], zc[:, 0]) - z[:, 1])
+        if not jacobian:
+            return r, None, None
+
+        # d zpolar / d zc
+        Jpolar = np.empty((z.shape[0], 2, 2))
+        Jpolar[:, 0, 0] = zc[:, 0] / zr
+        Jpolar[:, 0, 1] = zc[:, 1] / zr
+        Jpolar[:, 1, 0] = -zc[:, 1] / zr2
+        Jpolar[:, 1, 1] = zc[:, 0] / zr2
+
+        # d zc / d lmk = R^T, d zc / d p = -R^T
+        RT = np.empty((z.shape[0], 2, 2))
+        RT[:, 0, 0] = c
+        RT[:, 0, 1] = s
+        RT[:, 1, 0] = -s
+        RT[:, 1, 1] = c
+        J_lmk = Jpolar @ RT
+
+        J_x = np.empty((z.shape[0], 2, 3))
+        J_x[:, :, :2] = -J_lmk
+        dzc_dpsi = np.stack((-s * d[:, 0] + c * d[:, 1], -c * d[:, 0] - s * d[:, 1]), axis=1)
+        J_x[:, :, 2] = (Jpolar @ dzc_dpsi[:, :, None])[:, :, 0]
+
+        return r, J_x, J_lmk
+
+    def optimize(
+        self,
+        max_iterations: int = 20,
+        method: str = "lm",
+        solver: str = "splu",
+        tol: float = 1e-6,
+        damping: float = 1e-4,
+    ) -> List[Dict[str, float]]:
+        """Optimize the poses and landmarks, in place.
+
+        Parameters
+        ----------
+        max_iterations : int, optional
+            by default 20
+        method : str, optional
+            "lm" for Levenberg-Marquardt or "gn" for Gauss-Newton, by default "lm"
+        solver : str, optional
+            "splu" for a sparse factorization of the normal equations with a minimum degree
+            ordering, or "lsqr" for LSQR on the whitened Jacobian, by default "splu"
+        tol : float, optional
+            stop when the relative decrease of the cost is below this, by default 1e-6
+        damping : float, optional
+            the initial Levenberg-Marquardt damping, by default 1e-4
+
+        Returns
+        -------
+        List[Dict[str, float]]
+            the statistics of each iteration, also in self.stats
+        """
+        if method not in ("lm", "gn"):
+            raise ValueError(f"GraphSLAM.optimize: unknown method {method}")
+        if solver not in ("splu", "lsqr"):
+            raise ValueError(f"GraphSLAM.optimize: unknown solver {solver}")
+
+        x = self.pack()
+        r, J = self.linearize(x)
+        cost = r @ r / 2
+        lam = damping if method == "lm" else 0
+        heading_inds = 3 * np.arange(self.poses.shape[0]) + 2
+
+        for iteration in range(max_iterations):
+            t0 = time.perf_counter()
+            dx = self.solve_step(r, J, lam, solver)
+
+            xnew = x + dx
+            xnew[heading_inds] = utils.wrapToPi(xnew[heading_inds])
+            rnew, _ = self.linearize(xnew, jacobian=False)
+            costnew = rnew @ rnew / 2
+
+            accepted = method == "gn" or costnew < cost
+            self.stats.append(dict(
+                iteration=iteration, cost=costnew if accepted else cost, damping=lam,
+                step=float(np.abs(dx).max()), accepted=accepted, time=time.perf_counter() - t0,
+            ))
+            if not accepted:
+                lam *= 10
+                continue
+
+            converged = cost - costnew <= tol * cost
+            x = xnew
+            cost = costnew
+            lam /= 10
+            if converged:
+                break
+            r, J = self.linearize(x)
+
+        self.poses, self.landmarks = (v.copy() for v in self.unpack(x))
+        return self.stats
+
+    def solve_step(self, r: np.ndarray, J: sparse.csr_matrix, lam: float, solver: str) -> np.ndarray:
+        """The (damped) Gauss-Newton step, (J^T J + lam diag(J^T J)) dx = -J^T r."""
+        if solver == "lsqr":
+            # scale the columns to unit norm, which preconditions LSQR and makes its
+            # identity damping the same as lam diag(J^T J)
+            col_scale = 1 / np.sqrt(np.asarray(J.multiply(J).sum(axis=0)).ravel())
+            Js = J @ sparse.diags(col_scale)
+            y = spla.lsqr(Js, -r, damp=np.sqrt(lam), atol=1e-12, btol=1e-12)[0]
+            return col_scale * y
+
+        H = (J.T @ J).tocsc()
+        g = J.T @ r
+        if lam > 0:
+            H = H + lam * sparse.diags(H.diagonal())
+        lu = spla.splu(H, permc_spec="MMD_AT_PLUS_A")
+        return lu.solve(-g)
@@ -0,0 +1,143 @@
+from typing import Dict, List, Optional, Tuple
+from dataclasses import dataclass, field
+from pathlib import Path
+import numpy as np
+
+
+@dataclass
+class SLAMHistory:
+    """Records the SLAM estimates over a run without keeping every full covariance.
+
+    The pose mean and covariance are always stored, in preallocated arrays. The landmark
+    means and their 2x2 marginal covariances are stored per step when record_landmarks is
+    set, which is what the movie and the ellipse plots need, O(#landmarks) per step.
+    The full eta and P are only stored at the checkpoints: every checkpoint_every step,
+    and the steps given to record with checkpoint=True. With spill_dir the checkpoints
+    are written to .npy files there and memory mapped instead of kept in memory.
+
+    When the full P is expensive to form, as for SEIFSLAM, record can be given only the
+    pose covariance, and P only where needs_covariance says it is used.
+
+    Example
+    -------
+    history = SLAMHistory(K, checkpoint_every=100)
+    for k in range(K):
+        ...
+        history.record(k, eta, P, checkpoint=k == K - 1)
+    eta_final, P_final = history.checkpoint(K - 1)
+    """
+
+    K: int
+    checkpoint_every: Optional[int] = None
+    record_landmarks: bool = False
+    spill_dir: Optional[Path] = None
+    pose: np.ndarray = field(init=False, repr=False)
+    pose_cov: np.ndarray = field(init=False, repr=False)
+    num_landmarks: np.ndarray = field(init=False, repr=False)
+    _landmarks: List[Optional[np.ndarray]] = field(init=False, repr=False)
+    _landmark_covs: List[Optional[np.ndarray]] = field(init=False, repr=False)
+    _checkpoints: Dict[int, Tuple[np.ndarray, np.ndarray]] = field(
+        init=False, repr=False)
+
+    def __post_init__(self):
+        self.pose = np.full((self.K, 3), np.nan)
+        self.pose_cov = np.full((self.K, 3, 3), np.nan)
+        self.num_landmarks = np.zeros(self.K, dtype=int)
+        self._landmarks = [None] * self.K if self.record_landmarks else []
+        self._landmark_covs = [None] * self.K if self.record_landmarks else []
+        self._checkpoints = {}
+        if self.spill_dir is not None:
+            self.spill_dir = Path(self.spill_dir)
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+
+    def needs_covariance(self, k: int, checkpoint: bool = False) -> bool:
+        """If record of step k with checkpoint uses the full P, not only the pose covariance."""
+        return self.record_landmarks or self.is_checkpoint(k, checkpoint)
+
+    def is_checkpoint(self, k: int, checkpoint: bool = False) -> bool:
+        return checkpoint or (self.checkpoint_every is not None and k % self.checkpoint_every == 0)
+
+    def record(
+        self, k: int, eta: np.ndarray, P: Optional[np.ndarray], checkpoint: bool = False,
+        pose_cov: Optional[np.ndarray] = None
+    ):
+        """Record the estimate of step k, the arrays are copied.
+
+        Parameters
+        ----------
+        k : int
+            the time step
+        eta : np.ndarray, shape=(3 + 2*#landmarks,)
+            the robot state and map concatenated
+        P : Optional[np.ndarray], shape=(3 + 2*#landmarks,)*2
+            the covariance of eta, may be None with pose_cov when not needs_covariance
+        checkpoint : bool, optional
+            also store eta and P in full, by default False
+        pose_cov : Optional[np.ndarray], shape=(3, 3)
+            the pose covariance, by default P[:3, :3]
+        """
+        if P is None and (pose_cov is None or self.needs_covariance(k, checkpoint)):
+            raise ValueError(f"SLAMHistory: the full covariance is needed at step {k}")
+
+        self.pose[k] = eta[:3]
+        self.pose_cov[k] = P[:3, :3] if pose_cov is None else pose_cov
+        numLmk = (eta.shape[0] - 3) // 2
+        self.num_landmarks[k] = numLmk
+
+        if self.record_landmarks:
+            self._landmarks[k] = eta[3:].reshape(-1, 2).copy()
+            self._landmark_covs[k] = self.landmark_marginals(P)
+
+        if self.is_checkpoint(k, checkpoint):
+            self.save_checkpoint(k, eta, P)
+
+    def save_checkpoint(self, k: int, eta: np.ndarray, P: np.ndarray):
+        """Store eta and P of step k in full."""
+        if self.spill_dir is None:
+            self._checkpoints[k] = (eta.copy(), P.copy())
+            return
+
+        etamm = np.lib.format.open_memmap(
+            self.spill_dir / f"eta_{k}.npy", mode="w+", dtype=eta.dtype, shape=eta.shape)
+        Pmm = np.lib.format.open_memmap(
+            self.spill_dir / f"P_{k}.npy", mode="w+", dtype=P.dtype, shape=P.shape)
+        etamm[:] = eta
+        Pmm[:] = P
+        etamm.flush()
+        Pmm.flush()
+        self._checkpoints[k] = (etamm, Pmm)
+
+    def checkpoints(self) -> List[int]:
+        """The steps with a full eta and P stored, sorted."""
+        return sorted(self._checkpoints)
+
+    def checkpoint(self, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """The full eta and P of step k, which has to be a checkpoint."""
+        if k not in self._checkpoints:
+            raise KeyError(f"SLAMHistory: step {k} is not a checkpoint")
+        return self._checkpoints[k]
+
+    def landmarks(self, k: int) -> np.ndarray:
+        """The landmark means of step k, shape (#landmarks, 2)."""
+        if k in self._checkpoints:
+            return self._checkpoints[k][0][3:].reshape(-1, 2)
+        if self.record_landmarks and self._landmarks[k] is not None:
+            return self._landmarks[k]
+        raise KeyError(
+            f"SLAMHistory: landmarks of step {k} not recorded, use record_landmarks or a checkpoint")
+
+    def landmark_covs(self, k: int) -> np.ndarray:
+        """The 2x2 marginal covariances of the landmarks of step k, shape (#landmarks, 2, 2)."""
+        if k in self._checkpoints:
+            return self.landmark_marginals(self._checkpoints[k][1])
+        if self.record_landmarks and self._landmark_covs[k] is not None:
+            return self._landmark_covs[k]
+        raise KeyError(
+            f"SLAMHistory: landmarks of step {k} not recorded, use record_landmarks or a checkpoint")
+
+    @staticmethod
+    def landmark_marginals(P: np.ndarray) -> np.ndarray:
+        """The 2x2 diagonal blocks of the map part of P, shape (#landmarks, 2, 2)."""
+        numLmk = (P.shape[0] - 3) // 2
+        idxs = 3 + 2 * np.arange(numLmk)[:, None] + np.arange(2)
+        return P[idxs[:, :, None], idxs[:, None, :]]
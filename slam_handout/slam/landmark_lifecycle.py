@@ -0,0 +1,179 @@
+from typing import Optional, Tuple
+from dataclasses import dataclass, field
+import numpy as np
+import scipy.linalg as la
+from scipy.spatial import cKDTree
+from scipy.stats import chi2
+from EKFSLAM import EKFSLAM
+import utils
+
+
+@dataclass
+class LandmarkLifecycle:
+    """Landmark management around EKFSLAM.update: tentative landmarks, pruning and merging.
+
+    A new landmark is tentative until it has been associated confirmations times. A
+    landmark that is in view, within sensor_range and field_of_view of the predicted
+    sensor pose, but not associated is missed. A tentative landmark missed max_misses
+    times in a row is removed, and so is a confirmed one after max_misses_confirmed
+    misses if that is set.
+
+    Landmarks closer than merge_distance whose difference passes the merge_alpha
+    Mahalanobis gate are merged: the constraint m_i = m_j is applied as a perfect
+    measurement in one update for all the pairs, and m_j removed. Landmarks associated
+    in the same scan are never merged.
+
+    The removals are done in one compaction of eta and P per update, see
+    EKFSLAM.remove_landmarks. index_map maps the landmark indices before the last
+    update to the ones after, -1 for removed landmarks. The landmarks of an eta that
+    already has a map at the first update are taken as confirmed.
+
+    Example
+    -------
+    lifecycle = LandmarkLifecycle(slam, confirmations=3, max_misses=2)
+    eta, P, NIS, a = lifecycle.update(eta, P, z)
+    eta_confirmed = eta[lifecycle.confirmed_state_inds()]
+    """
+
+    slam: EKFSLAM
+    confirmations: int = 3
+    max_misses: int = 3
+    max_misses_confirmed: Optional[int] = None
+    sensor_range: float = 80.0
+    field_of_view: float = np.pi
+    merge_distance: float = 1.0
+    merge_alpha: float = 0.01
+    num_removed: int = 0
+    num_merged: int = 0
+    # per landmark: the number of associations and consecutive misses, and if confirmed
+    hits: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=int))
+    misses: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=int))
+    confirmed: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=bool))
+    index_map: np.ndarray = field(default_factory=lambda: np.zeros(0, dtype=int))
+
+    def update(
+        self, eta: np.ndarray, P: np.ndarray, z: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray, float, np.ndarray]:
+        """EKFSLAM.update followed by the landmark management.
+
+        Parameters and returns are as for EKFSLAM.update, but the associations are to
+        the landmark indices after the update, which change when landmarks are removed.
+        """
+        numLmk0 = (eta.shape[0] - 3) // 2
+        if self.hits.shape[0] == 0 and numLmk0 > 0:
+            # started with a map, its landmarks are taken as confirmed
+            self.hits = np.full(numLmk0, self.confirmations)
+            self.misses = np.zeros(numLmk0, dtype=int)
+            self.confirmed = np.ones(numLmk0, dtype=bool)
+        assert self.hits.shape[0] == numLmk0, (
+            f"LandmarkLifecycle.update: {numLmk0} landmarks in eta, {self.hits.shape[0]} tracked")
+        in_view = self.in_view(eta)
+
+        eta, P, NIS, a = self.slam.update(eta, P, z)
+
+        # bookkeeping of the landmarks before the update
+        associated = np.zeros(numLmk0, dtype=bool)
+        associated[a[a > -1]] = True
+        self.hits[associated] += 1
+        self.misses[associated] = 0
+        self.misses[in_view & ~associated] += 1
+        self.confirmed |= self.hits >= self.confirmations
+
+        # the landmarks added by the update
+        numNew = (eta.shape[0] - 3) // 2 - numLmk0
+        self.hits = np.append(self.hits, np.ones(numNew, dtype=int))
+        self.misses = np.append(self.misses, np.zeros(numNew, dtype=int))
+        self.confirmed = np.append(self.confirmed, np.full(numNew, self.confirmations <= 1))
+        associated = np.append(associated, np.ones(numNew, dtype=bool))
+
+        remove = ~self.confirmed & (self.misses >= self.max_misses)
+        if self.max_misses_confirmed is not None:
+            remove |= self.confirmed & (self.misses >= self.max_misses_confirmed)
+
+        numLmk = self.hits.shape[0]
+        self.index_map = np.arange(numLmk)
+        eta, P = self.merge(eta, P, remove, associated)
+
+        removed = np.flatnonzero(remove)
+        if removed.shape[0] > 0:
+            eta, P = self.slam.remove_landmarks(eta, P, removed)
+            kept = ~remove
+            new_inds = np.cumsum(kept) - 1
+            self.index_map = np.where(kept[self.index_map], new_inds[self.index_map], -1)
+            self.hits = self.hits[kept]
+            self.misses = self.misses[kept]
+            self.confirmed = self.confirmed[kept]
+            self.num_removed += removed.shape[0]
+
+        a = np.where(a > -1, self.index_map[np.maximum(a, 0)], -1)
+        return eta, P, NIS, a
+
+    def in_view(self, eta: np.ndarray) -> np.ndarray:
+        """The landmarks within sensor_range and field_of_view of the sensor, shape (#landmarks,)."""
+        if eta.shape[0] == 3:
+            return np.zeros(0, dtype=bool)
+        zpred = self.slam.h(eta).reshape(-1, 2)
+        return (zpred[:, 0] <= self.sensor_range) & (
+            np.abs(utils.wrapToPi(zpred[:, 1])) <= self.field_of_view / 2)
+
+    def merge(
+        self, eta: np.ndarray, P: np.ndarray, remove: np.ndarray, associated: np.ndarray
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        """Merge the duplicate landmarks, marking the merged away ones in remove.
+
+        The candidates are the pairs closer than merge_distance, and each landmark is in at
+        most one merge per call, taking the pairs in order of increasing Mahalanobis distance.
+        """
+        lmks = eta[3:].reshape(-1, 2)
+        pairs = cKDTree(lmks).query_pairs(self.merge_distance, output_type="ndarray")
+        if pairs.shape[0] == 0:
+            return eta, P
+        pairs = pairs[~remove[pairs].any(axis=1) & ~associated[pairs].all(axis=1)]
+
+        # Mahalanobis distance of m_i - m_j
+        inds = 3 + 2 * pairs[:, :, None] + np.arange(2)
+        ii = inds[:, 0]
+        jj = inds[:, 1]
+        d = lmks[pairs[:, 0]] - lmks[pairs[:, 1]]
+        D = (P[ii[:, :, None], ii[:, None, :]] + P[jj[:, :, None], jj[:, None, :]]
+             - P[ii[:, :, None], jj[:, None, :]] - P[jj[:, :, None], ii[:, None, :]])
+        dist2 = (d[:, None, :] @ np.linalg.solve(D, d[:, :, None]))[:, 0, 0]
+        gate = chi2.isf(self.merge_alpha, 2)
+
+        merge = []
+        used = np.zeros(lmks.shape[0], dtype=bool)
+        for p in np.argsort(dist2):
+            if dist2[p] > gate:
+                break
+            i, j = pairs[p]
+            if not used[i] and not used[j]:
+                merge.append(p)
+                used[i] = used[j] = True
+        if len(merge) == 0:
+            return eta, P
+
+        # m_i - m_j = 0 as a noise free measurement of all the merged pairs at once,
+        # the same Cholesky form as EKFSLAM.update with H = [I at i, -I at j]
+        ii = ii[merge].ravel()
+        jj = jj[merge].ravel()
+        HP = P[ii] - P[jj]
+        D = HP[:, ii] - HP[:, jj]
+        D_chol = la.cholesky((D + D.T) / 2, lower=True)
+        B = la.solve_triangular(D_chol, HP, lower=True)
+        v_white = la.solve_triangular(D_chol, eta[jj] - eta[ii], lower=True)
+        eta = eta + B.T @ v_white
+        P = P - B.T @ B
+
+        for i, j in pairs[merge]:
+            remove[j] = True
+            self.index_map[j] = i
+            self.hits[i] += self.hits[j]
+            self.confirmed[i] |= self.confirmed[j]
+        self.num_merged += len(merge)
+
+        return eta, P
+
+    def confirmed_state_inds(self) -> np.ndarray:
+        """The indices into eta of the robot and the confirmed landmarks."""
+        lmks = np.flatnonzero(self.confirmed)
+        return np.concatenate((np.arange(3), (3 + 2 * lmks[:, None] + np.arange(2)).ravel()))
@@ -0,0 +1,70 @@
+from typing import Tuple
+import numpy as np
+from dataclasses import dataclass, field
+from EKFSLAM import EKFSLAM
+
+
+@dataclass
+class OdometryBuffer:
+    """Composes odometry increments so that P only is touched when it is needed.
+
+    Each push is O(1): the robot pose, the Jacobian of the composed prediction wrt.
+    the robot state at the start of the buffer and the accumulated process noise are
+    kept in closed form as 3x3 quantities. flush applies them to the 3 x n robot strip
+    of P once, right before an update or anything else that needs the full state.
+    """
+
+    slam: EKFSLAM
+    x: np.ndarray = field(default_factory=lambda: np.zeros(3))
+    F: np.ndarray = field(default_factory=lambda: np.eye(3))
+    Qc: np.ndarray = field(default_factory=lambda: np.zeros((3, 3)))
+    count: int = 0
+
+    def push(self, eta: np.ndarray, z_odo: np.ndarray) -> np.ndarray:
+        """Add the odometry z_odo to the buffer.
+
+        Parameters
+        ----------
+        eta : np.ndarray, shape=(3 + 2*#landmarks,)
+            the robot state and map concatenated, only read when the buffer is empty
+        z_odo : np.ndarray, shape=(3,)
+            the measured odometry
+
+        Returns
+        -------
+        np.ndarray, shape=(3,)
+            the predicted robot state including all the buffered odometry
+        """
+        if self.count == 0:
+            self.x = eta[:3].copy()
+
+        self.x, self.F, self.Qc = self.slam.compose_step(self.x, self.F, self.Qc, z_odo)
+        self.count += 1
+
+        return self.x
+
+    def flush(self, eta: np.ndarray, P: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Apply the buffered odometry to eta and P in place and empty the buffer.
+
+        Parameters
+        ----------
+        eta : np.ndarray, shape=(3 + 2*#landmarks,)
+            the robot state and map concatenated
+        P : np.ndarray, shape=(3 + 2*#landmarks,)*2
+            the covariance of eta
+
+        Returns
+        -------
+        Tuple[np.ndarray, np.ndarray], shapes= (3 + 2*#landmarks,), (3 + 2*#landmarks,)*2
+            predicted mean and covariance of eta, the same arrays as the input.
+        """
+        if self.count > 0:
+            self.slam.validation.check("OdometryBuffer.flush input", eta, P)
+            self.slam.predict_robot(eta, P, self.x, self.F, self.Qc)
+            self.slam.validation.check("OdometryBuffer.flush", eta, P)
+
+            self.F = np.eye(3)
+            self.Qc = np.zeros((3, 3))
+            self.count = 0
+
+        return eta, P
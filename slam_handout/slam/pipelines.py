@@ -0,0 +1,173 @@
+from typing import Any, Callable, Dict, Optional, Tuple
+import numpy as np
+from scheduler import EventScheduler, interpolate_poses
+from vp_utils import odometry, Car
+
+# the tuned parameters of run_simulated_SLAM and run_real_SLAM, also the defaults of sweep
+PIPELINE_DEFAULTS: Dict[str, Dict[str, Any]] = {
+    "simulated": dict(
+        Q=np.diag([0.025, 0.025, 0.4 * np.pi / 180]) ** 2,
+        R=np.diag([0.1, 1 * np.pi / 180]) ** 2,
+        # first is for joint compatibility, second is individual
+        alphas=np.array([1e-2, 1e-3]),
+    ),
+    "real": dict(
+        # sigmas 2.5e-6, 1.25e-6 and 0.15 deg with correlation 0.9 between y and heading
+        Q=(np.diag([2.5e-6, 1.25e-6, 0.15 * np.pi / 180])
+           @ np.array([[1, 0, 0], [0, 1, 0.9], [0, 0.9, 1]])
+           @ np.diag([2.5e-6, 1.25e-6, 0.15 * np.pi / 180])),
+        R=np.diag([1.5, 2 * np.pi / 180]) ** 2,
+        alphas=np.array([1e-7, 1e-8]),
+        # axel distance, center to wheel encoder, laser distance in front of first axel
+        # and to the left of center
+        car=Car(2.83, 0.76, 0.95, 0.5),
+        heading0=36 * np.pi / 180,
+        # the first laser scan used, the first seems to be a bit off in timing
+        mk_first=1,
+    ),
+}
+
+
+def real_initial_state(Lo_m: np.ndarray, La_m: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """The initial eta and P of run_real_SLAM, at the start of the GPS track."""
+    eta = np.array([Lo_m[0], La_m[1], PIPELINE_DEFAULTS["real"]["heading0"]])
+    return eta, np.zeros((3, 3))
+
+
+def simulated_loop(
+    slam,
+    eta: np.ndarray,
+    P: np.ndarray,
+    z: np.ndarray,
+    z_offsets: np.ndarray,
+    odometry_sim: np.ndarray,
+    on_update: Callable[..., None],
+    N: int,
+    progress: Optional[Callable] = None,
+) -> Tuple[np.ndarray, Any]:
+    """The filter loop of run_simulated_SLAM, an update with the scan of each step and a predict.
+
+    Parameters
+    ----------
+    slam : EKFSLAM
+        or a filter with the same update and predict, e.g. SEIFSLAM
+    eta, P : np.ndarray
+        the initial state and its covariance (or information)
+    z, z_offsets : np.ndarray
+        the measurements of step k are z[z_offsets[k]:z_offsets[k + 1]]
+    odometry_sim : np.ndarray, shape=(K, 3)
+        the odometry from step k to k + 1
+    on_update : Callable
+        on_update(k, eta_pred, eta, P, NIS, a) after the update of step k, before the
+        predict, which changes P in place
+    N : int
+        the number of steps
+    progress : Optional[Callable], optional
+        e.g. tqdm, see EventScheduler.run
+
+    Returns
+    -------
+    Tuple[np.ndarray, Any]
+        eta and P after the update of the last step
+    """
+    def on_step(k, t):
+        nonlocal eta, P
+        eta_pred = eta
+        eta, P, NIS, a = slam.update(eta_pred, P, z[z_offsets[k]:z_offsets[k + 1]])
+        on_update(k, eta_pred, eta, P, NIS, a)
+        if k < N - 1:
+            # predict works in place, copy eta to keep the updated one
+            eta, P = slam.predict(eta.copy(), P, odometry_sim[k])
+
+    # the simulated measurements and odometry come together at each step
+    scheduler = EventScheduler()
+    scheduler.add_stream("step", np.arange(N), on_step)
+    scheduler.run(progress=progress)
+    return eta, P
+
+
+def real_loop(
+    data: Dict[str, np.ndarray],
+    predict: Callable[[np.ndarray], None],
+    update: Callable[[int, int, np.ndarray], None],
+    N: int,
+    car: Car = PIPELINE_DEFAULTS["real"]["car"],
+    mk_first: int = PIPELINE_DEFAULTS["real"]["mk_first"],
+    progress: Optional[Callable] = None,
+) -> Tuple[int, int]:
+    """The event loop of run_real_SLAM over the odometry and the laser scans in time order.
+
+    predict(odo) is called with the odometry of each interval between two events, and
+    update(mk, k, z) at laser scan mk with its trees z, after the odometry up to the scan,
+    which is between odometry sample k and k + 1.
+    The laser scans are handled before odometry with the same time stamp.
+
+    Parameters
+    ----------
+    data : Dict[str, np.ndarray]
+        timeOdo, speed, steering, timeLsr, trees and trees_offsets, see
+        slam_data.load_victoria_park
+    N : int
+        the last odometry sample to use, at most #odometry - 1
+
+    Returns
+    -------
+    Tuple[int, int]
+        one past the last laser scan used, and the last odometry sample used
+    """
+    timeOdo, timeLsr = data["timeOdo"], data["timeLsr"]
+    speed, steering = data["speed"], data["steering"]
+    trees, trees_offsets = data["trees"], data["trees_offsets"]
+    K = timeOdo.shape[0]
+    mK = timeLsr.shape[0]
+
+    # odometry for each step without a laser scan in between
+    odos_step = odometry(speed[1:], steering[1:], np.diff(timeOdo), car)
+    t = timeOdo[0]
+    k = 0  # the last odometry sample used
+    mk = mk_first
+
+    def on_odometry(k_odo, t_odo):
+        nonlocal t, k
+        if t == timeOdo[k_odo - 1]:
+            odo = odos_step[k_odo - 1]
+        else:  # a laser scan was handled since timeOdo[k_odo - 1]
+            odo = odometry(speed[k_odo], steering[k_odo], t_odo - t, car)
+        t = t_odo
+        k = k_odo
+        predict(odo)
+
+    def on_laser(mk_lsr, t_lsr):
+        nonlocal t, mk
+        dt = t_lsr - t
+        if dt < 0:  # avoid assertions as they can be optimized avay?
+            raise ValueError("negative time increment")
+        t = t_lsr
+        # the scan is between odometry sample k and k + 1
+        predict(odometry(speed[k + 1], steering[k + 1], dt, car))
+        update(mk_lsr, k, trees[trees_offsets[mk_lsr]:trees_offsets[mk_lsr + 1]])
+        mk = mk_lsr + 1
+
+    k_last = min(N, K - 1)
+    scheduler = EventScheduler()
+    scheduler.add_stream("laser", timeLsr, on_laser, priority=0, start=mk_first, stop=mK - 1)
+    scheduler.add_stream("odometry", timeOdo, on_odometry, priority=1, start=1, stop=k_last + 1)
+    scheduler.run(progress=progress, until=timeOdo[k_last])
+    return mk, k_last
+
+
+def gps_errors(
+    data: Dict[str, np.ndarray], t: np.ndarray, positions: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray]:
+    """The distance to the GPS of positions at times t, interpolated to the GPS times in t.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray], shapes=(#gps,), (#gps,)
+        the GPS samples within t and the errors at them
+    """
+    timeGps = data["timeGps"]
+    gps_inds = np.flatnonzero((timeGps >= t[0]) & (timeGps <= t[-1]))
+    pos_GPS = np.column_stack((data["Lo_m"][gps_inds], data["La_m"][gps_inds]))
+    pos_est = interpolate_poses(timeGps[gps_inds], t, positions)
+    return gps_inds, np.linalg.norm(pos_est - pos_GPS, axis=1)
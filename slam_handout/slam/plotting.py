@@ -1,9 +1,106 @@
+from functools import lru_cache
+from typing import Tuple
 import matplotlib.pyplot as plt
 import numpy as np
-import scipy.linalg as la
+from matplotlib.collections import LineCollection
 
 
-def ellipse(mu, P, s, n):
+@lru_cache(maxsize=8)
+def unit_circle(n: int) -> np.ndarray:
+    """n points on the unit circle, closed, shape (2, n). Shared by all the ellipses of n points."""
     thetas = np.linspace(0, 2*np.pi, n)
-    ell = mu + s * (la.cholesky(P).T @ np.array([np.cos(thetas), np.sin(thetas)])).T
-    return ell
\ No newline at end of file
+    circle = np.array([np.cos(thetas), np.sin(thetas)])
+    circle.setflags(write=False)
+    return circle
+
+
+def ellipse(mu, P, s, n):
+    return ellipses(np.asarray(mu)[None], np.asarray(P)[None], s, n)[0]
+
+
+def ellipses(mus: np.ndarray, Ps: np.ndarray, s: float, n: int) -> np.ndarray:
+    """The s sigma ellipses of all the 2D Gaussians at once.
+
+    The Cholesky factors of the 2x2 covariances are computed in closed form, with
+    degenerate directions collapsing to a line or a point instead of raising.
+
+    Parameters
+    ----------
+    mus : np.ndarray, shape=(M, 2)
+        the means
+    Ps : np.ndarray, shape=(M, 2, 2)
+        the covariances
+    s : float
+        the scaling, in standard deviations
+    n : int
+        the number of points of each ellipse
+
+    Returns
+    -------
+    np.ndarray, shape=(M, n, 2)
+        the ellipses
+    """
+    mus = np.asarray(mus).reshape(-1, 2)
+    Ps = np.asarray(Ps).reshape(-1, 2, 2)
+
+    # P = L L^T with L = [[l11, 0], [l21, l22]]
+    l11 = np.sqrt(np.maximum(Ps[:, 0, 0], 0))
+    l21 = np.divide(Ps[:, 1, 0], l11, out=np.zeros_like(l11), where=l11 > 0)
+    l22 = np.sqrt(np.maximum(Ps[:, 1, 1] - l21 ** 2, 0))
+
+    cos, sin = unit_circle(n)
+    ell = np.empty((mus.shape[0], n, 2))
+    ell[:, :, 0] = mus[:, 0, None] + s * l11[:, None] * cos
+    ell[:, :, 1] = mus[:, 1, None] + s * (l21[:, None] * cos + l22[:, None] * sin)
+    return ell
+
+
+def ellipse_collection(mus: np.ndarray, Ps: np.ndarray, s: float = 5, n: int = 100, **kwargs) -> LineCollection:
+    """The ellipses of mus and Ps as one LineCollection, kwargs are passed on to it.
+
+    Example
+    -------
+    ax.add_collection(ellipse_collection(lmks, lmk_covs, 5, colors="b"))
+    """
+    return LineCollection(ellipses(mus, Ps, s, n), **kwargs)
+
+
+def decimate(y: np.ndarray, max_points: int = 4000) -> Tuple[np.ndarray, np.ndarray]:
+    """A long time series reduced to about max_points for plotting.
+
+    The series is split into max_points / 2 buckets and the minimum and maximum of each
+    are kept in order, so peaks such as NIS outliers stay visible. NaNs are ignored.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray]
+        the time indices kept and the values at them, plot with ax.plot(k, y)
+    """
+    y = np.asarray(y)
+    K = y.shape[0]
+    if K <= max_points:
+        return np.arange(K), y
+
+    bucket = int(np.ceil(2 * K / max_points))
+    num_buckets = K // bucket
+    buckets = y[:num_buckets * bucket].reshape(num_buckets, bucket)
+    finite = np.where(np.isnan(buckets), np.nanmean(y), buckets)
+    start = bucket * np.arange(num_buckets)
+    inds = np.sort(np.column_stack((
+        start + np.argmin(finite, axis=1), start + np.argmax(finite, axis=1))), axis=1).ravel()
+    inds = np.concatenate((inds, np.arange(num_buckets * bucket, K)))
+    return inds, y[inds]
+
+
+def decimate_path(xy: np.ndarray, max_points: int = 4000) -> np.ndarray:
+    """Every few points of a path, keeping the last, so that about max_points are left."""
+    xy = np.asarray(xy)
+    step = max(1, int(np.ceil(xy.shape[0] / max_points)))
+    if step == 1:
+        return xy
+    return np.concatenate((xy[::step], xy[-1:]))
+
+
+def use_headless():
+    """Draw to files only, with the non interactive Agg backend, call before any figure is made."""
+    plt.switch_backend("Agg")
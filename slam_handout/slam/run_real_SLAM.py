@@ -1,7 +1,5 @@
 # %% Imports
-from scipy.io import loadmat
 from scipy.stats import chi2
-from pathlib import Path
 
 try:
     from tqdm import tqdm
@@ -16,11 +14,17 @@ except ImportError as e:
 
 import numpy as np
 from EKFSLAM import EKFSLAM
+from odometry_buffer import OdometryBuffer
+from compressed_ekf import CompressedEKFSLAM
+from graph_slam import GraphSLAM, GraphRecorder
+from landmark_lifecycle import LandmarkLifecycle
+from pipelines import PIPELINE_DEFAULTS, real_initial_state, real_loop, gps_errors
 import matplotlib
 import matplotlib.pyplot as plt
 from matplotlib import animation
-from plotting import ellipse
-from vp_utils import detectTrees, odometry, Car
+from plotting import ellipse, decimate, decimate_path, use_headless
+from vp_utils import odometry, deadReckoning
+from slam_data import load_victoria_park
 from utils import rotmat2d
 
 # %% plot config check and style setup
@@ -77,55 +81,33 @@ except Exception as e:
 
 def main():
     # %% Load data
-    victoria_park_foler = Path(
-        __file__).parents[1].joinpath("data/victoria_park")
-    realSLAM_ws = {
-        **loadmat(str(victoria_park_foler.joinpath("aa3_dr"))),
-        **loadmat(str(victoria_park_foler.joinpath("aa3_lsr2"))),
-        **loadmat(str(victoria_park_foler.joinpath("aa3_gpsx"))),
-    }
-
-    timeOdo = (realSLAM_ws["time"] / 1000).ravel()
-    timeLsr = (realSLAM_ws["TLsr"] / 1000).ravel()
-    timeGps = (realSLAM_ws["timeGps"] / 1000).ravel()
-
-    steering = realSLAM_ws["steering"].ravel()
-    speed = realSLAM_ws["speed"].ravel()
-    LASER = (
-        realSLAM_ws["LASER"] / 100
-    )  # Divide by 100 to be compatible with Python implementation of detectTrees
-    La_m = realSLAM_ws["La_m"].ravel()
-    Lo_m = realSLAM_ws["Lo_m"].ravel()
+    # converted from the .mat files once and memory mapped from then on, with LASER
+    # divided by 100 to be compatible with the Python implementation of detectTrees
+    # and the trees detected in all the scans, see slam_data.load_victoria_park
+    realSLAM_data = load_victoria_park()
+
+    timeOdo = realSLAM_data["timeOdo"]
+    timeLsr = realSLAM_data["timeLsr"]
+    timeGps = realSLAM_data["timeGps"]
+
+    steering = realSLAM_data["steering"]
+    speed = realSLAM_data["speed"]
+    La_m = realSLAM_data["La_m"]
+    Lo_m = realSLAM_data["Lo_m"]
 
     K = timeOdo.size
     mK = timeLsr.size
-    Kgps = timeGps.size
 
     # %% Parameters
 
-    L = 2.83  # axel distance
-    H = 0.76  # center to wheel encoder
-    a = 0.95  # laser distance in front of first axel
-    b = 0.5  # laser distance to the left of center
-
-    car = Car(L, H, a, b)
-    
-    # sigmas = np.array([2.5e-6, 1.25e-6, 0.15 * np.pi / 180])  # TODO tune, 2.5e-6, 1.25e-6, 0.15 deg
-    # CorrCoeff = np.array([[1, 0, 0], [0, 1, 0.9], [0, 0.9, 1]])
-    # Q = np.diag(sigmas) @ CorrCoeff @ np.diag(sigmas)
-    # # Q = CorrCoeff
-    # R = np.diag([0.1, 1 * np.pi / 180]) ** 2  # TODO tune, 0.1, 1 deg
-
-    # # first is for joint compatibility, second is individual
-    # JCBBalphas = np.array([1e-5, 1e-6])  # TODO tune, 1e-5, 1e-6
-    
-    sigmas = np.array([2.5e-6, 1.25e-6, 0.15 * np.pi / 180])  # TODO tune, 2.5e-6, 1.25e-6, 0.15 deg
-    CorrCoeff = np.array([[1, 0, 0], [0, 1, 0.9], [0, 0.9, 1]])
-    Q = np.diag(sigmas) @ CorrCoeff @ np.diag(sigmas)
-    R = np.diag([1.5, 2 * np.pi / 180]) ** 2  # TODO tune, 0.1, 1 deg
+    # the tuned Q, R, JCBB alphas and car geometry, shared with sweep
+    defaults = PIPELINE_DEFAULTS["real"]
+    car = defaults["car"]
+    Q = defaults["Q"]
+    R = defaults["R"]
 
     # first is for joint compatibility, second is individual
-    JCBBalphas = np.array([1e-7, 1e-8])  # TODO tune, 1e-5, 1e-6
+    JCBBalphas = defaults["alphas"]
 
     sensorOffset = np.array([car.a + car.L, car.b])
     doAsso = True
@@ -146,17 +128,42 @@ def main():
 
     # Initialize state
     # you might want to tweak these for a good reference
-    eta = np.array([Lo_m[0], La_m[1], 36 * np.pi / 180])
-    P = np.zeros((3, 3))
+    eta, P = real_initial_state(Lo_m, La_m)
 
-    mk_first = 1  # first seems to be a bit off in timing
+    mk_first = defaults["mk_first"]
     mk = mk_first
-    t = timeOdo[0]
 
     # %%  run
     N = K  # K
 
     doPlot = False
+    # only write the figures to files, without any windows
+    headless = False
+    if headless:
+        use_headless()
+        doPlot = False
+
+    # compose the odometry between laser scans and only predict P right before an update
+    doOdoBuffer = True
+    odo_buffer = OdometryBuffer(slam)
+
+    # compressed EKF: only the robot and the landmarks around it are touched by the filter
+    # steps, the full map is refreshed when the robot has moved refresh_distance
+    doCEKF = False
+    if doCEKF:
+        cekf = CompressedEKFSLAM(slam, eta, P, sensor_range=85, refresh_distance=20)
+
+    # tentative landmarks, removal of the ones not seen again and merging of duplicates.
+    # The laser sees 180 degrees ahead, the range is kept short as far trees are often
+    # not detected. Not with doCEKF or doGraphSLAM, which assume landmarks are never removed
+    doLifecycle = False
+    lifecycle = LandmarkLifecycle(slam, sensor_range=40, field_of_view=np.pi)
+
+    # record the odometry and the associated measurements, and smooth the whole run
+    # with graph SLAM afterwards
+    doGraphSLAM = False
+    if doGraphSLAM:
+        graph_recorder = GraphRecorder(eta)
 
     lh_pose = None
 
@@ -169,105 +176,92 @@ def main():
 
     do_raw_prediction = True
     if do_raw_prediction:
-        odos = np.zeros((K, 3))
-        odox = np.zeros((K, 3))
-        odox[0] = eta
-        P_odo = P.copy()
-        for k in range(min(N, K - 1)):
-            odos[k + 1] = odometry(speed[k + 1], steering[k + 1], 0.025, car)
-            odox[k + 1], _ = slam.predict(odox[k], P_odo, odos[k + 1])
-            
+        odos = odometry(speed[1:N], steering[1:N], 0.025, car)
+        odox = deadReckoning(eta, odos)
+
     tot_num_asso = 0
-    kgps = 1
-    err_GPS = np.zeros([Kgps - 1,1])
-    for k in tqdm(range(N)):
-        if mk < mK - 1 and timeLsr[mk] <= timeOdo[k + 1]:
-            # Force P to symmetric: there are issues with long runs (>10000 steps)
-            # seem like the prediction might be introducing some minor asymetries,
-            # so best to force P symetric before update (where chol etc. is used).
-            # TODO: remove this for short debug runs in order to see if there are small errors
-            P = (P + P.T) / 2
-            dt = timeLsr[mk] - t
-            if dt < 0:  # avoid assertions as they can be optimized avay?
-                raise ValueError("negative time increment")
-
-            # ? reset time to this laser time for next post predict
-            t = timeLsr[mk]
-            odo = odometry(speed[k + 1], steering[k + 1], dt, car)
-            eta, P = slam.predict(eta, P, odo)  # TODO predict
-
-            z = detectTrees(LASER[mk])
-            eta, P, NIS[mk], a[mk] = slam.update(eta, P, z)  # TODO update
-
-            num_asso = np.count_nonzero(a[mk] > -1)
-            tot_num_asso += num_asso
-
-            if num_asso > 0:
-                NISnorm[mk] = NIS[mk] / (2 * num_asso)
-                CInorm[mk] = np.array(chi2.interval(confidence_prob, 2 * num_asso)) / (
-                    2 * num_asso
-                )
+    z = np.zeros((0, 2))
+
+    def predict(odo):
+        nonlocal eta, P
+        if doGraphSLAM:
+            graph_recorder.odometry(odo)
+        if doCEKF:
+            cekf.predict(odo)
+        elif doOdoBuffer:
+            odo_buffer.push(eta, odo)
+        else:
+            eta, P = slam.predict(eta, P, odo)
+
+    def update(mk_lsr, k, z_lsr):
+        nonlocal eta, P, mk, z, tot_num_asso
+        mk = mk_lsr
+        z = z_lsr
+        # Force P to symmetric: there are issues with long runs (>10000 steps)
+        # seem like the prediction might be introducing some minor asymetries,
+        # so best to force P symetric before update (where chol etc. is used).
+        # TODO: remove this for short debug runs in order to see if there are small errors
+        P = (P + P.T) / 2
+        if doCEKF:
+            NIS[mk], a[mk] = cekf.update(z)
+            eta = cekf.eta_A  # the robot and the landmarks around it
+        else:
+            if doOdoBuffer:
+                eta, P = odo_buffer.flush(eta, P)
+            if doLifecycle:
+                eta, P, NIS[mk], a[mk] = lifecycle.update(eta, P, z)
             else:
-                NISnorm[mk] = 1
-                CInorm[mk].fill(1)
-
-            xupd[mk] = eta[:3]
-            
-            # GPS Error Calculation
-            t_next = timeLsr[mk + 1]
-            t_prev = timeLsr[mk - 1]
-            t_GPS = timeGps[kgps]
-            
-            dt_GPS = t_GPS - t
-            dt_GPS_next = t_next - t_GPS
-            dt_GPS_prev = t_GPS - t_prev
-            if abs(dt_GPS_prev) < abs(dt_GPS) and kgps < Kgps - 1:
-                err_GPS[kgps - 1] = np.linalg.norm(xupd[mk - 1, :2] - np.array([Lo_m[kgps], La_m[kgps]]))
-                # print(f"Estimate: {xupd[mk, :2]}")
-                # print(f"GPS: {np.array([Lo_m[kgps], La_m[kgps]])}")
-                # print(f"Error: {err_GPS[kgps - 1]}")
-                             
-                kgps += 1
-                t_GPS = timeGps[kgps]
-                dt_GPS = t_GPS - t
-                dt_GPS_next = t_next - t_GPS
-            if abs(dt_GPS_next) > abs(dt_GPS) and kgps < Kgps - 1:              
-                err_GPS[kgps - 1] = np.linalg.norm(xupd[mk, :2] - np.array([Lo_m[kgps], La_m[kgps]]))
-                # print(f"Estimate: {xupd[mk, :2]}")
-                # print(f"GPS: {np.array([Lo_m[kgps], La_m[kgps]])}")
-                # print(f"Error: {err_GPS[kgps - 1]}")
-                kgps += 1
-
-            if doPlot:
-                sh_lmk.set_offsets(eta[3:].reshape(-1, 2))
-                if len(z) > 0:
-                    zinmap = (
-                        rotmat2d(eta[2])
-                        @ (
-                            z[:, 0] *
-                            np.array([np.cos(z[:, 1]), np.sin(z[:, 1])])
-                            + slam.sensor_offset[:, None]
-                        )
-                        + eta[0:2, None]
+                eta, P, NIS[mk], a[mk] = slam.update(eta, P, z)  # TODO update
+
+        if doGraphSLAM:
+            graph_recorder.scan(eta, z, a[mk])
+
+        num_asso = np.count_nonzero(a[mk] > -1)
+        tot_num_asso += num_asso
+
+        if num_asso > 0:
+            NISnorm[mk] = NIS[mk] / (2 * num_asso)
+            CInorm[mk] = np.array(chi2.interval(confidence_prob, 2 * num_asso)) / (
+                2 * num_asso
+            )
+        else:
+            NISnorm[mk] = 1
+            CInorm[mk].fill(1)
+
+        xupd[mk] = eta[:3]
+
+        if doPlot:
+            sh_lmk.set_offsets(eta[3:].reshape(-1, 2))
+            if len(z) > 0:
+                zinmap = (
+                    rotmat2d(eta[2])
+                    @ (
+                        z[:, 0] *
+                        np.array([np.cos(z[:, 1]), np.sin(z[:, 1])])
+                        + slam.sensor_offset[:, None]
                     )
-                    sh_Z.set_offsets(zinmap.T)
-                lh_pose.set_data(*xupd[mk_first:mk, :2].T)
-
-                ax.set(
-                    xlim=[-200, 200],
-                    ylim=[-200, 200],
-                    title=f"step {k}, laser scan {mk}, landmarks {len(eta[3:])//2},\nmeasurements {z.shape[0]}, num new = {np.sum(a[mk] == -1)}",
+                    + eta[0:2, None]
                 )
-                plt.draw()
-                plt.pause(0.00001)
-
-            mk += 1
-
-        if k < K - 1:
-            dt = timeOdo[k + 1] - t
-            t = timeOdo[k + 1]
-            odo = odometry(speed[k + 1], steering[k + 1], dt, car)
-            eta, P = slam.predict(eta, P, odo)
+                sh_Z.set_offsets(zinmap.T)
+            lh_pose.set_data(*decimate_path(xupd[mk_first:mk, :2]).T)
+
+            ax.set(
+                xlim=[-200, 200],
+                ylim=[-200, 200],
+                title=f"step {k}, laser scan {mk}, landmarks {len(eta[3:])//2},\nmeasurements {z.shape[0]}, num new = {np.sum(a[mk] == -1)}",
+            )
+            plt.draw()
+            plt.pause(0.00001)
+
+    # one past the last laser scan and the last odometry sample used
+    # closing slam shuts down the pool of a parallel JCBB associator
+    with slam:
+        mk, k = real_loop(realSLAM_data, predict, update, N, car, mk_first, progress=tqdm)
+
+    if doCEKF:
+        eta, P = cekf.refresh()
+    else:
+        eta, P = odo_buffer.flush(eta, P)
 
     # %% Consistency
 
@@ -276,9 +270,9 @@ def main():
         (NISnorm[:mk] <= CInorm[:mk, 1])
 
     fig3, ax3 = plt.subplots(num=3, clear=True)
-    ax3.plot(CInorm[:mk, 0], "--")
-    ax3.plot(CInorm[:mk, 1], "--")
-    ax3.plot(NISnorm[:mk], lw=0.5)
+    ax3.plot(*decimate(CInorm[:mk, 0]), "--")
+    ax3.plot(*decimate(CInorm[:mk, 1]), "--")
+    ax3.plot(*decimate(NISnorm[:mk]), lw=0.5)
 
     ax3.set_title(f"NIS, {insideCI.mean()*100:.2f}% inside CI")
     ax3.set_xlabel('t [s]')
@@ -289,10 +283,20 @@ def main():
     print(f"CI ANIS: {CI_ANIS}")
     print(f"ANIS: {ANIS}")
     
-    # GPS RMSE
+    # GPS RMSE, with the estimates interpolated to the GPS times
+    t_upd = timeLsr[mk_first:mk]
+    _, err_GPS = gps_errors(realSLAM_data, t_upd, xupd[mk_first:mk, :2])
     rmse_GPS = np.sqrt(np.mean(err_GPS**2))
     print(f"RMSE GPS: {rmse_GPS}")
 
+    if doGraphSLAM:
+        graph = GraphSLAM.from_recording(slam, graph_recorder, eta[3:].reshape(-1, 2))
+        for stats in graph.optimize(max_iterations=10):
+            print(f"graph SLAM iteration {stats['iteration']}: cost {stats['cost']:.1f}, {stats['time']:.2f} s")
+        # pose 0 is the initial state
+        _, err_GPS_smoothed = gps_errors(realSLAM_data, t_upd, graph.poses[1:, :2])
+        print(f"RMSE GPS graph SLAM: {np.sqrt(np.mean(err_GPS_smoothed**2))}")
+
     # %% slam
 
     if do_raw_prediction:
@@ -304,8 +308,8 @@ def main():
             marker=".",
             label="GPS",
         )
-        ax5.plot(*odox[:N, :2].T, label="Odometry")
-        ax5.plot(*xupd[mk_first:mk, :2].T, label="Estimate")
+        ax5.plot(*decimate_path(odox[:N, :2]).T, label="Odometry")
+        ax5.plot(*decimate_path(xupd[mk_first:mk, :2]).T, label="Estimate")
         ax5.grid()
         ax5.set_title("GPS vs odometry integration")
         ax5.set_xlabel('longitude [m]')
@@ -316,7 +320,9 @@ def main():
     # %%
     fig6, ax6 = plt.subplots(num=6, clear=True)
     ax6.scatter(*eta[3:].reshape(-1, 2).T, color="r", marker="x", label="Landmark est.")
-    ax6.plot(*xupd[mk_first:mk, :2].T, label="Pose est.")
+    ax6.plot(*decimate_path(xupd[mk_first:mk, :2]).T, label="Pose est.")
+    if doGraphSLAM:
+        ax6.plot(*decimate_path(graph.poses[1:, :2]).T, label="Pose est. graph SLAM")
     ax6.set(
         title=f"Steps {k}, laser scans {mk-1}, landmarks {len(eta[3:])//2},\nmeasurements {z.shape[0]}, num new = {np.sum(a[mk] == -1)}"
     )
@@ -324,7 +330,8 @@ def main():
     ax6.set_ylabel('latitude [m]')
     ax6.legend()
     fig6.savefig("Estimates_real.pdf")
-    plt.show()
+    if not headless:
+        plt.show()
 
 
 if __name__ == "__main__":
@@ -1,9 +1,13 @@
 # %% Imports
-from plotting import ellipse
+from plotting import ellipse, ellipse_collection, decimate, decimate_path, use_headless
 from EKFSLAM import EKFSLAM
+from SEIFSLAM import SEIFSLAM
+from pipelines import PIPELINE_DEFAULTS, simulated_loop
+from history import SLAMHistory
+from synthetic_data import simulate
+from slam_data import load_simulated
 from typing import List, Optional
 
-from scipy.io import loadmat
 import numpy as np
 
 import matplotlib
@@ -11,7 +15,6 @@ import matplotlib.pyplot as plt
 from matplotlib import animation
 from scipy.stats import chi2
 import utils
-from pathlib import Path
 
 try:
     from tqdm import tqdm
@@ -77,31 +80,39 @@ except Exception as e:
 
 def main():
     # %% Load data
-    datafile = Path(__file__).parents[1].joinpath("data/simulatedSLAM")
-    simSLAM_ws = loadmat(str(datafile))
-
-    # NB: this is a MATLAB cell, so needs to "double index" to get out the measurements of a time step k:
-    #
-    # ex:
-    #
-    # z_k = z[k][0] # z_k is a (2, m_k) matrix with columns equal to the measurements of time step k
-    #
-    ##
-    z = [zk.T for zk in simSLAM_ws["z"].ravel()]
-
-    landmarks = simSLAM_ws["landmarks"].T
-    odometry = simSLAM_ws["odometry"].T
-    poseGT = simSLAM_ws["poseGT"].T
-
-    K = len(z)
+    # converted from the .mat file once and memory mapped from then on, see
+    # slam_data.load_simulated. The measurements of time step k are stacked rowwise in
+    # z[z_offsets[k]:z_offsets[k + 1]], shape (m_k, 2).
+    simSLAM_data = load_simulated()
+
+    z = simSLAM_data["z"]
+    z_offsets = simSLAM_data["z_offsets"]
+
+    landmarks = simSLAM_data["landmarks"]
+    odometry = simSLAM_data["odometry"]
+    poseGT = simSLAM_data["poseGT"]
+
+    # run on a generated dataset instead, e.g. for larger maps and longer runs, with
+    # SimulationConfig imported from synthetic_data
+    syntheticConfig = None  # SimulationConfig(num_steps=5000, landmark_density=0.01, seed=0)
+    if syntheticConfig is not None:
+        dataset = simulate(syntheticConfig)
+        z = dataset.z
+        z_offsets = dataset.offsets
+        landmarks = dataset.landmarks
+        odometry = dataset.odometry
+        poseGT = dataset.poseGT
+
+    K = z_offsets.shape[0] - 1
     M = len(landmarks)
 
     # %% Initilize
-    Q = np.diag([0.025, 0.025, 0.4 * np.pi / 180]) ** 2  # TODO tune, 0.1, 0.1, 1 deg
-    R = np.diag([0.1, 1 * np.pi / 180]) ** 2  # TODO tune, 0.1, 1 deg
+    # the tuned Q, R and JCBB alphas, shared with sweep
+    Q = PIPELINE_DEFAULTS["simulated"]["Q"]
+    R = PIPELINE_DEFAULTS["simulated"]["R"]
 
     # first is for joint compatibility, second is individual
-    JCBBalphas = np.array([1e-2, 1e-3])  # TODO tune, 1e-3, 1e-4
+    JCBBalphas = PIPELINE_DEFAULTS["simulated"]["alphas"]
 
     doAsso = True
 
@@ -109,13 +120,15 @@ def main():
 # these can have a large effect on runtime either through the number of landmarks created
 # or by the size of the association search space.
 
-    slam = EKFSLAM(Q, R, do_asso=doAsso, alphas=JCBBalphas)
+    # sparse extended information filter instead of the EKF, P is then the information
+    # form of the state and the covariances are recovered from it for the evaluation
+    doSEIF = False
+    if doSEIF:
+        slam = SEIFSLAM(Q, R, do_asso=doAsso, alphas=JCBBalphas, max_active=20)
+    else:
+        slam = EKFSLAM(Q, R, do_asso=doAsso, alphas=JCBBalphas)
 
     # allocate
-    eta_pred: List[Optional[np.ndarray]] = [None] * K
-    P_pred: List[Optional[np.ndarray]] = [None] * K
-    eta_hat: List[Optional[np.ndarray]] = [None] * K
-    P_hat: List[Optional[np.ndarray]] = [None] * K
     a: List[Optional[np.ndarray]] = [None] * K
     NIS = np.zeros(K)
     NISnorm = np.zeros(K)
@@ -127,37 +140,58 @@ def main():
     alpha = 0.05
 
     # init
-    eta_pred[0] = poseGT[0]  # we start at the correct position for reference
+    eta = poseGT[0].copy()  # we start at the correct position for reference
     # we also say that we are 100% sure about that
-    P_pred[0] = np.zeros((3, 3))
+    P = np.zeros((3, 3))
+    if doSEIF:
+        P = slam.init_information(eta, P)
 
     # %% Set up plotting
     # plotting
 
     doAssoPlot = False
     playMovie = False
+    # only write the figures and the movie to files, without any windows
+    headless = False
+    if headless:
+        use_headless()
+        doAssoPlot = False
     if doAssoPlot:
         figAsso, axAsso = plt.subplots(num=1, clear=True)
 
     # %% Run simulation
     N = K
 
+    # the pose estimates are always kept, the full eta and P only at the checkpoints
+    # and the last step. The landmarks of every step are only kept for the movie.
+    checkpointEvery = None
+    historySpillDir = None  # e.g. Path("history"), to memory map the checkpoints
+    history = SLAMHistory(N, checkpoint_every=checkpointEvery,
+                          record_landmarks=playMovie, spill_dir=historySpillDir)
+
     print("starting sim (" + str(N) + " iterations)")
     tot_num_asso = 0
-    for k, z_k in tqdm(enumerate(z[:N]), total=N):
-        # See top: need to do "double indexing" to get z at time step k
-        # Transpose is to stack measurements rowwise
-        # z_k = z[k][0].T
-
-        eta_hat[k], P_hat[k], NIS[k], a[k] = slam.update(
-            eta_pred[k], P_pred[k], z_k)  # TODO update
-        if k < K - 1:
-            # TODO predict
-            eta_pred[k + 1], P_pred[k +
-                                    1] = slam.predict(eta_hat[k], P_hat[k], odometry[k, :])
+
+    def on_update(k, eta_pred, eta_hat, P, NIS_k, a_k):
+        nonlocal tot_num_asso
+        z_k = z[z_offsets[k]:z_offsets[k + 1]]
+        NIS[k] = NIS_k
+        a[k] = a_k
+
+        # the pose covariance after the update, before predict changes P in place. With
+        # SEIF only the pose marginal is recovered, and the full covariance only when
+        # the history keeps it
+        checkpoint = k == N - 1
+        if doSEIF:
+            Pxx = slam.marginal_covariance(P, np.arange(3))
+            Pfull = slam.covariance(P) if history.needs_covariance(k, checkpoint) else None
+            history.record(k, eta_hat, Pfull, checkpoint=checkpoint, pose_cov=Pxx)
+        else:
+            Pxx = P[0:3, 0:3].copy()
+            history.record(k, eta_hat, P, checkpoint=checkpoint)
 
         assert (
-            eta_hat[k].shape[0] == P_hat[k].shape[0]
+            eta_hat.shape[0] == P.shape[0]
         ), "dimensions of mean and covariance do not match"
 
         num_asso = np.count_nonzero(a[k] > -1)
@@ -173,13 +207,14 @@ def main():
             CInorm[k].fill(1)
 
         # TODO, use provided function slam.NEESes
-        NEESes[k] = slam.NEESes(eta_hat[k][0:3], P_hat[k]
-                                [0:3, 0:3], poseGT[k, :])
+        # the first pose is known exactly, so its covariance is zero after the update
+        if k > 0:
+            NEESes[k] = slam.NEESes(eta_hat[0:3], Pxx, poseGT[k, :])
 
         if doAssoPlot and k > 0:
             axAsso.clear()
             axAsso.grid()
-            zpred = slam.h(eta_pred[k]).reshape(-1, 2)
+            zpred = slam.h(eta_pred).reshape(-1, 2)
             axAsso.scatter(z_k[:, 0], z_k[:, 1], label="z")
             axAsso.scatter(zpred[:, 0], zpred[:, 1], label="zpred")
             xcoords = np.block(
@@ -194,11 +229,15 @@ def main():
             plt.draw()
             plt.pause(0.001)
 
+    # closing slam shuts down the pool of a parallel JCBB associator
+    with slam:
+        eta, P = simulated_loop(slam, eta, P, z, z_offsets, odometry, on_update, N, progress=tqdm)
+
     print("sim complete")
 
-    pose_est = np.array([x[:3] for x in eta_hat[:N]])
-    lmk_est = [eta_hat_k[3:].reshape(-1, 2) for eta_hat_k in eta_hat]
-    lmk_est_final = lmk_est[N - 1]
+    pose_est = history.pose
+    lmk_est_final = history.landmarks(N - 1)
+    lmk_cov_final = history.landmark_covs(N - 1)
 
     np.set_printoptions(precision=4, linewidth=100)
 
@@ -219,15 +258,11 @@ def main():
     print(f"N Landmarks, GT: {landmarks.shape[0]}")
     print(f"N Landmarks, est: {lmk_est_final.shape[0]}")
     # Draw covariance ellipsis of measurements
-    for l, lmk_l in enumerate(lmk_est_final):
-        idxs = slice(3 + 2 * l, 3 + 2 * l + 2)
-        rI = P_hat[N - 1][idxs, idxs]
-        el = ellipse(lmk_l, rI, 5, 200)
-        ax2.plot(*el.T, "b")
-
-    ax2.plot(*poseGT.T[:2], c="r", label="Pose GT")
-    ax2.plot(*pose_est.T[:2], c="g", label="Pose est.")
-    ax2.plot(*ellipse(pose_est[-1, :2], P_hat[N - 1][:2, :2], 5, 200).T, c="g")
+    ax2.add_collection(ellipse_collection(lmk_est_final, lmk_cov_final, 5, 200, colors="b"))
+
+    ax2.plot(*decimate_path(poseGT[:, :2]).T, c="r", label="Pose GT")
+    ax2.plot(*decimate_path(pose_est[:, :2]).T, c="g", label="Pose est.")
+    ax2.plot(*ellipse(pose_est[-1, :2], history.pose_cov[-1, :2, :2], 5, 200).T, c="g")
     ax2.set(title="Estimated pose and landmarks vs Ground Truth", xlim=(mins[0], maxs[0]), ylim=(mins[1], maxs[1]))
     ax2.set_xlabel('x [m]')
     ax2.set_ylabel('y [m]')
@@ -241,9 +276,9 @@ def main():
     insideCI = (CInorm[:N, 0] <= NISnorm[:N]) * (NISnorm[:N] <= CInorm[:N, 1])
 
     fig3, ax3 = plt.subplots(num=3, clear=True)
-    ax3.plot(CInorm[:N, 0], '--')
-    ax3.plot(CInorm[:N, 1], '--')
-    ax3.plot(NISnorm[:N], lw=0.5)
+    ax3.plot(*decimate(CInorm[:N, 0]), '--')
+    ax3.plot(*decimate(CInorm[:N, 1]), '--')
+    ax3.plot(*decimate(NISnorm[:N]), lw=0.5)
     
     ax3.set_xlabel('k')
     ax3.set_title(f'NIS, {insideCI.mean()*100}% inside CI')
@@ -255,7 +290,7 @@ def main():
     print(f"CI ANIS: {CI_ANIS}")
     print(f"ANIS: {ANIS}")
 
-    # NEES
+    # NEES, of the steps after the first
 
     fig4, ax4 = plt.subplots(nrows=3, ncols=1, figsize=(
         7, 5), num=4, clear=True, sharex=True)
@@ -264,15 +299,15 @@ def main():
 
     for ax, tag, NEES, df in zip(ax4, tags, NEESes.T, dfs):
         CI_NEES = chi2.interval(1 - alpha, df)
-        ax.plot(np.full(N, CI_NEES[0]), '--')
-        ax.plot(np.full(N, CI_NEES[1]), '--')
-        ax.plot(NEES[:N], lw=0.5)
-        insideCI = (CI_NEES[0] <= NEES) * (NEES <= CI_NEES[1])
+        ax.plot([0, N - 1], np.full(2, CI_NEES[0]), '--')
+        ax.plot([0, N - 1], np.full(2, CI_NEES[1]), '--')
+        ax.plot(*decimate(NEES[:N]), lw=0.5)
+        insideCI = (CI_NEES[0] <= NEES[1:N]) * (NEES[1:N] <= CI_NEES[1])
         ax.set_title(f'NEES, {tag}: {insideCI.mean()*100}% inside CI')
 
-        CI_ANEES = np.array(chi2.interval(1 - alpha, df*N)) / N
+        CI_ANEES = np.array(chi2.interval(1 - alpha, df*(N - 1))) / (N - 1)
         print(f"CI ANEES {tag}: {CI_ANEES}")
-        print(f"ANEES {tag}: {NEES.mean()}")
+        print(f"ANEES {tag}: {NEES[1:N].mean()}")
 
     ax4[-1].set_xlabel('k')
     fig4.tight_layout()
@@ -291,7 +326,7 @@ def main():
     errs = np.vstack((pos_err, heading_err))
 
     for ax, err, tag, ylabel, scaling in zip(ax5, errs, tags[1:], ylabels, scalings):
-        ax.plot(err*scaling)
+        ax.plot(*decimate(err*scaling))
         ax.set_title(
             f"{tag}: RMSE {np.sqrt((err**2).mean())*scaling} {ylabel}")
         ax.set_ylabel(f"[{ylabel}]")
@@ -320,31 +355,32 @@ def main():
 
             for k in tqdm(range(N)):
                 ax_movie.scatter(*landmarks.T, c="r", marker="^")
-                ax_movie.plot(*poseGT[:k, :2].T, "r-")
-                ax_movie.plot(*pose_est[:k, :2].T, "g-")
-                ax_movie.scatter(*lmk_est[k].T, c="b", marker=".")
+                ax_movie.plot(*decimate_path(poseGT[:k, :2]).T, "r-")
+                ax_movie.plot(*decimate_path(pose_est[:k, :2]).T, "g-")
+                ax_movie.scatter(*history.landmarks(k).T, c="b", marker=".")
 
                 if k > 0:
-                    el = ellipse(pose_est[k, :2], P_hat[k][:2, :2], 5, 200)
+                    el = ellipse(pose_est[k, :2], history.pose_cov[k, :2, :2], 5, 200)
                     ax_movie.plot(*el.T, "g")
 
-                numLmk = lmk_est[k].shape[0]
-                for l, lmk_l in enumerate(lmk_est[k]):
-                    idxs = slice(3 + 2 * l, 3 + 2 * l + 2)
-                    rI = P_hat[k][idxs, idxs]
-                    el = ellipse(lmk_l, rI, 5, 200)
-                    ax_movie.plot(*el.T, "b")
+                ax_movie.add_collection(ellipse_collection(
+                    history.landmarks(k), history.landmark_covs(k), 5, 200, colors="b"))
 
                 camera.snap()
             animation = camera.animate(interval=100, blit=True, repeat=False)
-            print("playing movie")
+            if headless:
+                animation.save("movie.gif", writer="pillow")
+                print("movie written to movie.gif")
+            else:
+                print("playing movie")
 
         except ImportError:
             print(
                 "Install celluloid module, \n\n$ pip install celluloid\n\nto get fancy animation of EKFSLAM."
             )
 
-    plt.show()
+    if not headless:
+        plt.show()
     # %%
 
 
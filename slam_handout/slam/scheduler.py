@@ -0,0 +1,93 @@
+from typing import Callable, Iterator, List, Optional, Tuple
+from dataclasses import dataclass, field
+import heapq
+import numpy as np
+
+
+@dataclass
+class EventStream:
+    """Timestamped events of one sensor, handled by handler(k, t) for event k at time t."""
+
+    name: str
+    times: np.ndarray
+    handler: Callable[[int, float], None]
+    # handled first of events with the same time
+    priority: int = 0
+    start: int = 0
+    stop: Optional[int] = None
+
+    def events(self, stream_ind: int) -> Iterator[Tuple[float, int, int, int]]:
+        stop = self.times.shape[0] if self.stop is None else self.stop
+        times = self.times[self.start:stop].tolist()
+        for k, t in enumerate(times, start=self.start):
+            yield t, self.priority, stream_ind, k
+
+    def num_events(self) -> int:
+        stop = self.times.shape[0] if self.stop is None else self.stop
+        return max(stop - self.start, 0)
+
+
+@dataclass
+class EventScheduler:
+    """Merges timestamped sensor streams and dispatches each event to its handler in time order.
+
+    Each stream must be sorted in time. The streams are merged with a heap, so the cost per
+    event is O(log #streams).
+
+    Example
+    -------
+    scheduler = EventScheduler()
+    scheduler.add_stream("odometry", timeOdo, on_odometry, priority=1, start=1)
+    scheduler.add_stream("laser", timeLsr, on_laser, priority=0)
+    scheduler.run()
+    """
+
+    streams: List[EventStream] = field(default_factory=list)
+
+    def add_stream(
+        self,
+        name: str,
+        times: np.ndarray,
+        handler: Callable[[int, float], None],
+        priority: int = 0,
+        start: int = 0,
+        stop: Optional[int] = None,
+    ) -> EventStream:
+        """Register the events times[start:stop] to be handled by handler(k, times[k])."""
+        stream = EventStream(name, np.asarray(times), handler, priority, start, stop)
+        self.streams.append(stream)
+        return stream
+
+    def num_events(self) -> int:
+        return sum(stream.num_events() for stream in self.streams)
+
+    def events(self) -> Iterator[Tuple[float, int, int, int]]:
+        """All the events as (time, priority, stream index, event index) in the order handled."""
+        return heapq.merge(*(stream.events(i) for i, stream in enumerate(self.streams)))
+
+    def run(self, progress: Optional[Callable] = None, until: Optional[float] = None):
+        """Dispatch all the events, or the ones up to time until.
+
+        progress is an optional wrapper of the event iterator, like tqdm.
+        """
+        events = self.events()
+        if progress is not None:
+            events = progress(events, total=self.num_events())
+
+        handlers = [stream.handler for stream in self.streams]
+        for t, _, stream_ind, k in events:
+            if until is not None and t > until:
+                break
+            handlers[stream_ind](k, t)
+
+
+def interpolate_poses(t_query: np.ndarray, t: np.ndarray, x: np.ndarray) -> np.ndarray:
+    """Linearly interpolate the positions x, shape (N, d), at times t to the times t_query.
+
+    t must be sorted. t_query outside of t get the first or last value.
+    """
+    inds = np.clip(np.searchsorted(t, t_query), 1, t.shape[0] - 1)
+    t0 = t[inds - 1]
+    t1 = t[inds]
+    w = np.clip((t_query - t0) / np.where(t1 > t0, t1 - t0, 1), 0, 1)
+    return x[inds - 1] + w[:, None] * (x[inds] - x[inds - 1])
@@ -0,0 +1,150 @@
+from typing import Callable, Dict, List, Optional, Sequence
+from pathlib import Path
+import hashlib
+import os
+import shutil
+import numpy as np
+from scipy.io import loadmat
+from vp_utils import detectTreesBatch, DETECT_TREES_VERSION
+
+DATA_DIR = Path(__file__).parents[1].joinpath("data")
+CACHE_DIR = DATA_DIR.joinpath("cache")
+
+# bump when a conversion below changes, so that the cached arrays are not used
+DATA_CACHE_VERSION = 1
+
+
+def source_key(files: Sequence[Path], *extra: str, revalidate: bool = False) -> str:
+    """A blake2b hash of the file names, sizes and times, the conversion version and extra.
+
+    This only stats the files. With revalidate, the contents of the files are hashed as
+    well, read in blocks, so changed data whose size and time are kept, e.g. by a copy
+    that preserves the times, does not hit an old cache.
+    """
+    key = hashlib.blake2b(digest_size=16)
+    key.update(f"{DATA_CACHE_VERSION} {' '.join(extra)}".encode())
+    for f in files:
+        stat = Path(f).stat()
+        key.update(f"{Path(f).name} {stat.st_size} {stat.st_mtime_ns}".encode())
+        if revalidate:
+            with open(f, "rb") as stream:
+                for block in iter(lambda: stream.read(1 << 20), b""):
+                    key.update(block)
+    return key.hexdigest()
+
+
+def derived_key(key: str, *extra: str) -> str:
+    """A blake2b hash of key and extra, for caches derived from the one of key."""
+    return hashlib.blake2b(f"{key} {' '.join(extra)}".encode(), digest_size=16).hexdigest()
+
+
+def cached_arrays(
+    name: str, key: str, convert: Callable[[], Dict[str, np.ndarray]], cache_dir: Path = CACHE_DIR
+) -> Dict[str, np.ndarray]:
+    """The arrays of convert, converted once and memory mapped read only from then on.
+
+    The arrays are stored as .npy files in the directory cache_dir/<name>_<key>, which is
+    written to a temporary directory first so a cache is either complete or missing.
+    """
+    folder = Path(cache_dir).joinpath(f"{name}_{key}")
+    if not folder.is_dir():
+        arrays = convert()
+        tmp = folder.with_name(f"{folder.name}.tmp{os.getpid()}")
+        tmp.mkdir(parents=True, exist_ok=True)
+        for array_name, array in arrays.items():
+            np.save(tmp.joinpath(f"{array_name}.npy"), np.ascontiguousarray(array))
+        try:
+            tmp.rename(folder)
+        except OSError:  # written by another process in the meantime
+            shutil.rmtree(tmp)
+
+    return {f.stem: np.load(f, mmap_mode="r") for f in folder.glob("*.npy")}
+
+
+def ragged(zs: List[np.ndarray]) -> Dict[str, np.ndarray]:
+    """Stack the arrays zs row wise, zs[k] is z[offsets[k]:offsets[k + 1]]."""
+    offsets = np.zeros(len(zs) + 1, dtype=int)
+    np.cumsum([zk.shape[0] for zk in zs], out=offsets[1:])
+    z = np.concatenate(zs, axis=0) if zs else np.zeros((0, 2))
+    return dict(z=z, z_offsets=offsets)
+
+
+def load_simulated(
+    path: Optional[Path] = None, cache_dir: Path = CACHE_DIR, revalidate: bool = False
+) -> Dict[str, np.ndarray]:
+    """data/simulatedSLAM.mat, converted once and memory mapped.
+
+    The cache is keyed on the size and time of the file, or its contents with revalidate,
+    see source_key.
+
+    Returns
+    -------
+    Dict[str, np.ndarray]
+        landmarks (#landmarks, 2), odometry (K, 3), poseGT (K + 1, 3), and the measurements
+        of step k as z[z_offsets[k]:z_offsets[k + 1]], with [range, bearing] rows.
+    """
+    path = Path(path or DATA_DIR.joinpath("simulatedSLAM.mat"))
+
+    def convert():
+        ws = loadmat(str(path))
+        return dict(
+            **ragged([zk.T for zk in ws["z"].ravel()]),
+            landmarks=ws["landmarks"].T,
+            odometry=ws["odometry"].T,
+            poseGT=ws["poseGT"].T,
+        )
+
+    return cached_arrays("simulated", source_key([path], revalidate=revalidate), convert, cache_dir)
+
+
+def load_victoria_park(
+    folder: Optional[Path] = None,
+    detect_trees: bool = True,
+    cache_dir: Path = CACHE_DIR,
+    revalidate: bool = False,
+) -> Dict[str, np.ndarray]:
+    """The Victoria Park data, converted once and memory mapped.
+
+    The times are in seconds and LASER is divided by 100, as detectTrees expects. With
+    detect_trees, the trees of scan mk are trees[trees_offsets[mk]:trees_offsets[mk + 1]],
+    also detected once and cached. This is the only cache of the tree detections, keyed
+    on the key of the data and DETECT_TREES_VERSION. The data is keyed on the sizes and
+    times of the files, or their contents with revalidate, see source_key.
+
+    Returns
+    -------
+    Dict[str, np.ndarray]
+        timeOdo, speed and steering, timeLsr and LASER, timeGps, La_m and Lo_m, and
+        trees and trees_offsets with detect_trees.
+    """
+    folder = Path(folder or DATA_DIR.joinpath("victoria_park"))
+    files = [folder.joinpath(f"{name}.mat") for name in ("aa3_dr", "aa3_lsr2", "aa3_gpsx")]
+    key = source_key(files, revalidate=revalidate)
+
+    def convert():
+        ws = {}
+        for f in files:
+            ws.update(loadmat(str(f)))
+        return dict(
+            timeOdo=(ws["time"] / 1000).ravel(),
+            timeLsr=(ws["TLsr"] / 1000).ravel(),
+            timeGps=(ws["timeGps"] / 1000).ravel(),
+            steering=ws["steering"].ravel(),
+            speed=ws["speed"].ravel(),
+            LASER=ws["LASER"] / 100,
+            La_m=ws["La_m"].ravel(),
+            Lo_m=ws["Lo_m"].ravel(),
+        )
+
+    data = cached_arrays("victoria_park", key, convert, cache_dir)
+
+    if detect_trees:
+        def convert_trees():
+            offsets, trees = detectTreesBatch(np.asarray(data["LASER"]))
+            return dict(trees=trees, trees_offsets=offsets)
+
+        data.update(cached_arrays(
+            "victoria_park_trees", derived_key(key, f"trees {DETECT_TREES_VERSION}"),
+            convert_trees, cache_dir))
+
+    return data
@@ -0,0 +1,324 @@
+from typing import Any, Dict, List, Optional, Tuple
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field, asdict
+from multiprocessing import shared_memory
+from pathlib import Path
+import argparse
+import itertools
+import json
+import os
+import time
+import numpy as np
+from scipy.stats import chi2
+from EKFSLAM import EKFSLAM
+from odometry_buffer import OdometryBuffer
+from pipelines import PIPELINE_DEFAULTS, real_initial_state, simulated_loop, real_loop, gps_errors
+from synthetic_data import SimulatedDataset
+import slam_data
+
+
+@dataclass
+class SweepParams:
+    """One configuration: Q and R scaled from the pipeline defaults, and the JCBB alphas.
+
+    Q = q_scale^2 Q_default and R = r_scale^2 R_default, so the scales multiply the
+    standard deviations. The alphas are the ones of the pipeline when None, see
+    pipelines.PIPELINE_DEFAULTS.
+    """
+
+    q_scale: float = 1.0
+    r_scale: float = 1.0
+    # first is for joint compatibility, second is individual
+    alpha_joint: Optional[float] = None
+    alpha_individual: Optional[float] = None
+
+
+@dataclass
+class SharedArrays:
+    """Numpy arrays in shared memory, so the workers of a pool map them instead of copying.
+
+    Create with publish in the parent, which owns the memory until close. The object is
+    pickled to the workers, which call attach.
+    """
+
+    # name -> (shared memory name, shape, dtype)
+    specs: Dict[str, Tuple[str, Tuple[int, ...], str]] = field(default_factory=dict)
+    _shms: List[Any] = field(default_factory=list, repr=False)
+
+    @classmethod
+    def publish(cls, arrays: Dict[str, np.ndarray]) -> "SharedArrays":
+        shared = cls()
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array)
+            shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, array.dtype, buffer=shm.buf)[...] = array
+            shared._shms.append(shm)
+            shared.specs[name] = (shm.name, array.shape, array.dtype.str)
+        return shared
+
+    def attach(self) -> Dict[str, np.ndarray]:
+        """The arrays, read only views of the shared memory."""
+        arrays = {}
+        for name, (shm_name, shape, dtype) in self.specs.items():
+            shm = shared_memory.SharedMemory(name=shm_name)
+            self._shms.append(shm)
+            arrays[name] = np.ndarray(shape, dtype, buffer=shm.buf)
+            arrays[name].flags.writeable = False
+        return arrays
+
+    def close(self, unlink: bool = True):
+        for shm in self._shms:
+            shm.close()
+            if unlink:
+                try:
+                    shm.unlink()
+                except FileNotFoundError:  # already unlinked by a worker's resource tracker
+                    pass
+        self._shms = []
+
+    def __getstate__(self):
+        return {"specs": self.specs, "_shms": []}
+
+
+def load_simulated(path: Optional[Path] = None) -> Dict[str, np.ndarray]:
+    """The simulated data, from data/simulatedSLAM.mat or a SimulatedDataset directory."""
+    if path is not None and Path(path).is_dir():
+        dataset = SimulatedDataset.load(path, mmap_mode=None)
+        return dict(z=dataset.z, z_offsets=dataset.offsets, odometry=dataset.odometry,
+                    poseGT=dataset.poseGT)
+
+    data = slam_data.load_simulated(path)
+    return {name: data[name] for name in ("z", "z_offsets", "odometry", "poseGT")}
+
+
+def load_real(path: Optional[Path] = None) -> Dict[str, np.ndarray]:
+    """The Victoria Park data, with the trees detected once and cached, see slam_data.load_victoria_park."""
+    data = slam_data.load_victoria_park(path)
+    # all but LASER, which is only needed for the tree detection
+    return {name: data[name] for name in (
+        "timeOdo", "timeLsr", "timeGps", "steering", "speed", "La_m", "Lo_m", "trees", "trees_offsets")}
+
+
+def make_slam(pipeline: str, params: SweepParams, **kwargs) -> EKFSLAM:
+    defaults = PIPELINE_DEFAULTS[pipeline]
+    alphas = np.array(defaults["alphas"], dtype=float)
+    if params.alpha_joint is not None:
+        alphas[0] = params.alpha_joint
+    if params.alpha_individual is not None:
+        alphas[1] = params.alpha_individual
+    return EKFSLAM(
+        params.q_scale ** 2 * defaults["Q"],
+        params.r_scale ** 2 * defaults["R"],
+        do_asso=True,
+        alphas=alphas,
+        **kwargs,
+    )
+
+
+def consistency(NIS: np.ndarray, num_asso: np.ndarray, alpha: float = 0.05) -> Dict[str, Any]:
+    """ANIS normalized by the degrees of freedom, over the scans with associations."""
+    dofs = 2 * num_asso.sum()
+    if dofs == 0:
+        return dict(ANIS=None, ANIS_CI=None)
+    return dict(
+        ANIS=float(NIS[num_asso > 0].sum() / dofs),
+        ANIS_CI=(np.array(chi2.interval(1 - alpha, dofs)) / dofs).tolist(),
+    )
+
+
+def run_simulated(data: Dict[str, np.ndarray], params: SweepParams, N: Optional[int] = None) -> Dict[str, Any]:
+    """The run_simulated_SLAM filter loop without the plots, for the first N steps."""
+    poseGT = data["poseGT"]
+    K = data["z_offsets"].shape[0] - 1 if N is None else min(N, data["z_offsets"].shape[0] - 1)
+
+    slam = make_slam("simulated", params)
+    NIS = np.zeros(K)
+    num_asso = np.zeros(K, dtype=int)
+    NEES = np.zeros(K)
+    pos_err2 = np.zeros(K)
+
+    def on_update(k, eta_pred, eta, P, NIS_k, a):
+        NIS[k] = NIS_k
+        num_asso[k] = np.count_nonzero(a > -1)
+        if k > 0:  # the first pose is known exactly
+            NEES[k] = slam.NEESes(eta[:3], P[:3, :3], poseGT[k])[0]
+        pos_err2[k] = ((eta[:2] - poseGT[k, :2]) ** 2).sum()
+
+    with slam:
+        eta, _ = simulated_loop(slam, poseGT[0].copy(), np.zeros((3, 3)), data["z"],
+                                data["z_offsets"], data["odometry"], on_update, K)
+
+    # the NEES of the steps after the first, none with a single step
+    dofs = 3 * (K - 1)
+    return dict(
+        **consistency(NIS, num_asso),
+        ANEES=float(NEES.sum() / dofs) if dofs > 0 else None,
+        ANEES_CI=(np.array(chi2.interval(0.95, dofs)) / dofs).tolist() if dofs > 0 else None,
+        RMSE=float(np.sqrt(pos_err2.mean())),
+        landmarks=(eta.shape[0] - 3) // 2,
+        associations=int(num_asso.sum()),
+        steps=K,
+    )
+
+
+def run_real(data: Dict[str, np.ndarray], params: SweepParams, N: Optional[int] = None) -> Dict[str, Any]:
+    """The run_real_SLAM filter loop without the plots, up to odometry sample N.
+
+    The RMSE is against the GPS, with the estimates interpolated to the GPS times.
+    """
+    mK = data["timeLsr"].shape[0]
+    car = PIPELINE_DEFAULTS["real"]["car"]
+    slam = make_slam("real", params, sensor_offset=np.array([car.a + car.L, car.b]))
+    odo_buffer = OdometryBuffer(slam)
+
+    eta, P = real_initial_state(data["Lo_m"], data["La_m"])
+    xupd = np.zeros((mK, 3))
+    NIS = np.zeros(mK)
+    num_asso = np.zeros(mK, dtype=int)
+
+    def predict(odo):
+        odo_buffer.push(eta, odo)
+
+    def update(mk, k, z):
+        nonlocal eta, P
+        P = (P + P.T) / 2
+        eta, P = odo_buffer.flush(eta, P)
+        eta, P, NIS[mk], a = slam.update(eta, P, z)
+        num_asso[mk] = np.count_nonzero(a > -1)
+        xupd[mk] = eta[:3]
+
+    K = data["timeOdo"].shape[0]
+    mk_first = PIPELINE_DEFAULTS["real"]["mk_first"]
+    with slam:
+        mk, k_last = real_loop(data, predict, update, K if N is None else N)
+
+    _, err_GPS = gps_errors(data, data["timeLsr"][mk_first:mk], xupd[mk_first:mk, :2])
+
+    return dict(
+        **consistency(NIS[mk_first:mk], num_asso[mk_first:mk]),
+        RMSE=float(np.sqrt(np.mean(err_GPS ** 2))),
+        landmarks=(eta.shape[0] - 3) // 2,
+        associations=int(num_asso.sum()),
+        steps=int(k_last),
+    )
+
+
+PIPELINES = {"simulated": (load_simulated, run_simulated), "real": (load_real, run_real)}
+
+_worker_data: Optional[Dict[str, np.ndarray]] = None
+
+
+def _worker_init(shared: SharedArrays):
+    global _worker_data
+    _worker_data = shared.attach()
+
+
+def _worker_run(pipeline: str, params: SweepParams, N: Optional[int]) -> Dict[str, Any]:
+    return run_config(_worker_data, pipeline, params, N)
+
+
+def run_config(data: Dict[str, np.ndarray], pipeline: str, params: SweepParams, N: Optional[int]) -> Dict[str, Any]:
+    """Run one configuration, a failure is recorded in the result instead of raised."""
+    t0 = time.perf_counter()
+    try:
+        metrics = PIPELINES[pipeline][1](data, params, N)
+        error = None
+    except Exception as e:  # e.g. a non positive definite S with extreme parameters
+        metrics = {}
+        error = f"{type(e).__name__}: {e}"
+    return dict(params=asdict(params), **metrics, wall_time=time.perf_counter() - t0, error=error)
+
+
+def grid(values: Dict[str, List[float]]) -> List[SweepParams]:
+    """All the combinations of the values of each parameter."""
+    names = list(values)
+    return [SweepParams(**dict(zip(names, combo))) for combo in itertools.product(*values.values())]
+
+
+def random_search(bounds: Dict[str, Tuple[float, float]], num_samples: int, seed: Optional[int] = None) -> List[SweepParams]:
+    """num_samples configurations with each parameter log uniform within its bounds."""
+    rng = np.random.default_rng(seed)
+    samples = {name: np.exp(rng.uniform(np.log(lo), np.log(hi), num_samples))
+               for name, (lo, hi) in bounds.items()}
+    return [SweepParams(**{name: float(samples[name][i]) for name in bounds}) for i in range(num_samples)]
+
+
+def pareto_front(results: List[Dict[str, Any]], keys: Tuple[str, ...] = ("RMSE", "wall_time")) -> np.ndarray:
+    """The results not dominated in keys, all to be minimized, shape (#results,) bool."""
+    values = np.array([[r.get(key, np.inf) if r.get(key) is not None else np.inf for key in keys]
+                       for r in results], dtype=float)
+    dominated = np.zeros(len(results), dtype=bool)
+    for i, v in enumerate(values):
+        dominated[i] = np.any(np.all(values <= v, axis=1) & np.any(values < v, axis=1))
+    return ~dominated & np.all(np.isfinite(values), axis=1)
+
+
+def run_sweep(
+    pipeline: str,
+    configs: List[SweepParams],
+    data: Dict[str, np.ndarray],
+    N: Optional[int] = None,
+    num_workers: Optional[int] = None,
+) -> List[Dict[str, Any]]:
+    """Run the configurations over a process pool sharing data, and mark the Pareto front."""
+    num_workers = num_workers or os.cpu_count() or 1
+    if num_workers <= 1:
+        results = [run_config(data, pipeline, params, N) for params in configs]
+    else:
+        shared = SharedArrays.publish(data)
+        try:
+            with ProcessPoolExecutor(num_workers, initializer=_worker_init, initargs=(shared,)) as pool:
+                futures = [pool.submit(_worker_run, pipeline, params, N) for params in configs]
+                results = [future.result() for future in futures]
+        finally:
+            shared.close()
+
+    for result, on_front in zip(results, pareto_front(results)):
+        result["pareto"] = bool(on_front)
+    return results
+
+
+def parse_values(items: List[str]) -> Dict[str, List[float]]:
+    """name=v1,v2,... -> {name: [v1, v2, ...]}"""
+    return {name: [float(v) for v in values.split(",")]
+            for name, values in (item.split("=") for item in items)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parameter sweep of the SLAM pipelines.")
+    parser.add_argument("pipeline", choices=list(PIPELINES))
+    parser.add_argument("--grid", nargs="*", default=[], metavar="NAME=V1,V2",
+                        help=f"values of {', '.join(asdict(SweepParams()))}")
+    parser.add_argument("--random", type=int, default=0, metavar="SAMPLES",
+                        help="random search with --bounds instead of a grid")
+    parser.add_argument("--bounds", nargs="*", default=[], metavar="NAME=LOW,HIGH")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--steps", type=int, default=None, help="only the first steps")
+    parser.add_argument("--data", type=Path, default=None)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--output", type=Path, default=Path("sweep.json"))
+    args = parser.parse_args()
+
+    if args.random > 0:
+        bounds = {name: tuple(values) for name, values in parse_values(args.bounds).items()}
+        configs = random_search(bounds, args.random, args.seed)
+    else:
+        configs = grid(parse_values(args.grid))
+
+    data = PIPELINES[args.pipeline][0](args.data)
+    t0 = time.perf_counter()
+    results = run_sweep(args.pipeline, configs, data, args.steps, args.workers)
+    print(f"{len(results)} configurations in {time.perf_counter() - t0:.1f} s")
+
+    args.output.write_text(json.dumps(results, indent=2))
+    for r in sorted(results, key=lambda r: (r.get("RMSE") is None, r.get("RMSE"))):
+        params = ", ".join(f"{k}={v:.3g}" for k, v in r["params"].items() if v is not None)
+        if r["error"] is not None:
+            print(f"  {params}: {r['error']}")
+            continue
+        print(f"{'*' if r['pareto'] else ' '} {params}: RMSE {r['RMSE']:.3f}, ANIS {r['ANIS'] or float('nan'):.2f}, "
+              f"{r['landmarks']} landmarks, {r['wall_time']:.1f} s")
+
+
+if __name__ == "__main__":
+    main()
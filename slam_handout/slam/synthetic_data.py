@@ -0,0 +1,253 @@
+from typing import List, Optional, Tuple
+from dataclasses import dataclass, asdict
+from pathlib import Path
+import argparse
+import json
+import numpy as np
+from scipy.io import savemat
+from scipy.spatial import cKDTree
+import utils
+
+
+@dataclass
+class SimulationConfig:
+    """Parameters of a synthetic SLAM dataset, see simulate."""
+
+    # the landmarks are uniform in a square of world_size x world_size meters
+    world_size: float = 200.0
+    # landmarks per square meter
+    landmark_density: float = 0.0025
+    num_steps: int = 1000
+    # distance driven per step
+    speed: float = 0.5
+    max_range: float = 80.0
+    field_of_view: float = 2 * np.pi
+    detection_prob: float = 0.9
+    # mean number of false alarms per step, uniform in the field of view
+    clutter_rate: float = 0.0
+    # odometry and measurement noise standard deviations, [x, y, heading], [range, bearing]
+    odometry_std: Tuple[float, float, float] = (0.025, 0.025, 0.4 * np.pi / 180)
+    measurement_std: Tuple[float, float] = (0.1, 1 * np.pi / 180)
+    seed: Optional[int] = None
+
+    @property
+    def Q(self) -> np.ndarray:
+        return np.diag(self.odometry_std) ** 2
+
+    @property
+    def R(self) -> np.ndarray:
+        return np.diag(self.measurement_std) ** 2
+
+
+@dataclass
+class SimulatedDataset:
+    """A synthetic dataset with the contents of data/simulatedSLAM.mat.
+
+    The arrays are row major: landmarks (#landmarks, 2), odometry (K, 3) and poseGT
+    (K + 1, 3). The measurements of step k, taken at poseGT[k], are
+    z[offsets[k]:offsets[k + 1]] as [range, bearing] rows, see z_list. The detected
+    landmark of each measurement is in landmark_ids, -1 for false alarms.
+    """
+
+    config: SimulationConfig
+    landmarks: np.ndarray
+    odometry: np.ndarray
+    poseGT: np.ndarray
+    z: np.ndarray
+    offsets: np.ndarray
+    landmark_ids: np.ndarray
+
+    FILES = ("landmarks", "odometry", "poseGT", "z", "offsets", "landmark_ids")
+
+    @property
+    def K(self) -> int:
+        return self.odometry.shape[0]
+
+    def z_list(self) -> List[np.ndarray]:
+        """The measurements of each step as in the run scripts, shapes (#detections_k, 2)."""
+        return np.split(self.z, self.offsets[1:-1])
+
+    def save(self, path: Path):
+        """Save to the directory path, one .npy file per array, see load."""
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in self.FILES:
+            np.save(path / f"{name}.npy", getattr(self, name))
+        config = asdict(self.config)
+        (path / "config.json").write_text(json.dumps(config, indent=4))
+
+    @classmethod
+    def load(cls, path: Path, mmap_mode: Optional[str] = "r") -> "SimulatedDataset":
+        """Load a dataset saved with save, memory mapped by default."""
+        path = Path(path)
+        config = json.loads((path / "config.json").read_text())
+        config = SimulationConfig(**{k: tuple(v) if isinstance(v, list) else v for k, v in config.items()})
+        arrays = {name: np.load(path / f"{name}.npy", mmap_mode=mmap_mode) for name in cls.FILES}
+        return cls(config, **arrays)
+
+    def save_mat(self, path: Path):
+        """Save in the layout of data/simulatedSLAM.mat, z is a cell of (2, #detections_k)."""
+        z = np.empty((self.K, 1), dtype=object)
+        for k, zk in enumerate(self.z_list()):
+            z[k, 0] = zk.T
+        savemat(str(path), dict(
+            landmarks=self.landmarks.T, odometry=self.odometry.T, poseGT=self.poseGT.T, z=z))
+
+
+def simulate(config: SimulationConfig, chunk_size: int = 10000) -> SimulatedDataset:
+    """Generate a synthetic SLAM dataset.
+
+    The robot drives at constant speed along a random smooth closed curve through the
+    world, so it revisits the same areas. The odometry is the exact increment of poseGT
+    with the odometry noise added. Every landmark within max_range and field_of_view is
+    detected with detection_prob, and a Poisson number of false alarms is added, in
+    random order. The detections are found with a kd-tree, chunk_size steps at a time, and
+    the result depends on chunk_size through the order of the random draws.
+
+    Parameters
+    ----------
+    config : SimulationConfig
+        the parameters, the result only depends on them
+    chunk_size : int, optional
+        steps per kd-tree query, by default 10000
+
+    Returns
+    -------
+    SimulatedDataset
+    """
+    rng = np.random.default_rng(config.seed)
+    K = config.num_steps
+
+    numLmk = int(round(config.landmark_density * config.world_size ** 2))
+    landmarks = rng.uniform(0, config.world_size, (numLmk, 2))
+
+    poseGT = trajectory(config, rng)
+
+    # the exact odometry, f(poseGT[k], u[k]) = poseGT[k + 1], and the measured
+    c = np.cos(poseGT[:-1, 2])
+    s = np.sin(poseGT[:-1, 2])
+    d = np.diff(poseGT[:, :2], axis=0)
+    odometry = np.column_stack((
+        c * d[:, 0] + s * d[:, 1],
+        -s * d[:, 0] + c * d[:, 1],
+        utils.wrapToPi(np.diff(poseGT[:, 2])),
+    ))
+    odometry += rng.standard_normal((K, 3)) * config.odometry_std
+
+    # the measurements chunk_size steps at a time, bounding the memory of the temporaries
+    tree = cKDTree(landmarks)
+    chunks = [measurements(config, rng, tree, poseGT[k0:min(k0 + chunk_size, K)])
+              for k0 in range(0, K, chunk_size)]
+    counts = np.concatenate([chunk[0] for chunk in chunks])
+    offsets = np.zeros(K + 1, dtype=int)
+    np.cumsum(counts, out=offsets[1:])
+    z = np.concatenate([chunk[1] for chunk in chunks])
+    ids = np.concatenate([chunk[2] for chunk in chunks])
+
+    return SimulatedDataset(config, landmarks, odometry, poseGT, z, offsets, ids)
+
+
+def measurements(
+    config: SimulationConfig, rng: np.random.Generator, tree: cKDTree, poses: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """The measurements at poses, see simulate.
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray, np.ndarray], shapes=(#poses,), (#measurements, 2), (#measurements,)
+        the number of measurements at each pose, the measurements sorted by pose and
+        the landmark of each measurement, -1 for false alarms
+    """
+    K = poses.shape[0]
+    in_range = tree.query_ball_point(poses[:, :2], config.max_range)
+    steps = np.repeat(np.arange(K), [len(lmks) for lmks in in_range])
+    ids = np.fromiter((i for lmks in in_range for i in lmks), dtype=int, count=steps.shape[0])
+
+    # range and bearing of the landmarks in range
+    x = poses[steps]
+    delta = tree.data[ids] - x[:, :2]
+    zr = np.hypot(delta[:, 0], delta[:, 1])
+    zb = utils.wrapToPi(np.arctan2(delta[:, 1], delta[:, 0]) - x[:, 2])
+    detected = (np.abs(zb) <= config.field_of_view / 2) & (
+        rng.random(ids.shape[0]) < config.detection_prob)
+    steps, ids, zr, zb = steps[detected], ids[detected], zr[detected], zb[detected]
+
+    # false alarms, uniform in area over the field of view
+    clutter_steps = np.repeat(np.arange(K), rng.poisson(config.clutter_rate, K))
+    n = clutter_steps.shape[0]
+    steps = np.concatenate((steps, clutter_steps))
+    ids = np.concatenate((ids, np.full(n, -1)))
+    zr = np.concatenate((zr, config.max_range * np.sqrt(rng.random(n))))
+    zb = np.concatenate((zb, config.field_of_view * (rng.random(n) - 0.5)))
+
+    z = np.column_stack((zr, zb))
+    z += rng.standard_normal(z.shape) * config.measurement_std
+    z[:, 0] = np.abs(z[:, 0])
+    z[:, 1] = utils.wrapToPi(z[:, 1])
+
+    # sort by step, in random order within a step
+    order = np.lexsort((rng.random(steps.shape[0]), steps))
+    return np.bincount(steps, minlength=K), z[order], ids[order]
+
+
+def trajectory(config: SimulationConfig, rng: np.random.Generator) -> np.ndarray:
+    """A random smooth closed curve in the world, driven at constant speed.
+
+    The curve is a Lissajous figure with a random low frequency wobble, resampled by arc
+    length. The heading is along the direction of motion.
+
+    Returns
+    -------
+    np.ndarray, shape=(num_steps + 1, 3)
+        the poses
+    """
+    a, b = [(1, 1), (1, 2), (2, 1), (2, 3), (3, 2)][rng.integers(5)]
+    phase = rng.uniform(0, 2 * np.pi)
+    wobble_freqs = rng.integers(3, 7, size=2)
+    wobble_amps = rng.uniform(0, 0.1, size=2)
+    wobble_phases = rng.uniform(0, 2 * np.pi, size=2)
+
+    def curve(tau):
+        r = 1 + (wobble_amps * np.sin(np.outer(tau, wobble_freqs) + wobble_phases)).sum(axis=1)
+        p = np.column_stack((np.sin(a * tau + phase), np.sin(b * tau))) * r[:, None]
+        return config.world_size * (0.5 + 0.35 * p)
+
+    # one period finely sampled, and its arc length
+    num_fine = max(10000, int(20 * 10 * config.world_size / config.speed))
+    tau = np.linspace(0, 2 * np.pi, num_fine + 1)
+    fine = curve(tau)
+    arc = np.concatenate(([0], np.cumsum(np.hypot(*np.diff(fine, axis=0).T))))
+
+    s = (config.speed * np.arange(config.num_steps + 2)) % arc[-1]
+    tau_s = np.interp(s, arc, tau)
+    p = curve(tau_s)
+    d = np.diff(p, axis=0)
+    heading = np.arctan2(d[:, 1], d[:, 0])
+
+    return np.column_stack((p[:-1], heading))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Generate a synthetic SLAM dataset.")
+    parser.add_argument("output", type=Path, help="directory, or a .mat file")
+    for name, default in asdict(SimulationConfig()).items():
+        if isinstance(default, tuple):
+            parser.add_argument(f"--{name}", type=float, nargs=len(default), default=default)
+        else:
+            parser.add_argument(f"--{name}", type=type(default) if default is not None else int,
+                                default=default)
+    args = vars(parser.parse_args())
+    output = args.pop("output")
+    args = {k: tuple(v) if isinstance(v, list) else v for k, v in args.items()}
+
+    dataset = simulate(SimulationConfig(**args))
+    if output.suffix == ".mat":
+        dataset.save_mat(output)
+    else:
+        dataset.save(output)
+    print(f"{dataset.K} steps, {dataset.landmarks.shape[0]} landmarks, "
+          f"{dataset.z.shape[0]} measurements written to {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -6,3 +6,22 @@ def wrapToPi(angle):
 def rotmat2d(angle):
     return np.array([[np.cos(angle), -np.sin(angle)],
                      [np.sin(angle),  np.cos(angle)]])
+
+
+def add_block_diag(A, block):
+    """Add block on all the diagonal blocks of A in place, that is A += kron(I, block).
+
+    A does not need to be contiguous, and kron(I, block) is never formed.
+    """
+    b = block.shape[0]
+    idxs = np.arange(0, A.shape[0], b)
+    for i in range(b):
+        for j in range(b):
+            A[idxs + i, idxs + j] += block[i, j]
+    return A
+
+
+def matmul_block_diag(A, block):
+    """Calculate A @ kron(I, block) without forming kron(I, block)."""
+    b = block.shape[0]
+    return (A.reshape(A.shape[0], -1, b) @ block).reshape(A.shape)
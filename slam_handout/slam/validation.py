@@ -0,0 +1,106 @@
+from collections import Counter
+from dataclasses import dataclass, field
+from enum import IntEnum
+import logging
+import numpy as np
+import scipy.linalg as la
+
+logger = logging.getLogger(__name__)
+
+
+class ValidationLevel(IntEnum):
+    """How much checking of the SLAM state is done in the filter steps.
+
+    OFF: nothing, for release runs
+    CHEAP: shapes and NaNs in eta and the diagonal of P, O(n)
+    SAMPLED: CHEAP + symmetry and PSD (Cholesky attempt) every sample_every check
+    FULL: CHEAP + symmetry and PSD (eigenvalues) at every check, O(n^3)
+    """
+
+    OFF = 0
+    CHEAP = 1
+    SAMPLED = 2
+    FULL = 3
+
+
+@dataclass
+class CovarianceValidator:
+    """Checks eta and P and counts (and logs) violations instead of asserting.
+
+    Violations are counted in violations, keyed on "<where>: <what>".
+    """
+
+    level: ValidationLevel = ValidationLevel.OFF
+    sample_every: int = 100
+    # relative tolerance on symmetry and negative eigenvalues
+    tol: float = 1e-8
+    violations: Counter = field(default_factory=Counter)
+    num_checks: int = 0
+
+    def check(self, where: str, eta: np.ndarray, P: np.ndarray) -> bool:
+        """Check eta and P according to the validation level.
+
+        Parameters
+        ----------
+        where : str
+            name of the place of the check, used in the report
+        eta : np.ndarray, shape=(3 + 2*#landmarks,)
+            the robot state and map concatenated
+        P : np.ndarray, shape=(3 + 2*#landmarks,)*2
+            the covariance of eta
+
+        Returns
+        -------
+        bool
+            False if any violation was found
+        """
+        if self.level == ValidationLevel.OFF:
+            return True
+
+        self.num_checks += 1
+
+        if eta.shape * 2 != P.shape:
+            return self.report(where, "eta and P shape do not match")
+
+        Pdiag = P.diagonal()
+        if not (np.all(np.isfinite(eta)) and np.all(np.isfinite(Pdiag))):
+            return self.report(where, "NaN or inf in eta or P")
+
+        if np.any(Pdiag < 0):
+            return self.report(where, "negative variance in P")
+
+        if self.level == ValidationLevel.SAMPLED:
+            if self.num_checks % self.sample_every == 0:
+                return self.check_symmetric(where, P) and self.check_psd_cholesky(where, P)
+        elif self.level == ValidationLevel.FULL:
+            return self.check_symmetric(where, P) and self.check_psd_eig(where, P)
+
+        return True
+
+    def check_symmetric(self, where: str, P: np.ndarray) -> bool:
+        scale = max(np.abs(P).max(initial=0), 1)
+        if not np.allclose(P, P.T, rtol=0, atol=self.tol * scale):
+            return self.report(where, "P not symmetric")
+        return True
+
+    def check_psd_cholesky(self, where: str, P: np.ndarray) -> bool:
+        # P is allowed to be singular, so add a small jitter before the Cholesky attempt
+        jitter = self.tol * max(P.diagonal().max(initial=0), 1)
+        try:
+            la.cholesky(P + jitter * np.eye(P.shape[0]), lower=True)
+        except la.LinAlgError:
+            return self.report(where, "P not PSD")
+        return True
+
+    def check_psd_eig(self, where: str, P: np.ndarray) -> bool:
+        eigs = np.linalg.eigvalsh(P)
+        if eigs.size > 0 and eigs[0] < -self.tol * max(eigs[-1], 1):
+            return self.report(where, "P not PSD")
+        return True
+
+    def report(self, where: str, what: str) -> bool:
+        """Count and log a violation, always returns False."""
+        key = f"{where}: {what}"
+        self.violations[key] += 1
+        logger.warning("%s (%d times)", key, self.violations[key])
+        return False
@@ -1,5 +1,15 @@
+from concurrent.futures import ProcessPoolExecutor
+import os
 import numpy as np
 
+# bump when detectTrees changes, so that cached detections are not used
+DETECT_TREES_VERSION = 1
+
+# the fixed beam angles of the laser scans and their cos and sin
+AA = np.array(range(361)) * np.pi / 360
+COS_AA = np.cos(AA)
+SIN_AA = np.sin(AA)
+
 # Shamelessly stolen from here: https://github.com/ramanans1/EKF-SLAM/blob/master/tree_extraction.py
 # Small modifications by Odin Aleksander Severinsen
 def detectTrees(scan):
@@ -15,13 +25,11 @@ def detectTrees(scan):
 
     RR = scan
 
-    AA = np.array(range(361)) * np.pi / 360
-
     (ii1,) = np.where(RR < M11)
 
     L1 = len(ii1)
     if L1 < 1:
-        return []
+        return np.zeros((0, 2))
 
     R1 = RR[ii1]
     A1 = AA[ii1]
@@ -42,10 +50,13 @@ def detectTrees(scan):
     A2u = A1[ii2u]
     R2u = R1[ii2u]
 
-    x2 = R2 * np.cos(A2)
-    y2 = R2 * np.sin(A2)
-    x2u = R2u * np.cos(A2u)
-    y2u = R2u * np.sin(A2u)
+    # cos and sin from the precomputed tables through the beam indices
+    beams2 = ii1[ii2]
+    beams2u = ii1[ii2u]
+    x2 = R2 * COS_AA[beams2]
+    y2 = R2 * SIN_AA[beams2]
+    x2u = R2u * COS_AA[beams2u]
+    y2u = R2u * SIN_AA[beams2u]
 
     flag = np.zeros(L2)
 
@@ -195,21 +206,95 @@ def detectTrees(scan):
     return z
 
 
+def detectTreesBatch(scans, num_workers=None, chunk_size=2000):
+    """Detect trees in all the scans, in chunks over a process pool.
+
+    Parameters
+    ----------
+    scans : np.ndarray, shape=(#scans, 361)
+        the laser scans, in the units detectTrees expects
+    num_workers : int, optional
+        number of processes, all cpus if None, and no pool if 1
+    chunk_size : int
+        number of scans per task
+
+    Returns
+    -------
+    Tuple[np.ndarray, np.ndarray], shapes=(#scans + 1,), (#detections, 2)
+        the detections of all scans in ragged layout, the detections of scan k are
+        z[offsets[k]:offsets[k + 1]]
+    """
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    chunks = [scans[k:k + chunk_size] for k in range(0, scans.shape[0], chunk_size)]
+    if num_workers > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(num_workers) as executor:
+            detections = [zk for chunk in executor.map(_detectTreesChunk, chunks)
+                          for zk in chunk]
+    else:
+        detections = [zk for chunk in chunks for zk in _detectTreesChunk(chunk)]
+
+    offsets = np.zeros(scans.shape[0] + 1, dtype=int)
+    np.cumsum([zk.shape[0] for zk in detections], out=offsets[1:])
+    z = np.concatenate(detections, axis=0) if detections else np.zeros((0, 2))
+    return offsets, z
+
+
+def _detectTreesChunk(scans):
+    return [detectTrees(scan) for scan in scans]
+
+
 def odometry(ve, alpha, dt, car):
-    vc = ve / (1 - car.H * np.tan(alpha) / car.L)
-    dp = dt * vc * np.tan(alpha) / car.L
+    """Odometry increment(s) from wheel speed ve and steering alpha over dt.
+
+    ve, alpha and dt can be scalars, giving shape (3,), or arrays broadcast to shape (N,),
+    giving shape (N, 3) with one [dx, dy, dpsi] increment per row.
+    """
+    ve, alpha, dt = np.broadcast_arrays(*(np.asarray(v, dtype=float) for v in (ve, alpha, dt)))
+    tan_alpha = np.tan(alpha)
+    vc = ve / (1 - car.H * tan_alpha / car.L)
+    dp = dt * vc * tan_alpha / car.L
     dx = dt * vc * np.sinc(dp / np.pi)
-    if np.abs(dp) < 0.001:
-        # Taylor approximation
-        dy = -dt * vc * (dp / 2 - dp ** 3 / 24 + dp ** 5 / 720)
-    else:
-        dy = dt * vc * (np.cos(dp) - 1) / dp
 
-    odo = np.array([dx, dy, dp])
+    dy = np.empty_like(dp)
+    small = np.abs(dp) < 0.001
+    # Taylor approximation
+    dps = dp[small]
+    dy[small] = -dt[small] * vc[small] * (dps / 2 - dps ** 3 / 24 + dps ** 5 / 720)
+    large = ~small
+    dpl = dp[large]
+    dy[large] = dt[large] * vc[large] * (np.cos(dpl) - 1) / dpl
+
+    odo = np.stack((dx, dy, dp), axis=-1)
 
     return odo
 
 
+def deadReckoning(x0, odos):
+    """Integrate the odometry increments odos, shape (N, 3), from the pose x0.
+
+    The same as applying EKFSLAM.f to each increment in turn, but vectorized.
+
+    Returns
+    -------
+    np.ndarray, shape=(N + 1, 3)
+        the poses, starting with x0
+    """
+    x = np.empty((odos.shape[0] + 1, 3))
+    x[0] = x0
+    psi = x0[2] + np.cumsum(odos[:, 2])
+    # heading each increment is applied in
+    psi_prev = np.concatenate(([x0[2]], psi[:-1]))
+    cos_psi = np.cos(psi_prev)
+    sin_psi = np.sin(psi_prev)
+    x[1:, 0] = x0[0] + np.cumsum(odos[:, 0] * cos_psi - odos[:, 1] * sin_psi)
+    x[1:, 1] = x0[1] + np.cumsum(odos[:, 0] * sin_psi + odos[:, 1] * cos_psi)
+    x[1:, 2] = (psi + np.pi) % (2 * np.pi) - np.pi
+
+    return x
+
+
 class Car:
     def __init__(self, L, H, a, b):
         self.L = L
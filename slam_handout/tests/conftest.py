@@ -0,0 +1,16 @@
+import os
+import pytest
+
+"""
+This file is a hack to let the debugger in vscode catch the assert statements
+"""
+
+if os.getenv('_PYTEST_RAISE', "0") != "0":
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_exception_interact(call):
+        raise call.excinfo.value
+
+    @pytest.hookimpl(tryfirst=True)
+    def pytest_internalerror(excinfo):
+        raise excinfo.value
@@ -0,0 +1,125 @@
+from dataclasses import dataclass
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+assignment_name = "slam"
+
+this_file = Path(__file__)
+tests_folder = this_file.parent
+project_folder = tests_folder.parent
+code_folder = project_folder.joinpath(assignment_name)
+
+sys.path.insert(0, str(code_folder))
+
+from association import Associator  # nopep8
+from EKFSLAM import EKFSLAM  # nopep8
+from odometry_buffer import OdometryBuffer  # nopep8
+from synthetic_data import SimulationConfig, simulate  # nopep8
+import utils  # nopep8
+
+
+@dataclass
+class GivenAssociator(Associator):
+    """Returns the associations it is given, whatever the measurements."""
+
+    a: np.ndarray
+
+    def find_associations(self, z, zpred, S):
+        return self.a.copy()
+
+
+def random_problem(rng, num_landmarks):
+    """A random state, covariance and noise, P with correlations between all the states."""
+    n = 3 + 2 * num_landmarks
+    eta = np.concatenate((rng.uniform(-5, 5, 2), rng.uniform(-np.pi, np.pi, 1),
+                          rng.uniform(-40, 40, 2 * num_landmarks)))
+    A = rng.standard_normal((n, n))
+    P = 0.1 * A @ A.T / n + 0.01 * np.eye(n)
+    Q = np.diag([0.1, 0.1, 0.01]) ** 2
+    R = np.diag([0.1, 0.5 * np.pi / 180]) ** 2
+    return eta, P, Q, R
+
+
+class Test_EKFSLAM_update:
+    @pytest.mark.parametrize("seed", range(5))
+    def test_cholesky_matches_joseph(self, seed):
+        """The Cholesky downdate of P matches the Joseph form, and the textbook Kalman gain."""
+        rng = np.random.default_rng(seed)
+        eta, P, Q, R = random_problem(rng, num_landmarks=12)
+        a = rng.permutation(12)[:8]
+        z = EKFSLAM(Q, R, do_asso=False).h(eta).reshape(-1, 2)[a] + \
+            rng.standard_normal((8, 2)) * [0.1, 0.01]
+
+        slam = EKFSLAM(Q, R, do_asso=True, associator=GivenAssociator(a))
+        slam_joseph = EKFSLAM(Q, R, do_asso=True, associator=GivenAssociator(a),
+                              joseph_form=True)
+        eta_upd, P_upd, NIS, a_upd = slam.update(eta.copy(), P.copy(), z)
+        eta_jo, P_jo, NIS_jo, _ = slam_joseph.update(eta.copy(), P.copy(), z)
+
+        assert not slam_joseph.validation.violations
+        np.testing.assert_array_equal(a_upd, a)
+        np.testing.assert_allclose(eta_upd, eta_jo, atol=1e-10)
+        np.testing.assert_allclose(P_upd, P_jo, atol=1e-10)
+        assert NIS == pytest.approx(NIS_jo)
+
+        # the textbook update with an explicit inverse of S
+        H = slam.h_jac(eta)
+        inds = np.column_stack((2 * a, 2 * a + 1)).ravel()
+        Ha = H[inds]
+        S = Ha @ P @ Ha.T + np.kron(np.eye(a.size), R)
+        W = P @ Ha.T @ np.linalg.inv(S)
+        v = z.ravel() - slam.h(eta)[inds]
+        v[1::2] = utils.wrapToPi(v[1::2])
+        np.testing.assert_allclose(eta_upd, eta + W @ v, atol=1e-10)
+        np.testing.assert_allclose(P_upd, P - W @ S @ W.T, atol=1e-10)
+        assert NIS == pytest.approx(v @ np.linalg.solve(S, v))
+
+    def test_cholesky_matches_joseph_run(self):
+        """A filter run with association and new landmarks gives the same as the Joseph form."""
+        config = SimulationConfig(num_steps=60, max_range=30.0, seed=1)
+        data = simulate(config)
+        slam = EKFSLAM(config.Q, config.R, do_asso=True)
+        slam_joseph = EKFSLAM(config.Q, config.R, do_asso=True, joseph_form=True)
+
+        eta, P = data.poseGT[0].copy(), np.zeros((3, 3))
+        eta_jo, P_jo = eta.copy(), P.copy()
+        for z_k, odo in zip(data.z_list(), data.odometry):
+            eta, P, _, a = slam.update(eta, P, z_k)
+            eta_jo, P_jo, _, a_jo = slam_joseph.update(eta_jo, P_jo, z_k)
+            np.testing.assert_array_equal(a, a_jo)
+            eta, P = slam.predict(eta, P, odo)
+            eta_jo, P_jo = slam_joseph.predict(eta_jo, P_jo, odo)
+
+        assert not slam_joseph.validation.violations
+        np.testing.assert_allclose(eta, eta_jo, atol=1e-8)
+        np.testing.assert_allclose(P, P_jo, atol=1e-8)
+
+
+class Test_EKFSLAM_predict:
+    def test_composed_matches_sequential(self):
+        """predict_batch and OdometryBuffer give the same as predict for each increment."""
+        rng = np.random.default_rng(0)
+        eta, P, Q, R = random_problem(rng, num_landmarks=6)
+        z_odos = rng.standard_normal((7, 3)) * [1, 0.2, 0.05]
+        slam = EKFSLAM(Q, R, do_asso=False)
+
+        eta_seq, P_seq = eta.copy(), P.copy()
+        for z_odo in z_odos:
+            eta_seq, P_seq = slam.predict(eta_seq, P_seq, z_odo)
+        eta_batch, P_batch = slam.predict_batch(eta.copy(), P.copy(), z_odos)
+
+        buffer = OdometryBuffer(slam)
+        eta_buf, P_buf = eta.copy(), P.copy()
+        for z_odo in z_odos:
+            x = buffer.push(eta_buf, z_odo)
+        np.testing.assert_allclose(x, eta_seq[:3], atol=1e-12)
+        # P is only touched by flush
+        np.testing.assert_array_equal(P_buf, P)
+        eta_buf, P_buf = buffer.flush(eta_buf, P_buf)
+
+        for eta_k, P_k in ((eta_batch, P_batch), (eta_buf, P_buf)):
+            np.testing.assert_allclose(eta_k, eta_seq, atol=1e-12)
+            np.testing.assert_allclose(P_k, P_seq, atol=1e-12)
+        assert buffer.count == 0
@@ -0,0 +1,229 @@
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import multiprocessing
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+from scipy.stats import chi2
+
+assignment_name = "slam"
+
+this_file = Path(__file__)
+tests_folder = this_file.parent
+project_folder = tests_folder.parent
+code_folder = project_folder.joinpath(assignment_name)
+
+sys.path.insert(0, str(code_folder))
+
+import JCBB  # nopep8
+from JCBB import NIS, num_associations, chi2isf_cached  # nopep8
+import utils  # nopep8
+
+
+def JCBB_reference(z, zbar, S, alpha1, alpha2):
+    """The recursive JCBB of the handout, with a dense individual compatibility matrix."""
+    m = z.shape[0] // 2
+
+    a = np.full(m, -1, dtype=int)
+    abest = np.full(m, -1, dtype=int)
+
+    ic = individualCompatibility_reference(z, zbar, S)
+    g2 = chi2.isf(alpha2, 2)
+    order = np.argsort(np.amin(ic, axis=1))
+    z_order = np.empty(2 * len(order), dtype=int)
+    z_order[::2] = 2 * order
+    z_order[1::2] = 2 * order + 1
+
+    abesto = JCBBrec_reference(z[z_order], zbar, S, alpha1, g2, 0, a, ic[order], abest)
+    abest[order] = abesto
+    return abest
+
+
+def JCBBrec_reference(z, zbar, S, alpha1, g2, j, a, ic, abest):
+    m = z.shape[0] // 2
+    n = num_associations(a)
+
+    if j >= m:  # end of recursion
+        if n > num_associations(abest) or (
+            (n >= num_associations(abest))
+            and (NIS(z, zbar, S, a) < NIS(z, zbar, S, abest))
+        ):
+            abest = a
+    else:  # still at least one measurement to associate
+        I = np.argsort(ic[j, ic[j, :] < g2])
+        usableinds = np.where(ic[j, :] < g2)[0]
+
+        for i in usableinds[I]:
+            a[j] = i
+            # jointly compatible?
+            if NIS(z, zbar, S, a) < chi2isf_cached(alpha1, 2 * (n + 1)):
+                ici = ic[j:, i].copy()
+                ic[j:, i] = np.inf  # landmark not available any more.
+                abest = JCBBrec_reference(z, zbar, S, alpha1, g2, j + 1, a.copy(), ic, abest)
+                ic[j:, i] = ici
+
+        if n + (m - j - 2) >= num_associations(abest):
+            a[j] = -1
+            abest = JCBBrec_reference(z, zbar, S, alpha1, g2, j + 1, a, ic, abest)
+
+    return abest
+
+
+def individualCompatibility_reference(z, zbar, S):
+    nz_bar = zbar.shape[0] // 2
+    v_all = z.reshape(-1, 1, 2, 1) - zbar.reshape(1, -1, 2, 1)
+    idxs = np.arange(nz_bar)[:, None] * 2 + np.arange(2)[None]
+    S_all = S[idxs[..., None], idxs[:, None]]
+    return (v_all * np.linalg.solve(S_all[None], v_all)).sum(axis=(2, 3))
+
+
+def random_scan(rng, num_landmarks, num_measurements, num_clutter):
+    """Measurements of random landmarks with a correlated innovation covariance S.
+
+    The false alarms are placed near other landmarks, so there are several individually
+    compatible landmarks for many of the measurements.
+    """
+    n = num_landmarks
+    zbar = np.column_stack(
+        (rng.uniform(5, 40, n), rng.uniform(-np.pi / 2, np.pi / 2, n))).ravel()
+    # a common robot pose error correlates all the predicted measurements
+    A = rng.standard_normal((2 * n, 3)) * [0.5, 0.5, 0.02]
+    S = A @ A.T + np.kron(np.eye(n), np.diag([0.3, 0.02]) ** 2)
+
+    lmks = rng.choice(n, num_measurements, replace=False)
+    inds = np.column_stack((2 * lmks, 2 * lmks + 1)).ravel()
+    noise = np.linalg.cholesky(S[inds[:, None], inds]) @ rng.standard_normal(inds.size)
+    z = (zbar[inds] + noise).reshape(-1, 2)
+    clutter = zbar.reshape(-1, 2)[rng.choice(n, num_clutter)] + \
+        rng.standard_normal((num_clutter, 2)) * [1, 0.05]
+    z = np.concatenate((z, clutter))[rng.permutation(num_measurements + num_clutter)]
+    return z.ravel(), zbar, S
+
+
+class Test_JCBB:
+    @pytest.mark.parametrize("seed", range(40))
+    def test_matches_reference(self, seed):
+        rng = np.random.default_rng(seed)
+        z, zbar, S = random_scan(rng, num_landmarks=15, num_measurements=8, num_clutter=3)
+
+        a = JCBB.JCBB(z, zbar, S, 1e-3, 1e-4)
+        np.testing.assert_array_equal(a, JCBB_reference(z, zbar, S, 1e-3, 1e-4))
+
+    def test_no_landmarks(self):
+        rng = np.random.default_rng(0)
+        z, _, _ = random_scan(rng, num_landmarks=5, num_measurements=3, num_clutter=0)
+        a = JCBB.JCBB(z, np.zeros(0), np.zeros((0, 0)), 1e-3, 1e-4)
+        np.testing.assert_array_equal(a, np.full(3, -1))
+
+    def test_budget(self):
+        """With a node budget the search stops early, and returns a valid hypothesis."""
+        rng = np.random.default_rng(1)
+        z, zbar, S = random_scan(rng, num_landmarks=30, num_measurements=15, num_clutter=5)
+
+        stats = JCBB.JCBBStats()
+        a = JCBB.JCBB(z, zbar, S, 1e-3, 1e-4, max_nodes=20, stats=stats)
+
+        assert stats.truncated
+        assert stats.nodes <= 20
+        used = a[a > -1]
+        assert np.unique(used).size == used.size
+        if used.size > 0:
+            assert NIS(z, zbar, S, a) < chi2.isf(1e-3, 2 * used.size)
+
+
+class Test_IncrementalNIS:
+    @pytest.mark.parametrize("seed", range(5))
+    def test_matches_NIS(self, seed):
+        """Pushing and popping associations gives the joint NIS of the associations kept."""
+        rng = np.random.default_rng(seed)
+        z, zbar, S = random_scan(rng, num_landmarks=12, num_measurements=8, num_clutter=0)
+        m = z.shape[0] // 2
+        pushes = list(zip(rng.permutation(m), rng.permutation(12)[:m]))
+
+        joint_nis = JCBB.IncrementalNIS(z, zbar, S, m)
+        a = np.full(m, -1, dtype=int)
+        nises = [0.0]
+        for j, i in pushes:
+            # a push that is not committed is overwritten by the next one
+            joint_nis.try_push(j, (i + 1) % 12)
+
+            a[j] = i
+            assert joint_nis.try_push(j, i) == pytest.approx(NIS(z, zbar, S, a))
+            joint_nis.commit()
+            assert joint_nis.nis == pytest.approx(NIS(z, zbar, S, a))
+            nises.append(joint_nis.nis)
+
+        for k in range(m, 0, -1):
+            assert joint_nis.k == k
+            assert joint_nis.nis == nises[k]
+            joint_nis.pop()
+        assert joint_nis.k == 0 and joint_nis.nis == 0
+
+        # and the pushes after popping see only the associations kept
+        j, i = pushes[0]
+        a = np.full(m, -1, dtype=int)
+        a[j] = i
+        assert joint_nis.try_push(j, i) == pytest.approx(NIS(z, zbar, S, a))
+
+
+class Test_individualCandidates:
+    @pytest.mark.parametrize("seed", range(10))
+    def test_matches_dense(self, seed):
+        """The gated pairs and their NIS are those of the dense individual NIS matrix."""
+        rng = np.random.default_rng(seed)
+        z, zbar, S = random_scan(rng, num_landmarks=40, num_measurements=20, num_clutter=10)
+        g2 = chi2.isf(1e-4, 2)
+
+        # the individual NIS of every pair, with the bearing innovation wrapped as in NIS
+        zr, zbarr = z.reshape(-1, 2), zbar.reshape(-1, 2)
+        ic = np.empty((zr.shape[0], zbarr.shape[0]))
+        for j in range(zr.shape[0]):
+            for i in range(zbarr.shape[0]):
+                v = zr[j] - zbarr[i]
+                v[1] = utils.wrapToPi(v[1])
+                ic[j, i] = v @ np.linalg.solve(S[2 * i:2 * i + 2, 2 * i:2 * i + 2], v)
+        cand = JCBB.individualCandidates(z, zbar, S, g2)
+
+        np.testing.assert_allclose(JCBB.individualCompatibility(z, zbar, S), ic)
+        assert cand.offsets.shape[0] == ic.shape[0] + 1
+        for j in range(ic.shape[0]):
+            landmarks, nis = cand.row(j)
+            inside = np.flatnonzero(ic[j] < g2)
+            np.testing.assert_array_equal(landmarks, inside[np.argsort(ic[j, inside])])
+            np.testing.assert_allclose(nis, ic[j, landmarks])
+            if inside.size > 0:
+                assert cand.nis_min[j] == pytest.approx(ic[j].min())
+
+    def test_no_landmarks(self):
+        rng = np.random.default_rng(0)
+        z, _, _ = random_scan(rng, num_landmarks=5, num_measurements=3, num_clutter=0)
+        cand = JCBB.individualCandidates(z, np.zeros(0), np.zeros((0, 0)), chi2.isf(1e-4, 2))
+        assert cand.nis.size == 0
+        assert np.all(np.isinf(cand.nis_min))
+
+
+class Test_JCBBparallel:
+    @pytest.mark.parametrize("seed", range(10))
+    def test_matches_serial_threads(self, seed):
+        rng = np.random.default_rng(seed)
+        z, zbar, S = random_scan(rng, num_landmarks=20, num_measurements=10, num_clutter=4)
+
+        expected = JCBB.JCBB(z, zbar, S, 1e-3, 1e-4, prune_ties=False)
+        with ThreadPoolExecutor(3) as executor:
+            a = JCBB.JCBBparallel(z, zbar, S, 1e-3, 1e-4, executor, JCBB.SharedBound(), 3,
+                                  min_measurements=2)
+        np.testing.assert_array_equal(a, expected)
+
+    def test_matches_serial_processes(self):
+        shared_bound = multiprocessing.Value("i", 0)
+        with ProcessPoolExecutor(2, initializer=JCBB.JCBBpool_init,
+                                 initargs=(shared_bound,)) as executor:
+            for seed in range(3):
+                rng = np.random.default_rng(seed)
+                z, zbar, S = random_scan(
+                    rng, num_landmarks=20, num_measurements=10, num_clutter=4)
+
+                expected = JCBB.JCBB(z, zbar, S, 1e-3, 1e-4, prune_ties=False)
+                a = JCBB.JCBBparallel(z, zbar, S, 1e-3, 1e-4, executor, shared_bound, 2,
+                                      min_measurements=2)
+                np.testing.assert_array_equal(a, expected)
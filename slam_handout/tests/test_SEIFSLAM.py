@@ -0,0 +1,63 @@
+import sys
+from pathlib import Path
+import numpy as np
+
+assignment_name = "slam"
+
+this_file = Path(__file__)
+tests_folder = this_file.parent
+project_folder = tests_folder.parent
+code_folder = project_folder.joinpath(assignment_name)
+
+sys.path.insert(0, str(code_folder))
+
+from EKFSLAM import EKFSLAM  # nopep8
+from SEIFSLAM import SEIFSLAM  # nopep8
+from synthetic_data import SimulationConfig, simulate  # nopep8
+
+
+def run_both(config, **seif_kwargs):
+    """Run EKFSLAM and SEIFSLAM side by side on simulated data, asserting equal associations.
+
+    The EKF starts with the prior variance SEIF adds to the initial state, so both start
+    from the same distribution.
+    """
+    data = simulate(config)
+    ekf = EKFSLAM(config.Q, config.R, do_asso=True)
+    seif = SEIFSLAM(config.Q, config.R, do_asso=True, **seif_kwargs)
+
+    eta = data.poseGT[0].copy()
+    P = seif.prior_var * np.eye(3)
+    eta_s = eta.copy()
+    info = seif.init_information(eta_s, np.zeros((3, 3)))
+    for z_k, odo in zip(data.z_list(), data.odometry):
+        eta, P, _, a = ekf.update(eta, P, z_k)
+        eta_s, info, _, a_s = seif.update(eta_s, info, z_k)
+        np.testing.assert_array_equal(a_s, a)
+
+        eta, P = ekf.predict(eta, P, odo)
+        eta_s, info = seif.predict(eta_s, info, odo)
+
+    return data, eta, P, eta_s, info, seif
+
+
+class Test_SEIFSLAM:
+    def test_without_sparsification_matches_ekf(self):
+        """With every landmark active and exact mean recovery, SEIF is the EKF in information form."""
+        config = SimulationConfig(num_steps=80, max_range=30.0, seed=2)
+        _, eta, P, eta_s, info, seif = run_both(
+            config, max_active=1000, recover_every=1, sensor_range=1e4)
+
+        np.testing.assert_allclose(eta_s, eta, atol=1e-8)
+        P_s = seif.covariance(info)
+        np.testing.assert_allclose(P_s, P, atol=1e-10)
+        np.testing.assert_allclose(
+            seif.marginal_covariance(info, np.arange(3)), P_s[:3, :3], atol=1e-12)
+
+    def test_sparsified_close_to_ekf(self):
+        config = SimulationConfig(num_steps=200, max_range=30.0, seed=2)
+        data, eta, _, eta_s, _, _ = run_both(config, max_active=8, sensor_range=40)
+
+        assert eta_s.shape == eta.shape
+        assert np.abs(eta_s - eta).max() < 0.1
+        assert np.linalg.norm(eta_s[:2] - data.poseGT[-1, :2]) < 0.5
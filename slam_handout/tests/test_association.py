@@ -0,0 +1,50 @@
+import sys
+from pathlib import Path
+import numpy as np
+
+assignment_name = "slam"
+
+this_file = Path(__file__)
+tests_folder = this_file.parent
+project_folder = tests_folder.parent
+code_folder = project_folder.joinpath(assignment_name)
+
+sys.path.insert(0, str(code_folder))
+
+from association import JCBBAssociator, RJCAssociator  # nopep8
+from EKFSLAM import EKFSLAM  # nopep8
+import JCBB  # nopep8
+from .test_JCBB import random_scan  # nopep8
+
+
+class Test_JCBBAssociator:
+    def test_close_shuts_pool_down(self):
+        """Leaving the EKFSLAM context shuts down the pool, which is started again on use."""
+        rng = np.random.default_rng(0)
+        z, zbar, S = random_scan(rng, num_landmarks=20, num_measurements=10, num_clutter=4)
+        expected = JCBB.JCBB(z, zbar, S, 1e-3, 1e-4, prune_ties=False)
+        associator = JCBBAssociator(np.array([1e-3, 1e-4]), parallel=True, num_workers=2,
+                                    executor="thread", min_parallel_measurements=2)
+
+        with EKFSLAM(np.eye(3), np.eye(2), do_asso=True, associator=associator):
+            np.testing.assert_array_equal(associator.find_associations(z, zbar, S), expected)
+            pool = associator._pool
+            assert pool is not None
+        assert associator._pool is None
+        assert pool._shutdown
+
+        with associator:
+            np.testing.assert_array_equal(associator.find_associations(z, zbar, S), expected)
+            assert associator._pool is not None
+        assert associator._pool is None
+
+
+class Test_RJCAssociator:
+    def test_small_scan_is_plain_JCBB(self):
+        """Scans with fewer measurements than sample_size are not sampled from."""
+        rng = np.random.default_rng(1)
+        z, zbar, S = random_scan(rng, num_landmarks=20, num_measurements=8, num_clutter=3)
+        associator = RJCAssociator(np.array([1e-3, 1e-4]), sample_size=12, min_measurements=10)
+
+        np.testing.assert_array_equal(
+            associator.find_associations(z, zbar, S), JCBB.JCBB(z, zbar, S, 1e-3, 1e-4))
@@ -0,0 +1,84 @@
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+assignment_name = "slam"
+
+this_file = Path(__file__)
+tests_folder = this_file.parent
+project_folder = tests_folder.parent
+code_folder = project_folder.joinpath(assignment_name)
+
+sys.path.insert(0, str(code_folder))
+
+from compressed_ekf import CompressedEKFSLAM  # nopep8
+from EKFSLAM import EKFSLAM  # nopep8
+from synthetic_data import SimulationConfig, simulate  # nopep8
+
+
+def run_both(config, sensor_range, refresh_distance):
+    """Run EKFSLAM and CompressedEKFSLAM on the same simulated data.
+
+    Returns the final EKF state and covariance, the refreshed CEKF ones, and the CEKF.
+    """
+    data = simulate(config)
+    slam = EKFSLAM(config.Q, config.R, do_asso=True)
+    cekf_slam = EKFSLAM(config.Q, config.R, do_asso=True)
+
+    eta, P = data.poseGT[0].copy(), np.zeros((3, 3))
+    cekf = CompressedEKFSLAM(cekf_slam, eta.copy(), P.copy(), sensor_range=sensor_range,
+                             refresh_distance=refresh_distance)
+    for z_k, odo in zip(data.z_list(), data.odometry):
+        eta, P, NIS, a = slam.update(eta, P, z_k)
+        NIS_c, a_c = cekf.update(z_k)
+        np.testing.assert_array_equal(a_c, a)
+        assert NIS_c == pytest.approx(NIS)
+
+        eta, P = slam.predict(eta, P, odo)
+        cekf.predict(odo)
+
+    eta_c, P_c = cekf.refresh()
+    return eta, P, eta_c, P_c, cekf
+
+
+class Test_CompressedEKFSLAM:
+    def test_all_active_matches_ekf(self):
+        config = SimulationConfig(num_steps=80, max_range=30.0, seed=2)
+        eta, P, eta_c, P_c, cekf = run_both(config, sensor_range=1e4, refresh_distance=5)
+
+        assert cekf.num_refreshes > 2
+        np.testing.assert_allclose(eta_c, eta, atol=1e-8)
+        np.testing.assert_allclose(P_c, P, atol=1e-8)
+
+    def test_local_region_matches_ekf(self):
+        """With the measured landmarks always active, the passive part is exact as well."""
+        config = SimulationConfig(num_steps=150, max_range=20.0, seed=3)
+        eta, P, eta_c, P_c, cekf = run_both(config, sensor_range=40, refresh_distance=10)
+
+        assert cekf.num_refreshes > 2
+        # the active region of the last refresh did not hold the whole map
+        assert cekf.passive.size > 0
+        np.testing.assert_allclose(eta_c, eta, atol=1e-8)
+        np.testing.assert_allclose(P_c, P, atol=1e-8)
+
+    def test_predict_batch_matches_predict(self):
+        config = SimulationConfig(num_steps=20, max_range=30.0, seed=4)
+        data = simulate(config)
+        slam = EKFSLAM(config.Q, config.R, do_asso=True)
+
+        eta, P = data.poseGT[0].copy(), np.zeros((3, 3))
+        for z_k, odo in zip(data.z_list()[:10], data.odometry[:10]):
+            eta, P, _, _ = slam.update(eta, P, z_k)
+            eta, P = slam.predict(eta, P, odo)
+
+        cekf = CompressedEKFSLAM(slam, eta, P)
+        cekf_batch = CompressedEKFSLAM(slam, eta, P)
+        for odo in data.odometry[10:]:
+            cekf.predict(odo)
+        cekf_batch.predict_batch(data.odometry[10:])
+
+        eta_c, P_c = cekf.refresh()
+        eta_b, P_b = cekf_batch.refresh()
+        np.testing.assert_allclose(eta_b, eta_c, atol=1e-10)
+        np.testing.assert_allclose(P_b, P_c, atol=1e-10)
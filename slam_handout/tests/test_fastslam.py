@@ -0,0 +1,125 @@
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+assignment_name = "slam"
+
+this_file = Path(__file__)
+tests_folder = this_file.parent
+project_folder = tests_folder.parent
+code_folder = project_folder.joinpath(assignment_name)
+
+sys.path.insert(0, str(code_folder))
+
+from EKFSLAM import EKFSLAM  # nopep8
+from fastslam import FastSLAM, LandmarkMap  # nopep8
+from synthetic_data import SimulationConfig, simulate  # nopep8
+
+
+def random_landmarks(rng, n):
+    means = rng.uniform(-100, 100, (n, 2))
+    A = rng.standard_normal((n, 2, 2))
+    covs = A @ A.transpose(0, 2, 1) + np.eye(2)
+    return means, covs
+
+
+class Test_LandmarkMap:
+    def test_matches_dense(self):
+        """Appends and scattered sets give the same as plain arrays, also across chunks."""
+        rng = np.random.default_rng(0)
+        lmap = LandmarkMap(chunk_size=4)
+        means = np.zeros((0, 2))
+        covs = np.zeros((0, 2, 2))
+        for _ in range(10):
+            new_means, new_covs = random_landmarks(rng, rng.integers(0, 7))
+            lmap.append(new_means, new_covs)
+            means = np.concatenate((means, new_means))
+            covs = np.concatenate((covs, new_covs))
+
+            inds = rng.permutation(means.shape[0])[:rng.integers(0, means.shape[0] + 1)]
+            set_means, set_covs = random_landmarks(rng, inds.shape[0])
+            lmap.set(inds, set_means, set_covs)
+            means[inds] = set_means
+            covs[inds] = set_covs
+
+            assert lmap.num_landmarks == means.shape[0]
+            np.testing.assert_array_equal(lmap.all_means(), means)
+            order = rng.permutation(means.shape[0])
+            got_means, got_covs = lmap.get(order)
+            np.testing.assert_array_equal(got_means, means[order])
+            np.testing.assert_array_equal(got_covs, covs[order])
+
+    def test_copy_on_write(self):
+        rng = np.random.default_rng(1)
+        lmap = LandmarkMap(chunk_size=4)
+        lmap.append(*random_landmarks(rng, 10))
+        before = lmap.all_means().copy()
+
+        copy = lmap.copy()
+        copy.set(np.array([5]), np.array([[1e3, 1e3]]), np.eye(2)[None])
+
+        np.testing.assert_array_equal(lmap.all_means(), before)
+        assert copy.all_means()[5].tolist() == [1e3, 1e3]
+        # only the written chunk was copied
+        assert copy.means[0] is lmap.means[0] and copy.means[2] is lmap.means[2]
+        assert copy.means[1] is not lmap.means[1]
+        # and the original copies it as well before writing
+        lmap.set(np.array([0]), np.array([[-1e3, -1e3]]), np.eye(2)[None])
+        assert copy.all_means()[0].tolist() == before[0].tolist()
+
+    @pytest.mark.parametrize("seed", range(5))
+    def test_local_matches_brute_force(self, seed):
+        rng = np.random.default_rng(seed)
+        lmap = LandmarkMap(chunk_size=8)
+        # landmarks seen along a path, as in a run, then some of them moved
+        path = np.cumsum(rng.standard_normal((100, 2)) * 5, axis=0)
+        lmap.append(path + rng.standard_normal((100, 2)) * 10, np.tile(np.eye(2), (100, 1, 1)))
+        moved = rng.choice(100, 20, replace=False)
+        lmap.set(moved, lmap.get(moved)[0] + rng.standard_normal((20, 2)) * 30,
+                 np.tile(np.eye(2), (20, 1, 1)))
+
+        means = lmap.all_means()
+        for center in path[::10]:
+            inds, local_means, local_covs = lmap.local(center, 25.0)
+            expected = np.flatnonzero(((means - center) ** 2).sum(axis=1) <= 25.0 ** 2)
+            np.testing.assert_array_equal(inds, expected)
+            np.testing.assert_array_equal(local_means, means[expected])
+            np.testing.assert_array_equal(local_covs, lmap.get(expected)[1])
+
+
+class Test_FastSLAM:
+    def test_close_to_ekf(self):
+        config = SimulationConfig(num_steps=80, max_range=30.0, seed=6)
+        data = simulate(config)
+        slam = EKFSLAM(config.Q, config.R, do_asso=True)
+        fslam = FastSLAM(EKFSLAM(config.Q, config.R, do_asso=True), num_particles=10,
+                         sensor_range=40, seed=0)
+        fslam.init_particles(data.poseGT[0])
+
+        eta, P = data.poseGT[0].copy(), np.zeros((3, 3))
+        for z_k, odo in zip(data.z_list(), data.odometry):
+            eta, P, _, _ = slam.update(eta, P, z_k)
+            x_ekf = eta[:3].copy()
+            eta, P = slam.predict(eta, P, odo)
+            fslam.update(z_k)
+            fslam.predict(odo)
+
+        # the estimate is of the last scan, the last odometry is not applied yet
+        x, landmarks = fslam.estimate()
+        assert np.linalg.norm(x[:2] - data.poseGT[-2, :2]) < 0.5
+        assert np.linalg.norm(x[:2] - x_ekf[:2]) < 0.5
+        assert landmarks.shape[0] == (eta.shape[0] - 3) // 2
+        assert np.abs(landmarks.ravel() - eta[3:]).max() < 0.5
+
+    def test_particles_spread_without_associations(self):
+        """Without landmarks to associate, the poses are sampled from the odometry noise."""
+        Q = np.diag([0.1, 0.1, 0.01]) ** 2
+        R = np.diag([0.1, 0.5 * np.pi / 180]) ** 2
+        fslam = FastSLAM(EKFSLAM(Q, R, do_asso=True), num_particles=500, seed=0)
+        fslam.init_particles(np.zeros(3))
+        fslam.predict(np.array([1.0, 0.0, 0.0]))
+        fslam.update(np.zeros((0, 2)))
+
+        np.testing.assert_allclose(fslam.poses.mean(axis=0), [1, 0, 0], atol=0.01)
+        np.testing.assert_allclose(fslam.poses.std(axis=0), np.sqrt(np.diag(Q)), rtol=0.1)
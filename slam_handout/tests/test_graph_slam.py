@@ -0,0 +1,86 @@
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+assignment_name = "slam"
+
+this_file = Path(__file__)
+tests_folder = this_file.parent
+project_folder = tests_folder.parent
+code_folder = project_folder.joinpath(assignment_name)
+
+sys.path.insert(0, str(code_folder))
+
+from EKFSLAM import EKFSLAM  # nopep8
+from graph_slam import GraphSLAM, GraphRecorder, landmark_ids  # nopep8
+from synthetic_data import SimulationConfig, simulate  # nopep8
+
+
+@pytest.fixture(scope="module")
+def recorded_run():
+    """An EKF run on simulated data, recorded for graph SLAM, with the filtered poses."""
+    config = SimulationConfig(num_steps=200, max_range=30.0, seed=5)
+    data = simulate(config)
+    slam = EKFSLAM(config.Q, config.R, do_asso=True)
+
+    eta, P = data.poseGT[0].copy(), np.zeros((3, 3))
+    recorder = GraphRecorder(eta)
+    poses = []
+    for z_k, odo in zip(data.z_list(), data.odometry):
+        eta, P, _, a = slam.update(eta, P, z_k)
+        recorder.scan(eta, z_k, a)
+        poses.append(eta[:3].copy())
+
+        recorder.odometry(odo)
+        eta, P = slam.predict(eta, P, odo)
+
+    return data, slam, recorder, np.array(poses), eta[3:].reshape(-1, 2)
+
+
+def rmse(poses, poseGT):
+    return np.sqrt(np.mean(np.sum((poses[:, :2] - poseGT[:, :2]) ** 2, axis=1)))
+
+
+class Test_GraphSLAM:
+    def test_smooths_ekf(self, recorded_run):
+        data, slam, recorder, filtered, landmarks = recorded_run
+        graph = GraphSLAM.from_recording(slam, recorder, landmarks)
+        r0, _ = graph.linearize(graph.pack(), jacobian=False)
+
+        stats = graph.optimize()
+
+        assert stats[-1]["cost"] < r0 @ r0 / 2
+        # pose 0 is the initial state, pose t the state at scan t - 1
+        poseGT = data.poseGT[:filtered.shape[0]]
+        assert rmse(graph.poses[1:], poseGT) < rmse(filtered, poseGT)
+        # the last pose has no later measurements, so it stays close to the filter
+        np.testing.assert_allclose(graph.poses[-1], filtered[-1], atol=0.1)
+        np.testing.assert_allclose(graph.landmarks, landmarks, atol=0.1)
+
+    @pytest.mark.parametrize("method, solver", [("gn", "splu"), ("lm", "lsqr")])
+    def test_methods_agree(self, recorded_run, method, solver):
+        _, slam, recorder, _, landmarks = recorded_run
+        reference = GraphSLAM.from_recording(slam, recorder, landmarks)
+        reference.optimize()
+        graph = GraphSLAM.from_recording(slam, recorder, landmarks)
+        graph.optimize(method=method, solver=solver)
+
+        np.testing.assert_allclose(graph.poses, reference.poses, atol=1e-3)
+        np.testing.assert_allclose(graph.landmarks, reference.landmarks, atol=1e-3)
+
+    def test_unknown_method(self, recorded_run):
+        _, slam, recorder, _, landmarks = recorded_run
+        graph = GraphSLAM.from_recording(slam, recorder, landmarks)
+        with pytest.raises(ValueError):
+            graph.optimize(method="newton")
+        with pytest.raises(ValueError):
+            graph.optimize(solver="cholesky")
+
+
+class Test_landmark_ids:
+    def test_new_landmarks_in_order(self):
+        ids = landmark_ids([np.array([-1, -1]), np.array([1, -1, 0]), np.array([-1])], 2)
+        np.testing.assert_array_equal(ids[0], [2, 3])
+        np.testing.assert_array_equal(ids[1], [1, 4, 0])
+        np.testing.assert_array_equal(ids[2], [5])
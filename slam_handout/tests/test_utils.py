@@ -0,0 +1,52 @@
+import sys
+from pathlib import Path
+import numpy as np
+import pytest
+
+assignment_name = "slam"
+
+this_file = Path(__file__)
+tests_folder = this_file.parent
+project_folder = tests_folder.parent
+code_folder = project_folder.joinpath(assignment_name)
+
+sys.path.insert(0, str(code_folder))
+
+import utils  # nopep8
+
+
+class Test_add_block_diag:
+    @pytest.mark.parametrize("num_blocks, b", [(1, 2), (7, 2), (4, 3), (0, 2)])
+    def test_matches_kron(self, num_blocks, b):
+        rng = np.random.default_rng(num_blocks)
+        A = rng.standard_normal((num_blocks * b,) * 2)
+        block = rng.standard_normal((b, b))
+
+        expected = A + np.kron(np.eye(num_blocks), block)
+        out = utils.add_block_diag(A, block)
+
+        assert out is A
+        np.testing.assert_allclose(A, expected)
+
+    def test_non_contiguous(self):
+        """A view into a larger matrix is updated in place, and nothing outside it."""
+        rng = np.random.default_rng(0)
+        big = rng.standard_normal((13, 13))
+        block = rng.standard_normal((2, 2))
+
+        expected = big.copy()
+        expected[1::2, 1::2] += np.kron(np.eye(3), block)
+        utils.add_block_diag(big[1::2, 1::2], block)
+
+        np.testing.assert_allclose(big, expected)
+
+
+class Test_matmul_block_diag:
+    @pytest.mark.parametrize("rows, num_blocks, b", [(5, 1, 2), (3, 6, 2), (8, 4, 3)])
+    def test_matches_kron(self, rows, num_blocks, b):
+        rng = np.random.default_rng(rows)
+        A = rng.standard_normal((rows, num_blocks * b))
+        block = rng.standard_normal((b, b))
+
+        np.testing.assert_allclose(
+            utils.matmul_block_diag(A, block), A @ np.kron(np.eye(num_blocks), block))